@@ -0,0 +1,390 @@
+"""
+backtest_engine.py  (v6.3.29-F4.8)
+
+向量化 walk-forward 回測 → performance_summary.xlsx（sheet ByStrategy），供動態權重使用。
+
+一次掃過整個歷史面板（dates × tickers）：
+1) build_panel：cache_yf（批次庫 / *.pkl，或 histories stage 輸出）對齊成 numpy 陣列
+2) compute_signals：與 compute_indicators + tag_strategy_complete 相同的公式/門檻，
+   每個 (日期, 股票) 一次算完，得到策略代碼陣列
+3) simulate：訊號日收盤價進場（entry_price），之後 hold_days 內最低價觸及 stop_loss_price
+   （一個月支撐）即出場（跳空開低以開盤價），否則持有滿 hold_days 以收盤價出場；
+   同一檔股票持倉期間不重複進場
+4) summarize：各策略 trades / 勝率 / 平均報酬 / 年化(%) / MDD(%)
+
+限制：歷史券資比不在快取內，SQUEEZE_TW（需券資比）只在傳入 smr 面板時才會觸發。
+param_sweep 等工具直接重用 build_panel / compute_signals / simulate（陣列介面）。
+
+    python backtest_engine.py --cache cache_yf --hold 10 --out performance_summary.xlsx
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+SUMMARY_SHEET = "ByStrategy"
+TRADES_SHEET = "Trades"
+TRADING_DAYS = 252
+
+STRATEGY_CODES = ["", "SQUEEZE_TW", "SQUEEZE_OTC", "HIGH_MARGIN_MEAN_REVERT", "MEAN_REVERT"]
+CODE_OF = {s: i for i, s in enumerate(STRATEGY_CODES)}
+
+# 與 daily_auto_run_final 的常數相同；daily 呼叫時會以自身常數覆寫
+DEFAULT_PARAMS = {
+    "min_avg_volume": 100_000,
+    "th_bias_mean_revert": -6.0,
+    "th_bias_deep": -8.0,
+    "th_squeeze_tw": 30.0,
+    "th_squeeze_otc_proxy": 0.90,
+    "th_support_tol": 0.00,
+    "th_squeeze_vol_ratio": 0.70,
+    "th_squeeze_volratio_vol": 1.20,
+    "th_squeeze_min_bias": -3.0,
+    "hold_days": 10,
+    "cost_pct": float(os.environ.get("BT_COST_PCT", "0.585")),   # 手續費 0.1425%×2 + 證交稅 0.3%
+    "slot_frac": float(os.environ.get("BT_SLOT_FRAC", "0.10")),  # 每筆交易占資金比例（計算權益曲線）
+}
+
+
+def default_params(**overrides) -> dict:
+    p = dict(DEFAULT_PARAMS)
+    p.update({k: v for k, v in overrides.items() if v is not None})
+    return p
+
+
+# ---------------------------------------------------------------------------
+# panel
+# ---------------------------------------------------------------------------
+class Panel:
+    """dates × tickers 的 OHLCV numpy 陣列（float64，缺值 NaN）+ 市場別。"""
+
+    def __init__(self, dates, tickers, open_, high, low, close, volume, market):
+        self.dates = dates
+        self.tickers = tickers
+        self.open = open_
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.market = market  # np.array[str]：TW / TWO
+
+    @property
+    def shape(self):
+        return self.close.shape
+
+
+def _market_of(ticker: str) -> str:
+    t = str(ticker).upper()
+    if t.endswith(".TWO"):
+        return "TWO"
+    if t.endswith(".TW"):
+        return "TW"
+    return ""
+
+
+def build_panel(histories: dict, index_ticker: str | None = "0050.TW") -> Panel:
+    """histories: {ticker: OHLCV DataFrame}（download_histories / cache_yf 格式）"""
+    hist = {t: h for t, h in histories.items() if h is not None and len(h) and t != index_ticker}
+    tickers = sorted(hist)
+    fields = {}
+    for f in ("Open", "High", "Low", "Close", "Volume"):
+        wide = pd.DataFrame({t: pd.to_numeric(hist[t][f], errors="coerce") for t in tickers if f in hist[t].columns})
+        fields[f] = wide
+    dates = fields["Close"].index.sort_values()
+    arr = {f: w.reindex(index=dates, columns=tickers).to_numpy(dtype="float64") for f, w in fields.items()}
+    return Panel(
+        dates=dates,
+        tickers=np.array(tickers, dtype=object),
+        open_=arr["Open"],
+        high=arr["High"],
+        low=arr["Low"],
+        close=arr["Close"],
+        volume=arr["Volume"],
+        market=np.array([_market_of(t) for t in tickers], dtype=object),
+    )
+
+
+def load_cached_histories(cache_dir: str = "cache_yf") -> dict:
+    """批次庫 cache_yf/batches + 舊版 cache_yf/*.pkl（history_ingest.read_cached）。"""
+    from history_ingest import read_cached
+
+    return {t: df for t, df in read_cached(cache_dir).items()
+            if not t.startswith(("IDX_", "^")) and "Close" in df.columns}
+
+
+# ---------------------------------------------------------------------------
+# indicators + tags (vectorized over the whole panel)
+# ---------------------------------------------------------------------------
+def _roll(a: np.ndarray, w: int, how: str) -> np.ndarray:
+    r = pd.DataFrame(a).rolling(w)
+    return getattr(r, how)().to_numpy()
+
+
+def compute_indicator_panel(panel: Panel) -> dict:
+    """每個 (日期, 股票) 的 compute_indicators 欄位；與逐檔版相同公式。"""
+    c, h, l, v = panel.close, panel.high, panel.low, panel.volume
+    ma20 = _roll(c, 20, "mean")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bias20 = (c - ma20) / ma20 * 100
+        prev_c = np.vstack([np.full((1, c.shape[1]), np.nan), c[:-1]])
+        tr = np.fmax(np.fmax(h - l, np.abs(h - prev_c)), np.abs(l - prev_c))  # NaN prev_close → high-low
+        atr20 = _roll(tr, 20, "mean")
+        range20 = _roll(h, 20, "max") - _roll(l, 20, "min")
+        range60 = _roll(h, 60, "max") - _roll(l, 60, "min")
+        volatility_ratio = range20 / range60
+        vol20 = _roll(v, 20, "mean")
+        volume_ratio = _roll(v, 5, "mean") / vol20
+    support_1m = _roll(l, 20, "min")
+    n_obs = np.cumsum(~np.isnan(c), axis=0)
+    with np.errstate(invalid="ignore"):
+        valid = (n_obs >= 60) & (atr20 > 0) & ~np.isnan(bias20) & ~np.isnan(ma20)
+    return {
+        "close": c, "ma20": ma20, "bias20": bias20, "support_1m": support_1m, "atr20": atr20,
+        "volatility_ratio": volatility_ratio, "volume_ratio": volume_ratio, "vol20": vol20, "valid": valid,
+    }
+
+
+def indicators_for(panel: Panel, use_store: bool = True) -> dict:
+    """feature_store 完整涵蓋面板時直接取用（免重算 rolling），否則 compute_indicator_panel。"""
+    if use_store:
+        try:
+            from feature_store import indicator_panel
+            ind = indicator_panel(panel)
+            if ind is not None:
+                return ind
+        except Exception:
+            pass
+    return compute_indicator_panel(panel)
+
+
+def compute_signals(panel: Panel, params: dict | None = None, ind: dict | None = None,
+                    smr: np.ndarray | None = None) -> np.ndarray:
+    """回傳 int8 策略代碼陣列（0=無訊號，其餘見 STRATEGY_CODES），優先序同 tag_strategy_complete。"""
+    p = default_params() if params is None else default_params(**params)
+    ind = compute_indicator_panel(panel) if ind is None else ind
+    c, ma20, bias = ind["close"], ind["ma20"], ind["bias20"]
+    vr, volr = ind["volatility_ratio"], ind["volume_ratio"]
+    valid = ind["valid"] & (ind["vol20"] >= p["min_avg_volume"])
+
+    is_tw = (panel.market == "TW")[None, :]
+    is_two = (panel.market == "TWO")[None, :]
+    codes = np.zeros(c.shape, dtype="int8")
+    undecided = valid.copy()
+
+    def _assign(mask, code):
+        m = undecided & mask
+        codes[m] = code
+        undecided[m] = False
+
+    with np.errstate(invalid="ignore"):
+        if smr is not None:
+            guard = (
+                (smr >= p["th_squeeze_tw"]) & (vr >= p["th_squeeze_vol_ratio"])
+                & (volr >= p["th_squeeze_volratio_vol"]) & (c >= ma20) & (bias >= p["th_squeeze_min_bias"])
+            )
+            _assign(is_tw & guard, CODE_OF["SQUEEZE_TW"])
+        otc_p = vr * 0.6 + volr * 0.4
+        _assign(is_two & (otc_p >= p["th_squeeze_otc_proxy"]), CODE_OF["SQUEEZE_OTC"])
+        below_support = c < ind["support_1m"] * (1.0 + p["th_support_tol"])
+        undecided &= ~below_support
+        _assign(bias <= p["th_bias_deep"], CODE_OF["HIGH_MARGIN_MEAN_REVERT"])
+        _assign(bias <= p["th_bias_mean_revert"], CODE_OF["MEAN_REVERT"])
+    return codes
+
+
+# ---------------------------------------------------------------------------
+# trade simulation
+# ---------------------------------------------------------------------------
+def simulate(panel: Panel, codes: np.ndarray, params: dict | None = None, ind: dict | None = None,
+             no_overlap: bool = True) -> dict:
+    """
+    回傳交易陣列 dict：t_entry, t_exit, col, code, entry, stop, exit, ret_pct, hold_days, stopped
+    （尚未平倉者不計）
+    """
+    p = default_params() if params is None else default_params(**params)
+    H = int(p["hold_days"])
+    T, N = panel.shape
+    ind = compute_indicator_panel(panel) if ind is None else ind
+
+    t_idx, n_idx = np.nonzero(codes)
+    keep = t_idx + H < T
+    t_idx, n_idx = t_idx[keep], n_idx[keep]
+    if t_idx.size == 0:
+        return _empty_trades()
+
+    entry = np.round(panel.close[t_idx, n_idx], 2)
+    sup = ind["support_1m"][t_idx, n_idx]
+    stop = np.where(np.isnan(sup), np.round(entry * 0.95, 2), np.round(sup, 2))
+
+    offs = np.arange(1, H + 1)[:, None]                     # (H, 1)
+    days = t_idx[None, :] + offs                            # (H, S)
+    lows = panel.low[days, n_idx[None, :]]
+    with np.errstate(invalid="ignore"):
+        hit = lows <= stop[None, :]
+    any_hit = hit.any(axis=0)
+    first = np.where(any_hit, hit.argmax(axis=0), H - 1)   # offset index 0..H-1
+    t_exit = t_idx + first + 1
+    opens = panel.open[t_exit, n_idx]
+    closes = panel.close[t_exit, n_idx]
+    exit_px = np.where(any_hit, np.where(np.isnan(opens), stop, np.minimum(opens, stop)), closes)
+
+    ok = ~np.isnan(exit_px) & ~np.isnan(entry) & (entry > 0)
+    if no_overlap:
+        ok &= _no_overlap_mask(t_idx, t_exit, n_idx, ok)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ret = (exit_px / entry - 1.0) * 100.0 - p["cost_pct"]
+    sel = np.nonzero(ok)[0]
+    return {
+        "t_entry": t_idx[sel],
+        "t_exit": t_exit[sel],
+        "col": n_idx[sel],
+        "code": codes[t_idx[sel], n_idx[sel]],
+        "entry": entry[sel],
+        "stop": stop[sel],
+        "exit": exit_px[sel],
+        "ret_pct": ret[sel],
+        "hold_days": (t_exit - t_idx)[sel],
+        "stopped": any_hit[sel],
+    }
+
+
+def _no_overlap_mask(t_idx, t_exit, n_idx, ok) -> np.ndarray:
+    """同一檔股票持倉期間（至出場日）的新訊號略過；只在稀疏訊號上逐筆走訪。"""
+    order = np.lexsort((t_idx, n_idx))
+    mask = np.zeros(t_idx.shape, dtype=bool)
+    busy_until = {}
+    for i in order.tolist():
+        if not ok[i]:
+            continue
+        n = int(n_idx[i])
+        if t_idx[i] <= busy_until.get(n, -1):
+            continue
+        mask[i] = True
+        busy_until[n] = int(t_exit[i])
+    return mask
+
+
+def _empty_trades() -> dict:
+    z = np.array([], dtype="int64")
+    f = np.array([], dtype="float64")
+    return {"t_entry": z, "t_exit": z, "col": z, "code": np.array([], dtype="int8"), "entry": f, "stop": f,
+            "exit": f, "ret_pct": f, "hold_days": z, "stopped": np.array([], dtype=bool)}
+
+
+# ---------------------------------------------------------------------------
+# summary
+# ---------------------------------------------------------------------------
+def equity_stats(t_exit: np.ndarray, ret_pct: np.ndarray, n_days: int, slot_frac: float) -> tuple[float, float]:
+    """出場日記帳：每筆以 slot_frac 資金計；回傳 (年化%, MDD%≤0)。"""
+    if ret_pct.size == 0 or n_days <= 1:
+        return 0.0, 0.0
+    daily = np.zeros(n_days, dtype="float64")
+    np.add.at(daily, t_exit, ret_pct / 100.0 * slot_frac)
+    eq = np.cumprod(1.0 + np.maximum(daily, -0.999999))
+    years = n_days / TRADING_DAYS
+    ann = (eq[-1] ** (1.0 / years) - 1.0) * 100.0 if eq[-1] > 0 else -100.0
+    dd = eq / np.maximum.accumulate(eq) - 1.0
+    return float(ann), float(dd.min() * 100.0)
+
+
+def summarize(trades: dict, panel: Panel, params: dict | None = None) -> pd.DataFrame:
+    p = default_params() if params is None else default_params(**params)
+    T = panel.shape[0]
+    rows = []
+    for code in sorted(set(trades["code"].tolist())):
+        m = trades["code"] == code
+        r = trades["ret_pct"][m]
+        ann, mdd = equity_stats(trades["t_exit"][m], r, T, p["slot_frac"])
+        rows.append({
+            "strategy": STRATEGY_CODES[int(code)],
+            "annualized_pct": round(ann, 4),
+            "mdd_pct": round(mdd, 4),
+            "trades": int(m.sum()),
+            "win_rate_pct": round(float((r > 0).mean() * 100.0), 2),
+            "avg_return_pct": round(float(r.mean()), 4),
+            "avg_hold_days": round(float(trades["hold_days"][m].mean()), 2),
+            "stop_rate_pct": round(float(trades["stopped"][m].mean() * 100.0), 2),
+            "first_entry": str(panel.dates[int(trades["t_entry"][m].min())].date()),
+            "last_exit": str(panel.dates[int(trades["t_exit"][m].max())].date()),
+        })
+    cols = ["strategy", "annualized_pct", "mdd_pct", "trades", "win_rate_pct", "avg_return_pct",
+            "avg_hold_days", "stop_rate_pct", "first_entry", "last_exit"]
+    return pd.DataFrame(rows, columns=cols)
+
+
+def trades_frame(trades: dict, panel: Panel) -> pd.DataFrame:
+    return pd.DataFrame({
+        "strategy": [STRATEGY_CODES[int(c)] for c in trades["code"].tolist()],
+        "ticker": panel.tickers[trades["col"]],
+        "entry_date": panel.dates[trades["t_entry"]].strftime("%Y-%m-%d"),
+        "exit_date": panel.dates[trades["t_exit"]].strftime("%Y-%m-%d"),
+        "entry_price": trades["entry"],
+        "stop_loss_price": trades["stop"],
+        "exit_price": np.round(trades["exit"], 2),
+        "pnl_pct": np.round(trades["ret_pct"], 4),
+        "hold_days": trades["hold_days"],
+        "exit_reason": np.where(trades["stopped"], "STOP", "HOLD"),
+    })
+
+
+def write_summary(path: str, summary: pd.DataFrame, trades: pd.DataFrame | None = None) -> None:
+    tmp = path + ".tmp.xlsx"
+    with pd.ExcelWriter(tmp) as xw:
+        summary.to_excel(xw, sheet_name=SUMMARY_SHEET, index=False)
+        if trades is not None:
+            trades.to_excel(xw, sheet_name=TRADES_SHEET, index=False)
+    os.replace(tmp, path)
+
+
+def run_backtest(histories: dict, params: dict | None = None, smr: np.ndarray | None = None):
+    """histories → (summary DataFrame, trades DataFrame, Panel)"""
+    panel = build_panel(histories)
+    ind = indicators_for(panel)
+    codes = compute_signals(panel, params, ind=ind, smr=smr)
+    tr = simulate(panel, codes, params, ind=ind)
+    return summarize(tr, panel, params), trades_frame(tr, panel), panel
+
+
+def build_performance_summary(out_path: str = "performance_summary.xlsx", cache_dir: str = "cache_yf",
+                              histories: dict | None = None, params: dict | None = None,
+                              include_trades: bool = True, log=print) -> pd.DataFrame | None:
+    """快取歷史 → 回測 → 寫出 ByStrategy；無資料或無交易時回傳 None（不寫檔）。"""
+    t0 = time.perf_counter()
+    hist = histories if histories is not None else load_cached_histories(cache_dir)
+    if not hist:
+        log(f"[backtest] no cached histories in {cache_dir}")
+        return None
+    summary, trades, panel = run_backtest(hist, params)
+    if summary.empty:
+        log(f"[backtest] no closed trades over {panel.shape[0]} days x {panel.shape[1]} tickers")
+        return None
+    write_summary(out_path, summary, trades if include_trades else None)
+    log(f"[backtest] {out_path}: {len(trades)} trades, {panel.shape[0]} days x {panel.shape[1]} tickers "
+        f"in {time.perf_counter() - t0:.2f}s")
+    return summary
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Vectorized walk-forward backtest -> performance_summary.xlsx")
+    ap.add_argument("--cache", default="cache_yf")
+    ap.add_argument("--out", default="performance_summary.xlsx")
+    ap.add_argument("--hold", type=int, default=None, help="holding days (default %d)" % DEFAULT_PARAMS["hold_days"])
+    ap.add_argument("--cost", type=float, default=None, help="round-trip cost %%")
+    ap.add_argument("--no-trades", action="store_true", help="omit the Trades sheet")
+    args = ap.parse_args(argv)
+    params = default_params(hold_days=args.hold, cost_pct=args.cost)
+    summary = build_performance_summary(args.out, args.cache, params=params, include_trades=not args.no_trades)
+    if summary is None:
+        return 1
+    with pd.option_context("display.width", 160, "display.max_columns", 20):
+        print(summary.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
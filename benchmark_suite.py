@@ -0,0 +1,450 @@
+"""
+benchmark_suite.py  (v6.3.29-F4.8)
+
+熱路徑基準測試（合成市場資料，固定 seed，不連網）：
+- compute_indicators / tag_strategy_complete        （daily_auto_run_final，逐檔）
+- apply_live_scoring                                 （strategy_score）
+- compute_composite_score                            （daily_auto_run_final）
+- build_top20                                        （export_top20, prepared=True）
+- write_styled_excel / format_excel_sheet            （Excel 輸出）
+
+規模：1x = 今日 Stage2 約 1200 檔（TOPN_LIQUID），另有 10x / 100x。
+每項紀錄：最佳/中位 wall 秒數、throughput（items/s）、tracemalloc 峰值記憶體。
+
+用法：
+    python benchmark_suite.py                          # 1x,10x，印出結果
+    python benchmark_suite.py --scales 1,10,100 --save bench_baseline.json
+    python benchmark_suite.py --compare bench_baseline.json   # 變慢/變胖超過容忍值 → exit 1
+    python benchmark_suite.py --startup                # 入口腳本啟動時間 + -X importtime 前幾名
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+BASE_TICKERS = 1200          # = daily_auto_run_final.TOPN_LIQUID
+HISTORY_DAYS = 126           # ~6mo，與 download_histories(period="6mo") 相同
+DEFAULT_SEED = 20240601
+DEFAULT_SCALES = (1, 10)
+DEFAULT_REPEAT = 3
+TIME_TOLERANCE = 0.25        # 比 baseline 慢 25% 以上視為退步
+MEM_TOLERANCE = 0.30
+EXCEL_MAX_SCALE = 10         # openpyxl 重開 workbook 在 100x 太慢，預設略過（--all 強制執行）
+DEFAULT_BASELINE = "bench_baseline.json"
+
+STRATEGIES = ["MEAN_REVERT", "HIGH_MARGIN_MEAN_REVERT", "SQUEEZE_TW", "SQUEEZE_OTC"]
+
+
+# ---------------------------------------------------------------------------
+# synthetic market
+# ---------------------------------------------------------------------------
+def synth_tickers(n: int) -> list[tuple[str, str, str]]:
+    """[(ticker, symbol, market)]；約 60% 上市 / 40% 上櫃。"""
+    out = []
+    for i in range(n):
+        sym = f"{1000 + i:04d}" if i < 9000 else f"{100000 + i:06d}"
+        market = "TW" if (i % 5) < 3 else "TWO"
+        out.append((f"{sym}.{market}", sym, market))
+    return out
+
+
+def synth_histories(n: int, days: int = HISTORY_DAYS, seed: int = DEFAULT_SEED) -> dict[str, pd.DataFrame]:
+    """幾何隨機漫步 OHLCV，每檔一張 DataFrame（與 download_histories 輸出同形）。"""
+    rng = np.random.default_rng(seed)
+    idx = pd.bdate_range(end=pd.Timestamp("2024-06-28"), periods=days)
+    start = rng.uniform(10.0, 600.0, size=n)
+    vol = rng.uniform(0.01, 0.04, size=n)
+    rets = rng.normal(0.0, 1.0, size=(days, n)) * vol
+    close = start * np.exp(np.cumsum(rets, axis=0))
+    spread = np.abs(rng.normal(0.0, 1.0, size=(days, n))) * vol * close
+    high = close + spread
+    low = np.maximum(close - spread, 0.01)
+    opn = low + (high - low) * rng.uniform(0.0, 1.0, size=(days, n))
+    base_vol = rng.lognormal(mean=13.0, sigma=1.2, size=n)
+    volume = np.maximum(base_vol * rng.lognormal(0.0, 0.4, size=(days, n)), 0).round()
+    out = {}
+    for j, (t, _, _) in enumerate(synth_tickers(n)):
+        out[t] = pd.DataFrame(
+            {"Open": opn[:, j], "High": high[:, j], "Low": low[:, j], "Close": close[:, j], "Volume": volume[:, j]},
+            index=idx,
+        )
+    return out
+
+
+def synth_margin_map(n: int, seed: int = DEFAULT_SEED) -> dict[tuple[str, str], float]:
+    """(symbol, market) -> 券資比(%)，與 fetch_margin_short_ratio_map 同鍵。"""
+    rng = np.random.default_rng(seed + 1)
+    smr = rng.gamma(2.0, 6.0, size=n)
+    return {(sym, "TWO" if m == "TWO" else "TW"): float(v) for (_, sym, m), v in zip(synth_tickers(n), smr)}
+
+
+def synth_shares_map(n: int, seed: int = DEFAULT_SEED) -> dict[str, int]:
+    rng = np.random.default_rng(seed + 2)
+    shares = (rng.lognormal(18.5, 1.0, size=n)).round().astype("int64")
+    return {sym: int(v) for (_, sym, _), v in zip(synth_tickers(n), shares)}
+
+
+def synth_candidates(n: int, seed: int = DEFAULT_SEED) -> pd.DataFrame:
+    """rules stage 輸出的候選表（英文欄位，apply_live_scoring 的輸入）。"""
+    rng = np.random.default_rng(seed + 3)
+    tk = synth_tickers(n)
+    price = rng.uniform(10.0, 600.0, size=n).round(2)
+    bias = rng.normal(-7.0, 3.0, size=n).round(2)
+    volume = rng.lognormal(13.0, 1.2, size=n).round()
+    shares = np.array(list(synth_shares_map(n, seed).values()), dtype="float64")
+    smr = np.array(list(synth_margin_map(n, seed).values()))
+    df = pd.DataFrame({
+        "entry_date": "2024-06-28",
+        "symbol": [s for _, s, _ in tk],
+        "market": [m for _, _, m in tk],
+        "ticker": [t for t, _, _ in tk],
+        "name_zh": [f"合成{i}" for i in range(n)],
+        "strategy": rng.choice(STRATEGIES, size=n),
+        "entry_price": price,
+        "stop_loss_price": (price * 0.95).round(2),
+        "close": price,
+        "ma20": (price / (1 + bias / 100)).round(2),
+        "bias20": bias,
+        "atr20": (price * rng.uniform(0.01, 0.05, size=n)).round(4),
+        "volatility_ratio": rng.uniform(0.3, 1.2, size=n).round(4),
+        "volume_ratio": rng.uniform(0.4, 2.5, size=n).round(4),
+        "short_margin_ratio(%)": smr.round(2),
+        "weight_score_raw": rng.uniform(-1.0, 1.0, size=n).round(4),
+        "position_size": rng.uniform(0, 60_000, size=n).round(0),
+        "volume": volume,
+        "traded_value_ntd": (volume * price).round(0),
+        "turnover_rate(%)": (volume / shares * 100).round(4),
+        "vol_annual": rng.uniform(0.15, 0.9, size=n).round(4),
+        "Risk Alert": np.where(rng.uniform(size=n) < 0.15, "HIGH_RISK", ""),
+    })
+    return df
+
+
+def synth_full_frame(n: int, seed: int = DEFAULT_SEED) -> pd.DataFrame:
+    """FULL 中文欄位表（composite / Top20 / Excel 輸入）。"""
+    df = synth_candidates(n, seed)
+    try:
+        import daily_auto_run_final as dar
+        df = df.rename(columns=dar.COLUMN_MAP_ZH)
+    except Exception:
+        pass
+    df = df.rename(columns={
+        "traded_value_ntd": "成交值(元)",
+        "turnover_rate(%)": "周轉率(%)",
+        "short_margin_ratio(%)": "券資比(%)",
+    })
+    from strategy_score import apply_live_scoring
+    return apply_live_scoring(df)
+
+
+# ---------------------------------------------------------------------------
+# benchmarks: name -> (setup(n, seed) -> state, run(state) -> None, items(state) -> int, max_scale)
+# ---------------------------------------------------------------------------
+def _setup_indicators(n, seed):
+    return {"hist": synth_histories(n, seed=seed)}
+
+
+def _run_indicators(st):
+    import daily_auto_run_final as dar
+    ci = dar.compute_indicators
+    st["ind"] = {t: ci(h) for t, h in st["hist"].items()}
+
+
+def _setup_tagging(n, seed):
+    import daily_auto_run_final as dar
+    hist = synth_histories(n, seed=seed)
+    ind = {t: dar.compute_indicators(h) for t, h in hist.items()}
+    return {"ind": {t: v for t, v in ind.items() if v}, "ratio": synth_margin_map(n, seed)}
+
+
+def _run_tagging(st):
+    import daily_auto_run_final as dar
+    ratio = st["ratio"]
+    for t, ind in st["ind"].items():
+        sym, market = t.split(".")
+        otc_p = dar.calc_otc_short_pressure(ind["volatility_ratio"], ind["volume_ratio"])
+        dar.tag_strategy_complete(market, ind, ratio.get((sym, market)), otc_p)
+
+
+def _run_live_scoring(st):
+    from strategy_score import apply_live_scoring
+    apply_live_scoring(st["df"])
+
+
+def _run_composite(st):
+    import daily_auto_run_final as dar
+    dar.compute_composite_score(st["df"])
+
+
+def _run_top20(st):
+    from export_top20 import build_top20
+    build_top20(st["df"], prepared=True)
+
+
+def _run_styled_excel(st):
+    from excel_writer import write_styled_excel
+    if not write_styled_excel(st["df"], st["path"], hide_headers=["Yahoo代碼"]):
+        raise RuntimeError("xlsxwriter not installed")
+
+
+def _run_openpyxl_excel(st):
+    import daily_auto_run_final as dar
+    st["df"].to_excel(st["path"], index=False)
+    dar.format_excel_sheet(st["path"], hide_headers=["Yahoo代碼"])
+
+
+def _setup_excel(n, seed):
+    d = tempfile.mkdtemp(prefix="bench_xlsx_")
+    return {"df": synth_full_frame(n, seed), "path": os.path.join(d, "bench.xlsx"), "tmpdir": d}
+
+
+BENCHMARKS = {
+    "compute_indicators": (_setup_indicators, _run_indicators, lambda st: len(st["hist"]), None),
+    "tag_strategy_complete": (_setup_tagging, _run_tagging, lambda st: len(st["ind"]), None),
+    "apply_live_scoring": (lambda n, s: {"df": synth_candidates(n, s)}, _run_live_scoring, lambda st: len(st["df"]), None),
+    "compute_composite_score": (lambda n, s: {"df": synth_full_frame(n, s)}, _run_composite, lambda st: len(st["df"]), None),
+    "build_top20": (lambda n, s: {"df": synth_full_frame(n, s)}, _run_top20, lambda st: len(st["df"]), None),
+    "write_styled_excel": (_setup_excel, _run_styled_excel, lambda st: len(st["df"]), EXCEL_MAX_SCALE),
+    "format_excel_sheet": (_setup_excel, _run_openpyxl_excel, lambda st: len(st["df"]), EXCEL_MAX_SCALE),
+}
+
+
+def _cleanup(st) -> None:
+    d = st.get("tmpdir") if isinstance(st, dict) else None
+    if d:
+        import shutil
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def run_one(name: str, scale: int, repeat: int = DEFAULT_REPEAT, seed: int = DEFAULT_SEED) -> dict:
+    """計時（repeat 次，不開 tracemalloc）+ 額外一次 tracemalloc 量峰值記憶體。"""
+    setup, fn, items, _ = BENCHMARKS[name]
+    n = BASE_TICKERS * scale
+    st = setup(n, seed)
+    try:
+        fn(st)  # warm-up（import / 快取）
+        times = []
+        for _ in range(max(1, repeat)):
+            gc.collect()
+            t0 = time.perf_counter()
+            fn(st)
+            times.append(time.perf_counter() - t0)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn(st)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        k = items(st)
+    finally:
+        _cleanup(st)
+    best = min(times)
+    return {
+        "benchmark": name,
+        "scale": scale,
+        "tickers": n,
+        "items": k,
+        "best_s": round(best, 6),
+        "median_s": round(statistics.median(times), 6),
+        "items_per_s": round(k / best, 2) if best > 0 else None,
+        "peak_mem_bytes": int(peak),
+    }
+
+
+def run_suite(scales=DEFAULT_SCALES, only=None, repeat: int = DEFAULT_REPEAT, seed: int = DEFAULT_SEED,
+              include_all: bool = False, log=print) -> list[dict]:
+    results = []
+    for scale in scales:
+        for name, (_, _, _, max_scale) in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            if max_scale is not None and scale > max_scale and not include_all:
+                log(f"[bench] skip {name} @ {scale}x (max {max_scale}x; use --all)")
+                continue
+            try:
+                r = run_one(name, scale, repeat=repeat, seed=seed)
+            except Exception as e:
+                log(f"[bench] {name} @ {scale}x failed: {e!r}")
+                results.append({"benchmark": name, "scale": scale, "error": repr(e)})
+                continue
+            log(f"[bench] {name:<24} {scale:>4}x  best={r['best_s']:.4f}s  "
+                f"{r['items_per_s'] or 0:>12,.0f} items/s  peak={r['peak_mem_bytes'] / 1e6:,.1f} MB")
+            results.append(r)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# startup (import-time) benchmarks
+# ---------------------------------------------------------------------------
+STARTUP_TARGETS = {
+    "import daily_auto_run_final": ["-c", "import daily_auto_run_final"],
+    "daily_auto_run_final --help": ["daily_auto_run_final.py", "--help"],
+    "import export_top20": ["-c", "import export_top20"],
+}
+
+
+def parse_importtime(stderr: str) -> list[dict]:
+    """解析 `python -X importtime` 輸出：[{module, self_us, cumulative_us, depth}]"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            _, rest = line.split(":", 1)
+            self_us, cum_us, name = rest.split("|", 2)
+            depth = (len(name) - len(name.lstrip())) // 2
+            rows.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cum_us), "depth": depth})
+        except Exception:
+            continue
+    return rows
+
+
+def run_startup(name: str, repeat: int = DEFAULT_REPEAT, top: int = 10, cwd: str | None = None) -> dict:
+    """新子程序量 wall 時間（best of repeat），再跑一次 -X importtime 取最貴的頂層 import。"""
+    args = STARTUP_TARGETS[name]
+    cwd = cwd or os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=cwd, capture_output=True, text=True)
+        times.append(time.perf_counter() - t0)
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=cwd, capture_output=True, text=True)
+    rows = parse_importtime(proc.stderr)
+    heavy = sorted((r for r in rows if r["depth"] <= 1), key=lambda r: r["cumulative_us"], reverse=True)[:top]
+    best = min(times)
+    return {
+        "benchmark": f"startup:{name}",
+        "scale": 1,
+        "tickers": 0,
+        "items": 1,
+        "best_s": round(best, 6),
+        "median_s": round(statistics.median(times), 6),
+        "items_per_s": round(1 / best, 2) if best > 0 else None,
+        "peak_mem_bytes": None,
+        "import_total_us": sum(r["self_us"] for r in rows),
+        "top_imports": heavy,
+    }
+
+
+def run_startup_suite(repeat: int = DEFAULT_REPEAT, top: int = 10, log=print) -> list[dict]:
+    results = []
+    for name in STARTUP_TARGETS:
+        try:
+            r = run_startup(name, repeat=repeat, top=top)
+        except Exception as e:
+            log(f"[bench] startup {name} failed: {e!r}")
+            results.append({"benchmark": f"startup:{name}", "scale": 1, "error": repr(e)})
+            continue
+        log(f"[bench] startup {name:<30} best={r['best_s']:.3f}s  imports={r['import_total_us'] / 1e6:.3f}s")
+        for imp in r["top_imports"]:
+            log(f"          {imp['cumulative_us'] / 1e3:>9.1f} ms  {imp['module']}")
+        results.append(r)
+    return results
+
+
+def environment() -> dict:
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def save_baseline(path: str, results: list[dict], seed: int) -> None:
+    doc = {
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "seed": seed,
+        "env": environment(),
+        "results": [r for r in results if "error" not in r],
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(doc, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def compare(results: list[dict], baseline: dict, time_tol: float = TIME_TOLERANCE, mem_tol: float = MEM_TOLERANCE) -> list[dict]:
+    """回傳退步清單（空 = 通過）。時間比 best_s，記憶體比 peak_mem_bytes。"""
+    base = {(r["benchmark"], r["scale"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        if "error" in r:
+            regressions.append({"benchmark": r["benchmark"], "scale": r["scale"], "reason": r["error"]})
+            continue
+        b = base.get((r["benchmark"], r["scale"]))
+        if not b:
+            continue
+        t_ratio = r["best_s"] / b["best_s"] if b.get("best_s") else 1.0
+        m_ratio = r["peak_mem_bytes"] / b["peak_mem_bytes"] if (b.get("peak_mem_bytes") and r.get("peak_mem_bytes")) else 1.0
+        if t_ratio > 1.0 + time_tol:
+            regressions.append({"benchmark": r["benchmark"], "scale": r["scale"],
+                                "reason": f"time {b['best_s']:.4f}s -> {r['best_s']:.4f}s (x{t_ratio:.2f})"})
+        if m_ratio > 1.0 + mem_tol:
+            regressions.append({"benchmark": r["benchmark"], "scale": r["scale"],
+                                "reason": f"peak mem {b['peak_mem_bytes']:,} -> {r['peak_mem_bytes']:,} (x{m_ratio:.2f})"})
+    return regressions
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Synthetic-market benchmarks for indicator / scoring / export hot paths")
+    ap.add_argument("--scales", default=",".join(str(s) for s in DEFAULT_SCALES), help="e.g. 1,10,100")
+    ap.add_argument("--only", default="", help="comma separated benchmark names")
+    ap.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    ap.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    ap.add_argument("--all", action="store_true", help="also run Excel benchmarks above EXCEL_MAX_SCALE")
+    ap.add_argument("--save", nargs="?", const=DEFAULT_BASELINE, default=None, help="write baseline JSON")
+    ap.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, default=None, help="compare against baseline JSON")
+    ap.add_argument("--time-tol", type=float, default=TIME_TOLERANCE)
+    ap.add_argument("--mem-tol", type=float, default=MEM_TOLERANCE)
+    ap.add_argument("--startup", action="store_true", help="entry-script startup / import-time benchmarks")
+    ap.add_argument("--list", action="store_true")
+    args = ap.parse_args(argv)
+
+    if args.list:
+        for name in list(BENCHMARKS) + [f"startup:{t}" for t in STARTUP_TARGETS]:
+            print(name)
+        return 0
+
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    only = {s.strip() for s in args.only.split(",") if s.strip()} or None
+    if args.startup:
+        results = run_startup_suite(repeat=args.repeat)
+    else:
+        results = run_suite(scales, only=only, repeat=args.repeat, seed=args.seed, include_all=args.all)
+
+    if args.save:
+        save_baseline(args.save, results, args.seed)
+        print(f"[bench] baseline saved: {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("env") != environment():
+            print(f"[bench] WARNING: baseline env differs: {baseline.get('env')} vs {environment()}")
+        regs = compare(results, baseline, args.time_tol, args.mem_tol)
+        for r in regs:
+            print(f"[bench] REGRESSION {r['benchmark']} @ {r['scale']}x: {r['reason']}")
+        if regs:
+            return 1
+        print("[bench] no regressions vs baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
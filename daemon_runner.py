@@ -0,0 +1,328 @@
+"""
+daemon_runner.py  (v6.3.29-F4.8)
+
+常駐模式：daily_auto_run_final 只 import 一次，保留暖狀態，盤前重跑只需數秒。
+- 暖狀態：pandas / yfinance / requests SESSION（連線池）、股票池、券資比、Stage1 流動性、Stage2 歷史價量
+  （pipeline_stages.MemoryCheckpointStore 保留 universe / margin / prefilter / histories 的輸出），
+  股本 map（_SHARES_MEMO）
+- 每次 run：warm stage 直接取用，ledger 之後的計算 stage 全部重跑
+- 失效：
+    * 交易日變更 → 全部清除
+    * DAEMON_WATCH 內的路徑 mtime 晚於 stage 完成時間 → 該 stage（含）之後清除
+      （預設 histories=cache_yf：隔夜預抓 / 其他程序更新快取即失效）
+    * DAEMON_TTL 秒數到期（預設 margin=3600）
+    * client 送 invalidate <stage|all>
+
+    python daemon_runner.py serve                      # 127.0.0.1:DAEMON_PORT（預設 8765）
+    python daemon_runner.py run [--from rules]         # 送出執行請求，等待結果
+    python daemon_runner.py top20 [--date 2025-01-02]
+    python daemon_runner.py status | invalidate histories | stop
+
+通訊：multiprocessing.connection（本機 TCP + authkey 驗證），請求 / 回應皆為 dict。
+authkey：DAEMON_AUTHKEY；未設定時 serve 產生隨機金鑰寫入 DAEMON_AUTHKEY_FILE（權限 0600，
+預設 ~/.daily_auto_run_daemon.key），client 讀同一檔案。沒有固定的預設金鑰（連線會 unpickle 請求）。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+from multiprocessing.connection import Client, Listener
+
+from lazy_imports import is_loaded
+
+HOST = "127.0.0.1"
+PORT = int(os.environ.get("DAEMON_PORT", "8765"))
+AUTHKEY_FILE = os.environ.get("DAEMON_AUTHKEY_FILE", os.path.join(os.path.expanduser("~"), ".daily_auto_run_daemon.key"))
+
+
+class AuthKeyError(RuntimeError):
+    pass
+
+
+def _read_key_file(path: str) -> bytes | None:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if os.name != "nt" and st.st_mode & 0o077:
+        raise AuthKeyError(f"{path} is readable by other users; run: chmod 600 {path}")
+    with open(path, "rb") as f:
+        key = f.read().strip()
+    if not key:
+        raise AuthKeyError(f"{path} is empty")
+    return key
+
+
+def authkey(create: bool = False, path: str = AUTHKEY_FILE) -> bytes:
+    """DAEMON_AUTHKEY > 金鑰檔；create=True（serve）時金鑰檔不存在就產生（0600）。"""
+    env = os.environ.get("DAEMON_AUTHKEY", "").strip()
+    if env:
+        return env.encode("utf-8")
+    key = _read_key_file(path)
+    if key is not None:
+        return key
+    if not create:
+        raise AuthKeyError(f"no DAEMON_AUTHKEY and no key file {path} (start the daemon first)")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:  # 另一個 serve 同時建立
+        return authkey(create=False, path=path)
+    key = secrets.token_hex(32).encode("ascii")
+    with os.fdopen(fd, "wb") as f:
+        f.write(key + b"\n")
+    return key
+
+
+def _parse_pairs(spec: str) -> dict[str, str]:
+    """'histories=cache_yf;margin=3600' -> {'histories': 'cache_yf', 'margin': '3600'}"""
+    out = {}
+    for part in (spec or "").split(";"):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = v.strip()
+    return out
+
+
+WATCH = {k: [p for p in v.split(",") if p] for k, v in
+         _parse_pairs(os.environ.get("DAEMON_WATCH", "histories=cache_yf")).items()}
+TTL = {k: float(v) for k, v in _parse_pairs(os.environ.get("DAEMON_TTL", "margin=3600")).items()}
+
+
+def _latest_mtime(path: str) -> float:
+    """檔案 mtime；目錄取自身與第一層檔案的最大值。"""
+    try:
+        m = os.path.getmtime(path)
+    except OSError:
+        return 0.0
+    if os.path.isdir(path):
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    m = max(m, e.stat().st_mtime)
+                except OSError:
+                    continue
+    return m
+
+
+class Daemon:
+    def __init__(self, log=None):
+        t0 = time.perf_counter()
+        import daily_auto_run_final as d  # heavy imports / module state: once per daemon
+        from pipeline_stages import CheckpointStore, MemoryCheckpointStore, prune_days
+
+        self.d = d
+        self._Store = MemoryCheckpointStore
+        self._Backing = CheckpointStore
+        self._prune = prune_days
+        self.store = None
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.last = None
+        self.log = log or d.log
+        self.started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.log(f"[daemon] pipeline module loaded in {time.perf_counter() - t0:.2f}s")
+
+    # ----- warm state -----
+    def _store_for_today(self):
+        day = self.d._today_str()
+        if self.store is None or self.store.day != day:
+            if self.store is not None:
+                self.log(f"[daemon] trading day {self.store.day} -> {day}: warm state cleared")
+            self.store = self._Store(day, backing=self._Backing(self.d.CHECKPOINT_DIR, day))
+            self._prune(self.d.CHECKPOINT_DIR, day, log=self.log)
+        return self.store
+
+    def _expire(self, store) -> list[str]:
+        """WATCH / TTL 失效；回傳被清除的起始 stage。"""
+        dropped = []
+        now = time.time()
+        for stage in list(store.completed()):
+            if stage not in store.saved_at:
+                continue
+            saved = store.saved_at[stage]
+            changed = any(_latest_mtime(p) > saved for p in WATCH.get(stage, ()))
+            expired = stage in TTL and now - saved > TTL[stage]
+            if changed or expired:
+                store.drop_from(stage)
+                dropped.append(stage)
+                self.log(f"[daemon] {stage}: {'new data' if changed else 'ttl expired'} -> invalidated")
+                break  # drop_from 已清除其後所有 stage
+        return dropped
+
+    def invalidate(self, stage: str | None) -> dict:
+        with self.lock:
+            store = self._store_for_today()
+            store.drop_from("universe" if not stage or stage == "all" else stage)
+            return {"ok": True, "warm": store.completed()}
+
+    def _begin_run(self) -> None:
+        d = self.d
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        d.RUN_TS = ts
+        d.LOG_FILE = f"run_{ts}.log"  # 每次 run 一組 run_<ts>.log + run_metrics_<ts>.json
+        if is_loaded(d.LOGGER):
+            d.LOGGER.reopen(d.LOG_FILE)
+        d.METRICS_FILE = f"run_metrics_{ts}.json"
+        d.INVALID_TICKERS_FILE = f"invalid_tickers_{ts}.csv"
+        d.METRICS.reset(ts)
+        d.INVALID_TICKERS.clear()
+        d.decision_path = d.full_path = None
+
+    # ----- requests -----
+    def run(self, from_stage: str | None = None) -> dict:
+        with self.lock:
+            store = self._store_for_today()
+            self._expire(store)
+            if from_stage:
+                store.drop_from(from_stage)
+            warm = store.completed()
+            self._begin_run()
+            t0 = time.perf_counter()
+            try:
+                self.d.main(resume=True, store=store)
+                res = {"ok": True}
+            except (Exception, SystemExit) as e:  # 回報給 client，daemon 不中斷
+                import traceback
+                self.d.log("daemon run failed:\n" + traceback.format_exc(), level="ERROR")
+                res = {"ok": False, "error": repr(e)}
+            finally:
+                self.d.LOGGER.flush()
+            self.runs += 1
+            res.update(seconds=round(time.perf_counter() - t0, 2), day=store.day, warm=warm,
+                       full_path=self.d.full_path, decision_path=self.d.decision_path, metrics=self.d.METRICS_FILE)
+            self.last = res
+            return res
+
+    def top20(self, run_date: str | None = None) -> dict:
+        with self.lock:
+            import export_top20
+            prev = os.environ.get("RUN_DATE")
+            t0 = time.perf_counter()
+            try:
+                if run_date:
+                    os.environ["RUN_DATE"] = run_date
+                export_top20.main()
+                return {"ok": True, "seconds": round(time.perf_counter() - t0, 2)}
+            except Exception as e:
+                return {"ok": False, "error": repr(e)}
+            finally:
+                if prev is None:
+                    os.environ.pop("RUN_DATE", None)
+                else:
+                    os.environ["RUN_DATE"] = prev
+
+    def status(self) -> dict:
+        store = self.store
+        return {
+            "ok": True,
+            "started": self.started,
+            "runs": self.runs,
+            "busy": self.lock.locked(),
+            "day": store.day if store else None,
+            "warm": store.completed() if store else [],
+            "warm_age_s": {s: round(time.time() - t, 1) for s, t in (store.saved_at.items() if store else [])},
+            "last": self.last,
+        }
+
+    def handle(self, req: dict) -> dict:
+        cmd = (req or {}).get("cmd")
+        if cmd == "run":
+            return self.run(req.get("from"))
+        if cmd == "top20":
+            return self.top20(req.get("date"))
+        if cmd == "status":
+            return self.status()
+        if cmd == "invalidate":
+            return self.invalidate(req.get("stage"))
+        return {"ok": False, "error": f"unknown command: {cmd!r}"}
+
+
+def serve(host: str = HOST, port: int = PORT) -> int:
+    key = authkey(create=True)
+    daemon = Daemon()
+
+    def _reply(conn, req):
+        try:
+            conn.send(daemon.handle(req))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    with Listener((host, port), authkey=key) as listener:
+        daemon.log(f"[daemon] listening on {host}:{port}")
+        while True:
+            try:
+                conn = listener.accept()
+                req = conn.recv()
+            except Exception as e:  # 驗證失敗 / client 中斷：略過該連線
+                daemon.log(f"[daemon] rejected connection: {e!r}")
+                continue
+            if (req or {}).get("cmd") == "stop":
+                conn.send({"ok": True, "stopping": True, "busy": daemon.lock.locked()})
+                conn.close()
+                break
+            # run 期間 status 仍可回應（run / top20 / invalidate 以 lock 串行）
+            threading.Thread(target=_reply, args=(conn, req), daemon=True).start()
+    with daemon.lock:  # 等待進行中的 run 結束
+        daemon.log("[daemon] stopped")
+    daemon.d.close_logger()
+    return 0
+
+
+def request(req: dict, host: str = HOST, port: int = PORT, timeout: float | None = None) -> dict:
+    with Client((host, port), authkey=authkey()) as conn:
+        conn.send(req)
+        if timeout is not None and not conn.poll(timeout):
+            return {"ok": False, "error": f"no reply within {timeout}s"}
+        return conn.recv()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Warm daemon for the daily pipeline")
+    ap.add_argument("--port", type=int, default=PORT)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("serve")
+    r = sub.add_parser("run")
+    r.add_argument("--from", dest="from_stage", default=None, help="invalidate this stage (and later) before running")
+    t = sub.add_parser("top20")
+    t.add_argument("--date", default=None)
+    sub.add_parser("status")
+    i = sub.add_parser("invalidate")
+    i.add_argument("stage", nargs="?", default="all")
+    sub.add_parser("stop")
+    args = ap.parse_args(argv)
+
+    try:
+        if args.cmd == "serve":
+            return serve(port=args.port)
+    except AuthKeyError as e:
+        print(f"[daemon] {e}")
+        return 2
+    req = {"cmd": args.cmd}
+    if args.cmd == "run":
+        req["from"] = args.from_stage
+    elif args.cmd == "top20":
+        req["date"] = args.date
+    elif args.cmd == "invalidate":
+        req["stage"] = args.stage
+    try:
+        res = request(req, port=args.port)
+    except ConnectionRefusedError:
+        print(f"[daemon] not running on {HOST}:{args.port} (start with: python daemon_runner.py serve)")
+        return 2
+    except AuthKeyError as e:
+        print(f"[daemon] {e}")
+        return 2
+    print(json.dumps(res, ensure_ascii=False, indent=2, default=str))
+    return 0 if res.get("ok") else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
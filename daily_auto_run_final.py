@@ -298,6 +298,9 @@ def fetch_shares_outstanding_official_map(timeout=25):
     return out
 
 
+_SHARES_MEMO = {}  # v6.3.29-F4.8: (path, mtime) -> map；daemon 常駐時免重讀 JSON
+
+
 def load_or_build_shares_map(cache_path: str, max_age_hours: int = 72):
     """Cache issued shares map locally; rebuild if missing/old."""
     try:
@@ -306,10 +309,14 @@ def load_or_build_shares_map(cache_path: str, max_age_hours: int = 72):
             mtime = os.path.getmtime(cache_path)
             age_hours = (time.time() - mtime) / 3600.0
             if age_hours <= max_age_hours:
+                hit = _SHARES_MEMO.get(cache_path)
+                if hit is not None and hit[0] == mtime:
+                    return hit[1]
                 data = load_json_safe(cache_path, default={})
                 # ensure keys are digits
                 data2 = {str(k): int(v) for k, v in data.items() if re.fullmatch(r"\d{4,6}", str(k)) and _parse_int_maybe(v)}
                 if data2:
+                    _SHARES_MEMO[cache_path] = (mtime, data2)
                     return data2
         data = fetch_shares_outstanding_official_map()
         if data:
@@ -322,6 +329,7 @@ def fetch_shares_outstanding_yahoo_safe(yahoo_symbol: str):
     """Return shares outstanding from Yahoo if possible; otherwise None."""
     try:
         import yfinance as yf
+        METRICS.incr("yahoo_info_requests")
         t = yf.Ticker(yahoo_symbol)
         info = getattr(t, "info", None) or {}
         so = info.get("sharesOutstanding") or info.get("shares_outstanding") or None
@@ -331,11 +339,26 @@ def fetch_shares_outstanding_yahoo_safe(yahoo_symbol: str):
         return so if so > 0 else None
     except Exception:
         return None
-import os, re, math, time, json, requests
+import os, re, math, time, json
 import os
-import pandas as pd
-from strategy_score import apply_live_scoring
-from lights_unified import apply_lights, apply_display_overrides
+# v6.3.29-F4.8: heavy deps are imported on first use (fast --help / replay / Top20 regeneration)
+from lazy_imports import lazy_module, LazyObject
+pd = lazy_module("pandas")
+requests = lazy_module("requests")
+_strategy_score = lazy_module("strategy_score")
+_lights_unified = lazy_module("lights_unified")
+
+
+def apply_live_scoring(df):
+    return _strategy_score.apply_live_scoring(df)
+
+
+def apply_lights(df, *args, **kwargs):
+    return _lights_unified.apply_lights(df, *args, **kwargs)
+
+
+def apply_display_overrides(df, *args, **kwargs):
+    return _lights_unified.apply_display_overrides(df, *args, **kwargs)
 
 
 def get_latest_volume_from_prices(df_prices: pd.DataFrame):
@@ -548,6 +571,7 @@ def fetch_shares_outstanding(tickers: list[str], safe_mode: bool = True) -> dict
 
     for t in need:
         try:
+            METRICS.incr("yahoo_info_requests")
             info = yf.Ticker(t).info
             so = info.get("sharesOutstanding") or info.get("shares_outstanding")
             if so:
@@ -572,32 +596,40 @@ def smr_traffic_light(label: str) -> str:
         return "綠"
     return "灰"
 
-import yfinance as yf
 from io import StringIO
 from datetime import datetime, timedelta
-import smtplib
-from email.message import EmailMessage
 
 import logging
 logging.getLogger("yfinance").setLevel(logging.CRITICAL)  # v6.3.1
+yf = lazy_module("yfinance")
 
 
 # -------- runtime logging (v6.2.2) --------
 RUN_TS = datetime.now().strftime("%Y%m%d_%H%M%S")
 LOG_FILE = f"run_{RUN_TS}.log"
+METRICS_FILE = f"run_metrics_{RUN_TS}.json"  # v6.3.29-F4.8: per-stage timing/resource metrics
 INVALID_TICKERS_FILE = f"invalid_tickers_{RUN_TS}.csv"
 INVALID_TICKERS = set()
 NAME_MAP = {}
 STRAT_STATS = {}  # strategy -> dict(annualized_pct, mdd_pct, trades_used)
 
-def log(msg: str) -> None:
-    s = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}"
-    print(s, flush=True)
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(s + "\n")
-    except Exception:
-        pass
+# v6.3.29-F4.8: buffered background logger (one open handle, periodic flush)
+# 第一次 log() 才建立（--help / import 不啟動背景 thread、不產生 run_<ts>.log）
+import atexit
+from lazy_imports import is_loaded
+LOGGER = LazyObject(lambda: __import__("run_logger").RunLogger(LOG_FILE, level=os.environ.get("LOG_LEVEL", "INFO")))
+
+
+def close_logger() -> None:
+    if is_loaded(LOGGER):
+        LOGGER.close()
+
+
+atexit.register(close_logger)
+
+def log(msg: str, level: str = "INFO", **fields) -> None:
+    """level: DEBUG/INFO/WARN/ERROR；fields 例：stage="histories", tickers=60, latency_s=1.2"""
+    LOGGER.log(msg, level=level, **fields)
 # ------------------------------------------
 
 
@@ -653,6 +685,23 @@ RECEIVER_EMAIL = "fish262829@gmail.com"
 # 是否寄送 Email（v6.2.4）
 ENABLE_EMAIL = False  # True=寄信；False=只產出Excel
 
+# v6.3.29-F4.8: 同程序產出 Top20（免再啟動 export_top20.py 重讀 FULL）
+ENABLE_TOP20_INPROC = os.environ.get("TOP20_INPROC", "1").strip() != "0"
+
+# v6.3.29-F4.8: 每日指標特徵庫（Stage2 全部標的，feature_store/<YYYY-MM>.arrow）
+ENABLE_FEATURE_STORE = os.environ.get("FEATURE_STORE", "1").strip() != "0"
+
+# v6.3.29-F4.8: 持倉帳本（Decision 候選 → OPEN；每次執行依歷史價量平倉並回填出場/損益）
+ENABLE_LEDGER = os.environ.get("LEDGER", "1").strip() != "0"
+
+# v6.3.29-F4.8: 無資料 / 下市 ticker 負快取（cache/negative_tickers.json；Stage1 / Stage2 分批前排除）
+ENABLE_NEG_CACHE = os.environ.get("NEG_CACHE", "1").strip() != "0"
+
+# v6.3.29-F4.8: 串流模式——每批下載完成即交給 indicators worker，下一批同時下載；
+# histories 只保留批次陣列（不保留逐檔 DataFrame）。STREAM_QUEUE = 等待計算的批次上限
+ENABLE_STREAM_HISTORIES = os.environ.get("STREAM_HISTORIES", "0").strip() == "1"
+STREAM_QUEUE = int(os.environ.get("STREAM_QUEUE", "2"))
+
 INDEX_TICKER = "0050.TW"
 PERF_SUMMARY_FILE = "performance_summary.xlsx"
 
@@ -716,7 +765,7 @@ COLUMN_MAP_ZH = {
     "otc_short_pressure": "嘎空壓力",
     "weight_mode": "權重模式",
     "weight_source_file": "權重來源檔",
-    "weight_score_raw": (safe_float(safe_get(locals(), "weight_score_raw", 0.0, SAFE_MODE), 0.0, SAFE_MODE) + safe_float(safe_get(locals(), "score_penalty", 0.0, SAFE_MODE), 0.0, SAFE_MODE)),
+    "weight_score_raw": 0.0,  # legacy: safe_get(locals(), ...) at module scope always evaluated to 0.0 (kept for identical FULL columns)
     "weight_raw": "平滑前權重",
     "weight_prev": "上一期權重",
     "weight_used": "使用權重",
@@ -753,12 +802,22 @@ STRATEGY_DESC_ZH = {
 # =======================================
 
 
-SESSION = requests.Session()
-
 # v6.3.21.0: meta for margin/short ratio availability
 MARGIN_RATIO_META = {}  # (symbol, market)->status
 
-SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+# v6.3.29-F4.8: run metrics (SESSION HTTP count / bytes via hook; yf.download batches metered per frame)
+from run_metrics import RunMetrics, frame_nbytes, requests_counter_hook
+METRICS = RunMetrics(RUN_TS, "daily_auto_run_final")
+
+
+def _build_session():
+    s = requests.Session()
+    s.headers.update({"User-Agent": "Mozilla/5.0"})
+    s.hooks["response"].append(requests_counter_hook(METRICS))
+    return s
+
+
+SESSION = LazyObject(_build_session)  # created on first HTTP call
 
 
 def _fetch_isin_universe(str_mode: int) -> pd.DataFrame:
@@ -926,34 +985,49 @@ def fetch_twse_short_margin_ratio(latest_dt: datetime, max_lookback_days: int =
     return pd.DataFrame(columns=["symbol", "short_margin_ratio"])
 
 
-def _cache_path_for_ticker(ticker: str) -> str:
-    safe = ticker.replace("^", "IDX_")
-    return os.path.join(CACHE_DIR, f"{safe}.pkl")
+_HISTORY_STORE = None
 
-def _cache_is_fresh(path: str) -> bool:
-    try:
-        mtime = datetime.fromtimestamp(os.path.getmtime(path))
-        return (datetime.now() - mtime).days <= CACHE_TTL_DAYS
-    except Exception:
-        return False
-
-def load_cached_history(ticker: str):
-    path = _cache_path_for_ticker(ticker)
-    if os.path.exists(path) and _cache_is_fresh(path):
-        try:
-            return pd.read_pickle(path)
-        except Exception:
-            return None
-    return None
+def _history_store():
+    """v6.3.29-F4.8: 批次歷史庫（cache_yf/batches）；daemon 內跨 run 共用已載入的批次檔。"""
+    global _HISTORY_STORE
+    from history_ingest import HistoryStore
+    if _HISTORY_STORE is None or _HISTORY_STORE.cache_dir != CACHE_DIR:
+        _HISTORY_STORE = HistoryStore(CACHE_DIR)
+    return _HISTORY_STORE
 
-def save_cached_history(ticker: str, df: pd.DataFrame) -> None:
-    os.makedirs(CACHE_DIR, exist_ok=True)
-    ratio_map = {}
+def _negative_cache():
+    """v6.3.29-F4.8: 負快取（ENABLE_NEG_CACHE=False 時為 None）；每個 stage 讀一次、結束時寫回。"""
+    if not ENABLE_NEG_CACHE:
+        return None
     try:
-        df.to_pickle(_cache_path_for_ticker(ticker))
-    except Exception:
-        pass
+        from negative_cache import NegativeCache
+        return NegativeCache()
+    except Exception as e:
+        log("negative cache unavailable: " + repr(e), level="WARN")
+        return None
 
+def _skip_negative(neg, tickers: list[str], stage: str) -> list[str]:
+    """負快取內尚未到重新探測日的 ticker 不進批次（仍列入 INVALID_TICKERS）。"""
+    if neg is None:
+        return tickers
+    keep, skip = neg.split(tickers)
+    if skip:
+        INVALID_TICKERS.update(skip)
+        log(f"negative cache: skipped {len(skip)} known-empty tickers", stage=stage, skipped=len(skip))
+    return keep
+
+def _record_negative(neg, b, stage: str, bi: int) -> None:
+    if neg is None:
+        return
+    failed = b.invalid_tickers()
+    if not neg.record_batch(failed, b.tickers[b.has_data].tolist()):
+        log(f"negative cache: batch {bi} mostly empty ({len(failed)}/{len(b.tickers)}); failures not recorded",
+            level="WARN", stage=stage, batch=bi)
+
+def _history_cache():
+    """v6.3.29-F4.8: 新鮮度 / 容量上限 / LRU 淘汰 / 命中統計（history_cache.py）；每次下載一個實例。"""
+    from history_cache import HistoryCache
+    return HistoryCache(CACHE_DIR, ttl_days=CACHE_TTL_DAYS, store=_history_store(), incr=METRICS.incr)
 
 def yf_download_with_retry(tickers: list[str], period: str) -> pd.DataFrame:
     """
@@ -962,7 +1036,9 @@ def yf_download_with_retry(tickers: list[str], period: str) -> pd.DataFrame:
     last_err = None
     for attempt in range(1, YF_MAX_RETRY + 1):
         try:
-            return yf.download(
+            METRICS.incr("yahoo_batches")
+            METRICS.incr("yahoo_tickers_requested", len(tickers))
+            df = yf.download(
                 " ".join(tickers),
                 period=period,
                 group_by="ticker",
@@ -970,12 +1046,15 @@ def yf_download_with_retry(tickers: list[str], period: str) -> pd.DataFrame:
                 auto_adjust=False,
                 progress=False,
             )
+            METRICS.incr("yahoo_frame_bytes", frame_nbytes(df))
+            return df
         except Exception as e:
             msg = str(e)
             last_err = e
             if ("Too Many Requests" in msg) or ("Rate limited" in msg) or ("YFRateLimitError" in msg):
+                METRICS.incr("yahoo_rate_limited")
                 sleep_s = YF_BACKOFF_BASE * attempt
-                log(f"yfinance rate limited. retry {attempt}/{YF_MAX_RETRY} sleep {sleep_s:.1f}s")
+                log(f"yfinance rate limited. retry {attempt}/{YF_MAX_RETRY} sleep {sleep_s:.1f}s", level="WARN", tickers=len(tickers))
                 time.sleep(sleep_s)
                 continue
             raise
@@ -1594,31 +1673,35 @@ def prefilter_by_liquidity(tickers: list[str]) -> list[str]:
     """
     if not ENABLE_TWO_STAGE_SCREEN:
         return tickers
+    from history_ingest import from_download
+
     log(f"Stage1 prefilter: period={STAGE1_PERIOD}, universe={len(tickers)}")
+    neg = _negative_cache()
     vol_map = {}  # ticker -> avg_volume
-    for bi, batch in enumerate(batched(tickers, BATCH_SIZE), start=1):
-        log(f"Stage1 batch {bi}: {len(batch)} tickers")
+    for bi, batch in enumerate(batched(_skip_negative(neg, tickers, "prefilter"), BATCH_SIZE), start=1):
+        log(f"Stage1 batch {bi}: {len(batch)} tickers", stage="prefilter", batch=bi, tickers=len(batch))
+        _t0 = time.perf_counter()
         try:
             data = yf_download_with_retry(batch, STAGE1_PERIOD)
         except Exception as e:
-            log(f"Stage1 batch download failed: {repr(e)}")
+            log(f"Stage1 batch download failed: {repr(e)}", level="WARN", stage="prefilter", batch=bi)
             continue
+        log(f"Stage1 batch {bi} downloaded", level="DEBUG", stage="prefilter", batch=bi, latency_s=time.perf_counter() - _t0)
 
-        for t in batch:
-            try:
-                if isinstance(data.columns, pd.MultiIndex):
-                    df = data[t].dropna(how="all")
-                else:
-                    df = data.dropna(how="all")
-                if df is None or df.empty or "Volume" not in df.columns:
-                    INVALID_TICKERS.add(t)
-                    continue
-                av = float(df["Volume"].tail(5).mean())
-                if av > 0:
-                    vol_map[t] = av
-            except Exception:
-                continue
+        # v6.3.29-F4.8: 整批一次轉陣列，五日均量向量化（不逐檔切 DataFrame）
+        try:
+            b = from_download(data, batch)
+        except Exception as e:
+            log(f"Stage1 batch ingest failed: {repr(e)}", level="WARN", stage="prefilter", batch=bi)
+            continue
+        INVALID_TICKERS.update(b.invalid_tickers() if "Volume" in b.fields else [str(t) for t in b.tickers[b.present]])
+        _record_negative(neg, b, "prefilter", bi)
+        av = b.tail_mean("Volume", 5)
+        ok = av > 0
+        vol_map.update(zip(b.tickers[ok].tolist(), av[ok].tolist()))
         time.sleep(SLEEP_BETWEEN_YF_BATCH)
+    if neg is not None:
+        neg.save()
 
     if not vol_map:
         log("Stage1 prefilter got no data; fallback to full universe.")
@@ -1631,38 +1714,75 @@ def prefilter_by_liquidity(tickers: list[str]) -> list[str]:
     log(f"Stage1 selected for Stage2: {len(sel)} tickers (min_vol={MIN_AVG_VOLUME}, topN={TOPN_LIQUID})")
     return sel if sel else tickers
 
-def download_histories(tickers: list[str], period: str = "6mo") -> dict[str, pd.DataFrame]:
-    out, missing = {}, []
+def download_histories(tickers: list[str], period: str = "6mo", use_cache: bool = True,
+                       on_batch=None) -> dict[str, pd.DataFrame]:
+    """
+    use_cache=False：全部重新下載並覆寫快取（prefetch_overnight 收盤後使用）。
+    v6.3.29-F4.8: 每批下載結果由 history_ingest 一次轉成陣列、一次寫入批次庫（cache_yf/batches），
+    回傳 HistoryMap（{ticker: DataFrame}，DataFrame 取用時才切出）；舊版 <ticker>.pkl 仍可讀。
+    快取新鮮度 / 淘汰 / 統計由 history_cache.HistoryCache 負責（結束時寫入 run log）。
+    on_batch(part)：快取命中的部分與每個下載批次就緒即呼叫（串流模式）；此時回傳的 map 不保留 DataFrame。
+    """
+    from history_ingest import HistoryMap, from_download
+
+    cache = _history_cache()
+    store = cache.store
+    stream = on_batch is not None
+    out, cached, missing = HistoryMap(memo=not stream), HistoryMap(memo=False), []
     for t in tickers:
-        smr = None  # v6.3.18.4: default init
-        risk_note_extra = ""
-        c = load_cached_history(t)
-        if c is not None and not c.empty:
-            out[t] = c
+        hit = cache.lookup(t) if use_cache else None
+        if isinstance(hit, tuple):
+            out.add_batch(hit[0], [t])
+            cached.add_batch(hit[0], [t])
+        elif hit is not None and not hit.empty:
+            out.add_frame(t, hit)
+            cached.add_frame(t, hit)
         else:
             missing.append(t)
+    if stream and len(cached):
+        on_batch(cached)
+    neg = _negative_cache()
+    missing = _skip_negative(neg, missing, "histories")
     for bi, batch in enumerate(batched(missing, BATCH_SIZE), start=1):
-        log(f"Downloading batch {bi}: {len(batch)} tickers")
+        log(f"Downloading batch {bi}: {len(batch)} tickers", stage="histories", batch=bi, tickers=len(batch))
         if not batch:
             continue
+        _t0 = time.perf_counter()
         try:
             data = yf_download_with_retry(batch, period)
-        except Exception:
+        except Exception as e:
+            log(f"Stage2 batch download failed: {repr(e)}", level="WARN", stage="histories", batch=bi)
             continue
-        for t in batch:
-            try:
-                df = data[t].dropna(how="all") if isinstance(data.columns, pd.MultiIndex) else data.dropna(how="all")
-                if df is not None and not df.empty:
-                    out[t] = df
-                    save_cached_history(t, df)
-                else:
-                    INVALID_TICKERS.add(t)
-            except Exception:
-                continue
+        log(f"Stage2 batch {bi} downloaded", level="DEBUG", stage="histories", batch=bi, latency_s=time.perf_counter() - _t0)
+        try:
+            b = from_download(data, batch)
+        except Exception as e:
+            log(f"Stage2 batch ingest failed: {repr(e)}", level="WARN", stage="histories", batch=bi)
+            continue
+        INVALID_TICKERS.update(b.invalid_tickers())
+        _record_negative(neg, b, "histories", bi)
+        out.add_batch(b)
+        if stream:
+            part = HistoryMap(memo=False)
+            part.add_batch(b)
+            on_batch(part)
+        try:
+            store.write(b)
+        except Exception as e:
+            log(f"history store write failed: {repr(e)}", level="WARN", stage="histories", batch=bi)
         time.sleep(SLEEP_BETWEEN_YF_BATCH)
+    if neg is not None:
+        neg.save()
+    try:
+        cache.touch()
+        cache.evict(log=log)
+    except Exception as e:
+        log(f"history cache maintenance failed: {repr(e)}", level="WARN", stage="histories")
+    c = cache.counters
+    log(cache.summary(), stage="histories", cache_hits=c["hits"], cache_misses=c["misses"],
+        cache_stale=c["stale"], cache_evicted=c["evicted"])
     return out
 
-
 def compute_indicators(hist: pd.DataFrame):
     if hist is None or hist.empty or len(hist) < 60:
         return None
@@ -1739,20 +1859,13 @@ def tag_strategy_complete(market: str, ind: dict, short_margin_ratio: float | No
 
 
 def _load_prev_weights():
-    if not os.path.exists(WEIGHT_STATE_FILE):
-        return None
-    try:
-        with open(WEIGHT_STATE_FILE, "r", encoding="utf-8") as f:
-            return (json.load(f) or {}).get("weights", None)
-    except Exception:
-        return None
+    from strategy_weights import load_state
+    return load_state(WEIGHT_STATE_FILE)
 
 def _save_prev_weights(w):
-    try:
-        with open(WEIGHT_STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump({"updated": _today_str(), "weights": w}, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
+    # v6.3.29-F4.8: 權重未變時不重寫 state
+    from strategy_weights import save_state
+    save_state(WEIGHT_STATE_FILE, w, _today_str())
 
 def _cap_and_renorm(w):
     w2 = {k: min(float(v), MAX_STRATEGY_WEIGHT) for k, v in w.items()}
@@ -1760,54 +1873,36 @@ def _cap_and_renorm(w):
     return {k: v / s for k, v in w2.items()} if s > 0 else w2
 
 def load_weight_inputs_from_summary(path: str):
-    if not os.path.exists(path):
-        return None
-    try:
-        df = pd.read_excel(path, sheet_name="ByStrategy")
-    except Exception:
-        return None
-    if "strategy" not in [c.lower() for c in df.columns]:
-        return None
-    strategy_col = next(c for c in df.columns if c.lower() == "strategy")
-    ann_col = next((c for c in df.columns if c.lower().startswith("annualized")), None)
-    mdd_col = next((c for c in df.columns if c.lower().startswith("mdd")), None)
-    trades_col = next((c for c in df.columns if c.lower().startswith("trades")), None)
-    if ann_col is None or mdd_col is None:
-        return None
-    cols = [strategy_col, ann_col, mdd_col] + ([trades_col] if trades_col else [])
-    df = df[cols].copy()
-    df.columns = ["strategy", "annualized_pct", "mdd_pct"] + (["trades"] if trades_col else [])
-    df["annualized_pct"] = pd.to_numeric(df["annualized_pct"], errors="coerce")
-    df["mdd_pct"] = pd.to_numeric(df["mdd_pct"], errors="coerce")
-    df["trades"] = pd.to_numeric(df["trades"], errors="coerce") if "trades" in df.columns else pd.NA
-    df = df.dropna(subset=["strategy", "annualized_pct", "mdd_pct"])
-    if df.empty:
-        return None
-    df["score_raw"] = (df["annualized_pct"].clip(lower=0) / df["mdd_pct"].abs().clip(lower=1.0))
-    df["score_raw"] = df["score_raw"].replace([math.inf, -math.inf], pd.NA).fillna(0.0)
-    mask = df["trades"].notna() & (df["trades"] < MIN_TRADES_FOR_WEIGHT)
-    df.loc[mask, "score_raw"] *= (df.loc[mask, "trades"] / MIN_TRADES_FOR_WEIGHT).clip(lower=0, upper=1)
-    out = {}
-    for _, r in df.iterrows():
-        out[str(r["strategy"])] = {
-            "annualized_pct": float(r["annualized_pct"]),
-            "mdd_pct": float(r["mdd_pct"]),
-            "trades": None if pd.isna(r["trades"]) else float(r["trades"]),
-            "score_raw": float(r["score_raw"]),
-        }
-    return out
+    # v6.3.29-F4.8: 解析結果以 mtime/size 快取（cache/weight_inputs.pkl），檔案未變不重讀 Excel
+    from strategy_weights import load_summary_inputs
+    return load_summary_inputs(path, MIN_TRADES_FOR_WEIGHT)
+
+def _backtest_params() -> dict:
+    """backtest_engine 使用與實盤相同的篩選門檻。"""
+    return {
+        "min_avg_volume": MIN_AVG_VOLUME,
+        "th_bias_mean_revert": TH_BIAS_MEAN_REVERT,
+        "th_bias_deep": TH_BIAS_DEEP,
+        "th_squeeze_tw": TH_SQUEEZE_TW,
+        "th_squeeze_otc_proxy": TH_SQUEEZE_OTC_PROXY,
+        "th_support_tol": TH_SUPPORT_TOL,
+        "th_squeeze_vol_ratio": TH_SQUEEZE_VOL_RATIO,
+        "th_squeeze_volratio_vol": TH_SQUEEZE_VOLRATIO_VOL,
+        "th_squeeze_min_bias": TH_SQUEEZE_MIN_BIAS,
+    }
 
 def compute_weights_with_trace(strategies_today: list[str]):
     inputs = load_weight_inputs_from_summary(PERF_SUMMARY_FILE)
     if inputs is None:
         # v6.3.16: 若無 performance_summary（檔案不存在或無 CLOSED trades），仍回填欄位避免整欄空白
-        # 嘗試自動產出 performance_summary.xlsx（若有 CLOSED trades）
+        # v6.3.29-F4.8: 以快取歷史向量化回測自動產出 performance_summary.xlsx
         try:
             if not os.path.exists(PERF_SUMMARY_FILE):
-                import performance_summary as _ps
-                _ps.main()
-        except Exception:
-            pass
+                from backtest_engine import build_performance_summary
+                with METRICS.stage("backtest"):
+                    build_performance_summary(PERF_SUMMARY_FILE, CACHE_DIR, params=_backtest_params(), log=log)
+        except Exception as e:
+            log("backtest summary skipped: " + repr(e))
         # 再讀一次
         inputs2 = load_weight_inputs_from_summary(PERF_SUMMARY_FILE)
         if inputs2 is not None:
@@ -1960,21 +2055,40 @@ def format_excel_sheet(file_path: str, hide_headers: list[str] | None = None) ->
     except Exception as e:
         log("Excel format skipped: " + repr(e))
 
+def write_excel_output(df: pd.DataFrame, file_path: str, hide_headers: list[str] | None = None) -> None:
+    """
+    v6.3.29-F4.8：單次寫出（資料+樣式+燈號/風險條件格式），不再 to_excel 後重開 workbook。
+    缺 xlsxwriter 或寫出失敗時，回退 to_excel + format_excel_sheet。
+    """
+    try:
+        from excel_writer import write_styled_excel
+        if write_styled_excel(df, file_path, hide_headers=hide_headers):
+            return
+    except Exception as e:
+        log("styled Excel write failed, fallback to openpyxl: " + repr(e))
+    df.to_excel(file_path, index=False)
+    format_excel_sheet(file_path, hide_headers=hide_headers)
+
 def send_email_with_attachment(to_email: str, file_path: str, subject: str, body: str) -> None:
-    app_pw = os.environ.get(APP_PASSWORD_ENV, "").strip()
-    if not app_pw:
-        raise RuntimeError(f"Missing Gmail App Password env var: {APP_PASSWORD_ENV}")
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = SENDER_EMAIL
-    msg["To"] = to_email
-    msg.set_content(body)
-    with open(file_path, "rb") as f:
-        data = f.read()
-    msg.add_attachment(data, maintype="application", subtype="vnd.openxmlformats-officedocument.spreadsheetml.sheet", filename=os.path.basename(file_path))
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(SENDER_EMAIL, app_pw)
-        smtp.send_message(msg)
+    """同步寄信（手動補寄用；每日流程改走 queue_email）。SMTP 設定見 notify_outbox.smtp_settings。"""
+    import notify_outbox
+
+    rec = {"to": to_email, "subject": subject, "body": body, "attachments": [file_path]}
+    notify_outbox.send_message(notify_outbox.build_message(rec, SENDER_EMAIL))
+
+
+def queue_email(to_email: str, file_paths: list[str], subject: str, body: str) -> str:
+    """
+    v6.3.29-F4.8: 寄信改為非阻塞——寫入 outbox/pending 後立即返回，
+    OUTBOX_SPAWN_DRAIN=1（預設）時另起背景 drain 負責寄出與重試；流程結束時間不受 SMTP 延遲影響。
+    """
+    import notify_outbox
+
+    mid = notify_outbox.enqueue(to_email, subject, body, file_paths, sender=SENDER_EMAIL)
+    if os.environ.get("OUTBOX_SPAWN_DRAIN", "1").strip() != "0":
+        if not notify_outbox.spawn_drain(sender=SENDER_EMAIL):
+            log("outbox drain spawn failed; run `python notify_outbox.py drain` to send", level="WARN")
+    return mid
 
 
 
@@ -1983,17 +2097,7 @@ def compute_composite_score(df: pd.DataFrame):
     """Compute composite score for ranking (daily + top20 consistent).
     Adds: traded value rank and vol*liquidity interaction penalty.
     """
-    def _rank01(series, higher_better=True):
-        s = pd.to_numeric(series, errors="coerce")
-        # if scalar (float/int), expand to constant series
-        if not hasattr(s, "isna"):
-            s = pd.Series([float(s) if s is not None else float("nan")] * len(df), index=df.index)
-        if s.isna().all():
-            return pd.Series([0.0]*len(df), index=df.index)
-        r = s.rank(pct=True)
-        if not higher_better:
-            r = 1.0 - r
-        return r.fillna(0.0)
+    from strategy_score import grouped_rank01, rank_group_keys
 
     pos_col = next((c for c in ["建議部位","position","target_position","final_position","target_weight","position_weight"] if c in df.columns), None)
     score_col = next((c for c in ["策略分數","strategy_score","score"] if c in df.columns), None)
@@ -2003,26 +2107,23 @@ def compute_composite_score(df: pd.DataFrame):
     vol_col = next((c for c in ["vol_annual","年化波動"] if c in df.columns), None)
     price_col = next((c for c in ["進場價","entry_price","close","Close","收盤價"] if c in df.columns), None)
 
-    w_pos = _rank01(df[pos_col] if pos_col else 0.0, True)
-    w_score = _rank01(df[score_col] if score_col else 0.0, True)
-
+    # v6.3.29-F4.8: 各元件一次 groupby().rank（依市場分組，TWSE/TWO 不混排）
+    zeros = pd.Series([0.0]*len(df), index=df.index)
+    comps = pd.DataFrame({
+        "pos": pd.to_numeric(df[pos_col], errors="coerce") if pos_col else zeros,
+        "score": pd.to_numeric(df[score_col], errors="coerce") if score_col else zeros,
+    }, index=df.index)
     if bias_col:
-        b = pd.to_numeric(df[bias_col], errors="coerce").fillna(0.0).abs()
-        w_bias = _rank01(b, True)
-    else:
-        w_bias = pd.Series([0.0]*len(df), index=df.index)
-
+        comps["bias"] = pd.to_numeric(df[bias_col], errors="coerce").fillna(0.0).abs()
     if turn_col:
-        tr = pd.to_numeric(df[turn_col], errors="coerce").fillna(0.0)
-        w_turn = _rank01(tr, True)
-    else:
-        w_turn = pd.Series([0.0]*len(df), index=df.index)
-
+        comps["turn"] = pd.to_numeric(df[turn_col], errors="coerce").fillna(0.0)
     if tv_col:
-        tv = pd.to_numeric(df[tv_col], errors="coerce").fillna(0.0)
-        w_tv = _rank01(tv, True)
-    else:
-        w_tv = pd.Series([0.0]*len(df), index=df.index)
+        comps["tv"] = pd.to_numeric(df[tv_col], errors="coerce").fillna(0.0)
+    ranks = grouped_rank01(comps, rank_group_keys(df))
+    w_pos, w_score = ranks["pos"], ranks["score"]
+    w_bias = ranks["bias"] if bias_col else zeros
+    w_turn = ranks["turn"] if turn_col else zeros
+    w_tv = ranks["tv"] if tv_col else zeros
 
     prices = pd.to_numeric(df[price_col], errors="coerce") if price_col else pd.Series([float("nan")]*len(df), index=df.index)
     tvv = pd.to_numeric(df[tv_col], errors="coerce") if tv_col else pd.Series([float("nan")]*len(df), index=df.index)
@@ -2130,17 +2231,14 @@ def fetch_official_daily_volume_map(trade_date):
 
 
 # --- Yahoo volume fallback (candidate-only) ---
-try:
-    import yfinance as yf
-except Exception:
-    yf = None
 
 
 def fetch_yahoo_volume_map(tickers, trade_date, chunk_size=80, pause_sec=1.0):
     """Fetch volume for tickers from Yahoo (yfinance). Returns dict: ticker -> volume(int).
     Only for a limited candidate list to reduce rate limits.
     """
-    if yf is None:
+    import importlib.util
+    if importlib.util.find_spec("yfinance") is None:  # yf 是 lazy proxy：未安裝時不觸發 import
         return {}
 
     tset = [t for t in list(dict.fromkeys(tickers)) if isinstance(t, str) and t.strip()]
@@ -2154,6 +2252,8 @@ def fetch_yahoo_volume_map(tickers, trade_date, chunk_size=80, pause_sec=1.0):
     for i in range(0, len(tset), chunk_size):
         chunk = tset[i:i+chunk_size]
         try:
+            METRICS.incr("yahoo_batches")
+            METRICS.incr("yahoo_tickers_requested", len(chunk))
             df = yf.download(
                 tickers=" ".join(chunk),
                 start=start,
@@ -2163,6 +2263,7 @@ def fetch_yahoo_volume_map(tickers, trade_date, chunk_size=80, pause_sec=1.0):
                 threads=False,
                 progress=False,
             )
+            METRICS.incr("yahoo_frame_bytes", frame_nbytes(df))
             if df is None or len(df) == 0:
                 time.sleep(pause_sec)
                 continue
@@ -2202,17 +2303,12 @@ def fetch_yahoo_volume_map(tickers, trade_date, chunk_size=80, pause_sec=1.0):
 
     return vol_map
 
-def main():
-    global decision_path, full_path, today, market_regime
-    df_view_dec = pd.DataFrame()  # init to avoid UnboundLocalError
-    now = _dt.datetime.now()
-    today_date = now.date()
-    today = _dt.date.today()
-    log('=== daily_auto_run_final start ===')
-    log(f'cwd={os.getcwd()}')
-    os.makedirs(LOCAL_EXCEL_FOLDER, exist_ok=True)
-    os.makedirs(CACHE_DIR, exist_ok=True)
+# ===== v6.3.29-F4.8: staged pipeline (resumable) =====
+CHECKPOINT_DIR = "checkpoints"
+
 
+def _stage_universe() -> dict:
+    """Stage universe: 上市/上櫃股票池 + 中文名稱 + Yahoo tickers."""
     uni = pd.concat([fetch_listed_stocks(), fetch_otc_stocks()], ignore_index=True)
 
     # v6.3.1: 清理股票池（只保留 4 碼普通股）
@@ -2238,13 +2334,6 @@ def main():
     except Exception as e:
         uni['name_zh'] = ''
         log('Name enrichment skipped: ' + repr(e))
-        # v6.3.20: load ratio_map once per run (券資比 T+1 backtrack)
-        try:
-            ratio_map = fetch_margin_short_ratio_map(today, lookback_days=30)
-            log(f"ratio_map size (T+1): {len(ratio_map)}")
-        except Exception as _e:
-            ratio_map = {}
-            log("ratio_map load failed: " + repr(_e))
 
 
     # v6.3.11: post-enrichment safeguard (即使前段 try/except 失敗也強制補上 name_zh)
@@ -2263,13 +2352,6 @@ def main():
             uni["name_zh"] = ""
             log("Name enrichment (safeguard) failed: " + repr(_e))
 
-    # v6.3.20.11: legacy TWSE CSV ratio_map overwrite removed (keeps tuple-key ratio_map)
-    log("legacy TWSE CSV ratio_map overwrite disabled")
-
-    log(f"ratio_map size (TWSE keys): {sum(1 for k in ratio_map.keys() if isinstance(k, tuple) and len(k)==2 and k[1]=='TWSE')}")
-    idx_hist = yf.Ticker(INDEX_TICKER).history(period="6mo")
-    market_regime = calc_market_regime(idx_hist)
-
     tickers, meta = [], {}
     for _, r in uni.iterrows():
         sym, market = str(r["symbol"]), r["market"]
@@ -2277,20 +2359,148 @@ def main():
         tickers.append(t)
         meta[t] = (sym, market, str(r.get("name_zh","")))
 
+    return {"uni": uni, "tickers": tickers, "meta": meta, "name_map": dict(NAME_MAP)}
+
+
+def _stage_margin(signal_date) -> dict:
+    """Stage margin: 券資比 (T+1) ratio_map + MARGIN_RATIO_META."""
+    # v6.3.20: load ratio_map once per run (券資比 T+1 backtrack)
+    try:
+        ratio_map = fetch_margin_short_ratio_map(signal_date, lookback_days=30)
+        log(f"ratio_map size (T+1): {len(ratio_map)}")
+    except Exception as _e:
+        ratio_map = {}
+        log("ratio_map load failed: " + repr(_e))
+
+    # v6.3.20.11: legacy TWSE CSV ratio_map overwrite removed (keeps tuple-key ratio_map)
+    log("legacy TWSE CSV ratio_map overwrite disabled")
+
+    log(f"ratio_map size (TWSE keys): {sum(1 for k in ratio_map.keys() if isinstance(k, tuple) and len(k)==2 and k[1]=='TWSE')}")
+    return {"ratio_map": ratio_map, "margin_meta": dict(MARGIN_RATIO_META)}
+
+
+def _stage_prefilter(tickers: list[str]) -> dict:
+    """Stage prefilter: Stage1 流動性快篩."""
     tickers2 = prefilter_by_liquidity(tickers)
+    return {"tickers2": tickers2, "invalid_tickers": set(INVALID_TICKERS)}
+
 
+class IndicatorWorker:
+    """
+    v6.3.29-F4.8: 串流模式的 indicators worker（背景執行緒）。
+    download_histories 每交來一批即計算 compute_indicators，網路等待與計算重疊；
+    佇列上限 STREAM_QUEUE 批，計算跟不上時下載端暫停（記憶體有上限）。只保留 ind_map。
+    """
 
-    latest_volume_map = {}  # yahoo_symbol -> latest volume
-    histories = download_histories(tickers2, period=STAGE2_PERIOD)
+    def __init__(self, maxsize: int = STREAM_QUEUE):
+        import queue
+        import threading
+
+        self.q = queue.Queue(maxsize=max(int(maxsize), 1))
+        self.ind_map = None
+        self.error = None
+        self.busy_s = 0.0
+        self._thread = threading.Thread(target=self._loop, name="indicators", daemon=True)
+
+    def start(self) -> None:
+        self.ind_map = {}
+        self._thread.start()
+
+    def submit(self, part) -> None:
+        self.q.put(part)
+
+    def _loop(self) -> None:
+        while True:
+            part = self.q.get()
+            if part is None:
+                return
+            if self.error is not None:
+                continue
+            t0 = time.perf_counter()
+            try:
+                for t in part:
+                    self.ind_map[t] = compute_indicators(part[t])
+            except Exception as e:
+                self.error = e
+            self.busy_s += time.perf_counter() - t0
 
-    rows = []
+    def finish(self) -> dict:
+        self.q.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.ind_map
+
+
+def _stage_histories(tickers2: list[str], worker: IndicatorWorker | None = None) -> dict:
+    """Stage histories: 大盤 regime + Stage2 歷史價量（worker：串流模式，同時計算 indicators）."""
+    METRICS.incr("yahoo_tickers_requested")
+    idx_hist = yf.Ticker(INDEX_TICKER).history(period="6mo")
+    METRICS.incr("yahoo_frame_bytes", frame_nbytes(idx_hist))
+    regime = calc_market_regime(idx_hist)
+    if worker is None:
+        histories = download_histories(tickers2, period=STAGE2_PERIOD)
+    else:
+        worker.start()
+        try:
+            histories = download_histories(tickers2, period=STAGE2_PERIOD, on_batch=worker.submit)
+        finally:
+            t0 = time.perf_counter()
+            worker.finish()
+            log(f"streaming indicators: {len(worker.ind_map)} tickers, worker busy {worker.busy_s:.1f}s, "
+                f"waited {time.perf_counter() - t0:.1f}s after last batch", stage="histories")
+    return {"histories": histories, "market_regime": regime, "invalid_tickers": set(INVALID_TICKERS)}
+
+
+def _stage_ledger(histories: dict) -> dict:
+    """Stage ledger: OPEN 部位 mark-to-market（停損 / 持有期滿出場）；CLOSED 足量時改寫 performance_summary."""
+    if not ENABLE_LEDGER:
+        return {"ledger": None}
+    from position_ledger import mark_to_market, write_performance_summary
+    res = mark_to_market(histories, cache_dir=CACHE_DIR, log=log)
+    res["summary_written"] = write_performance_summary(PERF_SUMMARY_FILE, log=log)
+    return {"ledger": res}
+
+
+def _store_features(histories: dict, meta: dict, ratio_map: dict, df_view: pd.DataFrame | None = None) -> None:
+    """Stage2 全部標的指標寫入特徵庫；券資比取自 ratio_map，候選另附周轉率 / 綜合分數 / 策略代碼."""
+    if not ENABLE_FEATURE_STORE or not histories:
+        return
+    try:
+        from feature_store import update
+        smr = [(t, ratio_map.get((str(meta[t][0]).strip(), normalize_market_code(meta[t][1])), None))
+               for t in histories if t in meta]
+        extras = pd.DataFrame(smr, columns=["ticker", "short_margin_ratio(%)"])
+        if df_view is not None and "ticker" in df_view.columns:
+            cand = df_view[[c for c in ("ticker", "turnover_rate(%)", "綜合分數", "strategy") if c in df_view.columns]]
+            extras = extras.merge(cand.drop_duplicates("ticker"), on="ticker", how="left")
+        with METRICS.stage("features", rows_in=len(histories)):
+            update(histories, extras=extras, log=log)
+    except Exception as e:
+        log("feature store update failed: " + repr(e))
+
+
+def _stage_indicators(histories: dict, streamed: dict | None = None) -> dict:
+    """Stage indicators: 每檔 compute_indicators（None 表示資料不足/流動性不足）；streamed：串流模式已算好的結果."""
+    if streamed is not None:
+        log(f"indicators computed while downloading: {sum(1 for v in streamed.values() if v is not None)} / {len(streamed)}")
+        return {"ind_map": streamed}
+    ind_map = {}
     for t, hist in histories.items():
+        ind_map[t] = compute_indicators(hist)
+    log(f"indicators computed: {sum(1 for v in ind_map.values() if v is not None)} / {len(ind_map)}")
+    return {"ind_map": ind_map}
+
+
+def _stage_rules(ind_map: dict, meta: dict, ratio_map: dict, now) -> dict:
+    """Stage rules: 策略標記 + 券資比風險規則 → 候選列."""
+    rows = []
+    for t, ind in ind_map.items():
         sym, market, name_zh = meta.get(t, ("", "", ""))
         if not name_zh:
             name_zh = NAME_MAP.get((str(sym).strip(), str(market).strip()), "")
         if not sym:
             continue
-        ind = compute_indicators(hist)
         if ind is None:
             continue
         smr = ratio_map.get((str(sym).strip(), normalize_market_code(market)), None)
@@ -2395,35 +2605,55 @@ def main():
             "hold_days": None,
         })
 
-    if not rows:
-        log('No candidates found today.')
-        flush_invalid_tickers()
-        return
+    return {"df": pd.DataFrame(rows) if rows else None}
+
 
-    df = pd.DataFrame(rows)
+def _stage_weights(df: pd.DataFrame) -> dict:
+    """Stage weights: 動態權重 + weight_* 追溯欄位."""
+    df = df.copy()
     strategies_today = sorted(df["strategy"].unique().tolist())
     wmap, trace, mode = compute_weights_with_trace(strategies_today)
 
     df["weight_used"] = df["strategy"].map(wmap)
     df["strategy_weight"] = df["weight_used"]
 
-    def tget(s, k):
-        return (trace.get(s, {}) or {}).get(k)
+    # v6.3.29-F4.8: trace 每策略一列，一次對齊到候選表（取代逐欄 apply）
+    from strategy_weights import broadcast_trace
+    broadcast_trace(df, trace, ["weight_mode","weight_source_file","weight_score_raw","weight_raw","weight_prev","weight_alpha","trades_used","annualized_pct","mdd_pct"])
 
-    for col in ["weight_mode","weight_source_file","weight_score_raw","weight_raw","weight_prev","weight_alpha","trades_used","annualized_pct","mdd_pct"]:
-        df[col] = df["strategy"].apply(lambda s: tget(s, col))
+    return {"df": df, "mode": mode}
 
-    df["position_size"] = df.apply(lambda x: round(calc_position_size(TOTAL_CAPITAL, float(x["weight_used"]), float(x["atr20"]), float(x["close"]), market_regime), 0), axis=1)
-    df["Risk Alert"] = df["position_size"].apply(lambda p: "HIGH RISK" if p / TOTAL_CAPITAL > TH_HIGH_RISK_POS else "")
 
-    today = _today_str()
-    out_path = os.path.join(LOCAL_EXCEL_FOLDER, f"{today}_stock_selection.xlsx")
+def _stage_sizing(df: pd.DataFrame, regime: str) -> dict:
+    """Stage sizing: 建議部位 + HIGH RISK 標記（scoring stage 資金配置後依最終部位重算）."""
+    # v6.3.29-F4.8: 向量化（同 calc_position_size 公式）；資金預算配置在 scoring stage（需綜合分數）
+    from position_sizing import size_positions
+    df = df.copy()
+    market_regime = regime
+    df["position_size"] = size_positions(
+        pd.to_numeric(df["atr20"], errors="coerce"), pd.to_numeric(df["close"], errors="coerce"),
+        pd.to_numeric(df["weight_used"], errors="coerce"), TOTAL_CAPITAL, MAX_ACCOUNT_RISK,
+        PER_TRADE_RISK_RATIO, REGIME_RISK_MULTIPLIER.get(market_regime, 1.0))
+    df["Risk Alert"] = (df["position_size"] / TOTAL_CAPITAL > TH_HIGH_RISK_POS).map({True: "HIGH RISK", False: ""})
+
+    return {"df": df}
+
+
+def _stage_scoring(df: pd.DataFrame) -> dict:
+    """Stage scoring: 即時評分/燈號 + 周轉率 + 流動性/波動控倉 + 顯示欄位補齊."""
+    trade_date = None
     df_view = df.sort_values(["strategy","market","symbol"]).copy()
     # === Live scoring + lights (一致) ===
     try:
         df_view = apply_live_scoring(df_view)
     except Exception as _e:
         log("apply_live_scoring skipped (error): " + repr(_e))
+    # v6.3.29-F4.8: 投組層級資金配置（總資金 / 策略 / 市場預算，POS_ALLOC_MODE）
+    try:
+        from position_sizing import allocate_frame
+        df_view = allocate_frame(df_view, TOTAL_CAPITAL, log=log, high_risk_pos=TH_HIGH_RISK_POS)
+    except Exception as _e:
+        log("position allocation skipped (error): " + repr(_e))
         # ===== Liquidity + Volatility risk block (v6.3.24) =====
     # ---- turnover_rate(%) compute (v6.3.24.3) ----
     try:
@@ -2542,6 +2772,13 @@ def main():
     df_view["stop_loss_price"] = sl.fillna(pd.to_numeric(df_view.get("support_1m"), errors="coerce")).fillna((ep * 0.95).round(2))
 
 
+    return {"df_view": df_view, "trade_date": trade_date}
+
+
+def _stage_export(df_view: pd.DataFrame, today: str, trade_date, mode: str, regime: str) -> dict:
+    """Stage export: FULL / Decision / sidecar / Top20 / Email."""
+    market_regime = regime
+    out_path = os.path.join(LOCAL_EXCEL_FOLDER, f"{today}_stock_selection.xlsx")
     # ===== Full 版輸出（隱藏 Yahoo代碼欄）=====
     # ensure all columns exist for full (v6.3.13)
     for k in COLUMN_MAP_ZH.keys():
@@ -2627,7 +2864,10 @@ def main():
             _tv = pd.to_numeric(df_full["成交值(元)"], errors="coerce")
             # If some are missing, leave blank; rank on available
             if _tv.notna().any():
-                _rank = _tv.rank(ascending=False, method="min")
+                # v6.3.29-F4.8: per-market rank (TWSE / TWO never mixed)
+                from strategy_score import rank_group_keys
+                _keys = rank_group_keys(df_full)
+                _rank = _tv.rank(ascending=False, method="min") if _keys is None else _tv.groupby(_keys.values).rank(ascending=False, method="min")
                 # store as integer-like (no decimals)
                 df_full["成交值排名"] = _rank.round(0).astype("Int64").astype("object")
                 df_full.loc[_tv.isna(), "成交值排名"] = ""
@@ -2671,6 +2911,10 @@ def main():
     except Exception:
         pass
 
+    # v6.3.29-F4.8: Top20 需要但 FULL 版面沒有的欄位（綜合分數 / 成交值(元) …）只寫進 FULL sidecar；
+    # 同程序 Top20 與 export_top20.py 都從同一份 sidecar 取輸入
+    _top20_extra = df_full[[c for c in TOP20_COL_ORDER_ZH if c in df_full.columns and c not in FULL_COL_ORDER_ZH]]
+
         # fixed FULL column order
     for _c in FULL_COL_ORDER_ZH:
         if _c not in df_full.columns:
@@ -2680,10 +2924,12 @@ def main():
     df_full = apply_lights(df_full)
 
     df_full_export = apply_display_overrides(df_full)
-    full_path = out_path
+    df_full_sidecar = df_full_export.copy()
+    for _c in _top20_extra.columns:
+        if _c not in df_full_sidecar.columns:
+            df_full_sidecar[_c] = _top20_extra[_c].to_numpy()
 
-    df_full_export.to_excel(out_path, index=False)
-    format_excel_sheet(out_path, hide_headers=["股票代號","市場"])
+    write_excel_output(df_full_export, out_path, hide_headers=["股票代號","市場"])
 
     # ===== 盤前決策版輸出（10欄，隱藏 Yahoo代碼欄）=====
     df_view_dec = df_view.copy()
@@ -2763,41 +3009,170 @@ def main():
 
     df_decision = df_decision.reindex(columns=DECISION_COLS_FIXED)
 
-    df_decision.to_excel(out_path_decision, index=False)
-    format_excel_sheet(out_path_decision, hide_headers=["股票代號","市場"])
+    write_excel_output(df_decision, out_path_decision, hide_headers=["股票代號","市場"])
     log(f"Saved decision: {out_path_decision}")
-try:
-    postprocess_excel(decision_path)
-except Exception:
-    pass
+
+    # v6.3.29-F4.8: typed Arrow sidecar + manifest (下游免 read_excel)
+    sc = None
+    try:
+        from sidecar_io import write_sidecars
+        sc = write_sidecars(LOCAL_EXCEL_FOLDER, today, {
+            "FULL": (df_full_sidecar, out_path),
+            "DECISION": (df_decision, out_path_decision),
+        })
+        log(f"Sidecars written: {sorted(sc.keys()) if sc else 'skipped (pyarrow unavailable)'}")
+    except Exception as e:
+        log("sidecar write failed: " + repr(e))
+
+    # v6.3.29-F4.8: Decision 候選（建議部位 > 0）寫入持倉帳本
+    if ENABLE_LEDGER:
+        try:
+            from position_ledger import ingest
+            log(f"Ledger: {ingest(df_view)} new OPEN position(s)")
+        except Exception as e:
+            log("ledger ingest failed: " + repr(e))
+
+    warehouse_tables = {"FULL": (df_full_sidecar, out_path), "DECISION": (df_decision, out_path_decision)}
+
+    # v6.3.29-F4.8: Top20 in-process（免啟動 export_top20.py）；輸入與單獨執行完全相同：
+    # 有 FULL sidecar 就讀 sidecar，否則用寫進 FULL xlsx 的同一份表
+    if ENABLE_TOP20_INPROC:
+        try:
+            from export_top20 import export_top20, top20_out_path
+            df_top_src = None
+            if sc and "FULL" in sc:
+                from sidecar_io import load_sidecar
+                df_top_src = load_sidecar(LOCAL_EXCEL_FOLDER, today, "FULL")
+            if df_top_src is None:
+                df_top_src = df_full_export
+            out_path_top20 = top20_out_path(LOCAL_EXCEL_FOLDER, today)
+            with METRICS.stage("top20", rows_in=len(df_top_src)):
+                top20 = export_top20(df_top_src, out_path_top20, log=log)
+                METRICS.set_rows(rows_out=len(top20))
+            log(f"Saved Top20 (in-process): {out_path_top20} (n={len(top20)})")
+            warehouse_tables["TOP20"] = (top20, out_path_top20)
+        except Exception as e:
+            log("Top20 in-process export failed: " + repr(e))
+
+    # v6.3.29-F4.8: 本日輸出寫入本機倉庫（daily_excel_records/warehouse.sqlite）
+    try:
+        from output_warehouse import append as warehouse_append
+        log(f"Warehouse: {warehouse_append(LOCAL_EXCEL_FOLDER, today, warehouse_tables)}")
+    except Exception as e:
+        log("warehouse append failed: " + repr(e))
 
     subject = f"每日盤前檢查表 {today} ({market_regime})"
     body = f"附件為今日盤前選股結果。權重模式={mode}（已輸出 weight_* 欄位）。"
     if ENABLE_EMAIL:
         try:
-            send_email_with_attachment(RECEIVER_EMAIL, out_path, subject, body)
-            log('Email sent.')
+            log(f"Email queued: {queue_email(RECEIVER_EMAIL, [out_path], subject, body)}")
         except Exception as e:
             log('Email skipped (error): ' + repr(e))
     else:
         log('Email disabled. Skipping send.')
 
     log(f"Saved: {out_path}")
-try:
-    postprocess_excel(full_path)
-except Exception:
-    pass
-    
+    return {"full_path": out_path, "decision_path": out_path_decision}
+
+
+def main(resume: bool = False, store=None):
+    """store：外部提供的 checkpoint store（daemon_runner 的 MemoryCheckpointStore；此時一律 resume）。"""
+    global today
+    from pipeline_stages import CheckpointStore, StageRunner, prune_days
+
+    now = _dt.datetime.now()
+    today = _today_str()
+    log('=== daily_auto_run_final start ===')
+    log(f'cwd={os.getcwd()}')
+    os.makedirs(LOCAL_EXCEL_FOLDER, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    if store is None:
+        store = CheckpointStore(CHECKPOINT_DIR, today)
+        # v6.3.29-F4.8: 隔夜預抓（prefetch_overnight.py）已就緒的 stage 直接還原，只驗證新鮮度
+        if not resume:
+            prune_days(CHECKPOINT_DIR, today, log=log)
+            from pipeline_stages import STAGE_ORDER
+            from prefetch_overnight import usable_stages
+            kept = usable_stages(CHECKPOINT_DIR, today, log=log)
+            if kept:
+                log(f"prefetched stages used: {kept}")
+                store.drop_from(STAGE_ORDER[len(kept)])
+                resume = True
+    else:
+        resume = True
+    runner = StageRunner(store, resume=resume, log=log, metrics=METRICS)
+    try:
+        _run_stages(runner, now)
+    finally:
+        try:
+            METRICS.write(METRICS_FILE)
+            log(f"Run metrics: {METRICS_FILE}")
+        except Exception as e:
+            log("run metrics write failed: " + repr(e))
+
+
+def _run_stages(runner, now) -> None:
+    global decision_path, full_path, market_regime, NAME_MAP, MARGIN_RATIO_META
+
+    st = runner.run("universe", _stage_universe)
+    NAME_MAP = st["name_map"]
+    tickers, meta = st["tickers"], st["meta"]
+
+    st = runner.run("margin", _stage_margin, _dt.date.today())
+    ratio_map = st["ratio_map"]
+    MARGIN_RATIO_META = st["margin_meta"]
+
+    st = runner.run("prefilter", _stage_prefilter, tickers)
+    tickers2 = st["tickers2"]
+    INVALID_TICKERS.update(st["invalid_tickers"])
+
+    worker = IndicatorWorker() if ENABLE_STREAM_HISTORIES else None
+    st = runner.run("histories", _stage_histories, tickers2, worker)
+    histories = st["histories"]
+    market_regime = st["market_regime"]
+    INVALID_TICKERS.update(st["invalid_tickers"])
+
+    runner.run("ledger", _stage_ledger, histories)
+
+    # 串流模式下 histories 由 checkpoint 還原時 worker 未執行（ind_map 為 None）→ 照常計算
+    streamed = worker.ind_map if worker is not None else None
+    ind_map = runner.run("indicators", _stage_indicators, histories, streamed)["ind_map"]
+
+    df = runner.run("rules", _stage_rules, ind_map, meta, ratio_map, now)["df"]
+    if df is None:
+        log('No candidates found today.')
+        _store_features(histories, meta, ratio_map)
+        flush_invalid_tickers()
+        return
+
+    st = runner.run("weights", _stage_weights, df)
+    df, mode = st["df"], st["mode"]
+
+    df = runner.run("sizing", _stage_sizing, df, market_regime)["df"]
+
+    st = runner.run("scoring", _stage_scoring, df)
+    df_view, trade_date = st["df_view"], st["trade_date"]
+    _store_features(histories, meta, ratio_map, df_view)
+
+    st = runner.run("export", _stage_export, df_view, today, trade_date, mode, market_regime)
+    full_path, decision_path = st["full_path"], st["decision_path"]
+
 
 if __name__ == "__main__":
     import traceback
     from pathlib import Path
     from datetime import datetime
     import sys
+    import argparse
+
+    ap = argparse.ArgumentParser(description="TradingSystem v6.3.29 daily pre-market run")
+    ap.add_argument("--resume", action="store_true", help="resume today's run from the last completed stage checkpoint")
+    args = ap.parse_args()
 
     Path("logs").mkdir(exist_ok=True)
     try:
-        main()
+        main(resume=args.resume)
     except SystemExit as e:
         code = getattr(e, "code", 1)
         if code not in (0, None):
@@ -2805,11 +3180,18 @@ if __name__ == "__main__":
             p = Path("logs") / f"daily_auto_run_error_{ts}.log"
             content = "SystemExit: " + repr(code) + "\n\n" + "STACK:\n" + "".join(traceback.format_stack())
             p.write_text(content, encoding="utf-8")
+            log(f"SystemExit {code!r}; saved traceback: {p}", level="FATAL")
+            LOGGER.flush()
             print(f"[FATAL] saved traceback: {p}")
         raise
     except BaseException:
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         p = Path("logs") / f"daily_auto_run_error_{ts}.log"
-        p.write_text(traceback.format_exc(), encoding="utf-8")
+        tb = traceback.format_exc()
+        p.write_text(tb, encoding="utf-8")
+        log("fatal error:\n" + tb, level="FATAL")
+        LOGGER.flush()
         print(f"[FATAL] saved traceback: {p}")
         raise
+    finally:
+        close_logger()
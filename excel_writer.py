@@ -0,0 +1,185 @@
+"""
+excel_writer.py  (v6.3.29-F4.8)
+
+單次寫出 Excel（資料 + 樣式一次完成，不再 load → 修改 → save）：
+- 表頭樣式 / 凍結首列 / 自動篩選
+- 隱藏指定欄位（依表頭文字）
+- 欄寬（直接由 DataFrame 計算，與 format_excel_sheet 同一規則）
+- 燈號欄（*燈號）與風險提醒列 → 條件式格式（風險底色涵蓋整列；燈號值的底色優先，同舊的先 format 後 postprocess）
+- layout=False：只做舊 postprocess_excel 的樣式（全表靠右、燈號儲存格著色置中；Top20 用）
+
+需要 xlsxwriter；未安裝或資料含 ±inf 時回傳 False，由呼叫端走舊的 openpyxl 後處理流程。
+寫出中途失敗時刪除未完成的檔案後再拋出例外。
+"""
+from __future__ import annotations
+
+import os
+
+import pandas as pd
+
+LIGHT_COLOR_MAP = {"🔴": "#FF0000", "🟡": "#FFA500", "🟢": "#00AA00"}
+LIGHT_FILL_MAP = {"🔴": "#FFE5E5", "🟡": "#FFF2CC", "🟢": "#E2F0D9"}
+LIGHT_NA_VALUES = ("N/A", "LOW")
+LIGHT_NA_FILL = "#F2F2F2"
+LIGHT_NA_COLOR = "#666666"
+
+HEADER_FILL = "#EDEDED"
+RISK_FILL = "#FFF2CC"       # light yellow
+RISK_HIGH_FILL = "#F8CBAD"  # light red
+
+WIDTH_SCAN_ROWS = 200  # header + 199 data rows (same as format_excel_sheet)
+WIDTH_MIN = 10
+WIDTH_MAX = 40
+
+
+def _col_letter(idx: int) -> str:
+    """0-based column index -> Excel letter."""
+    s = ""
+    n = idx + 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+def column_widths(df: pd.DataFrame, scan_rows: int = WIDTH_SCAN_ROWS) -> list[int]:
+    """欄寬：表頭 + 前 scan_rows-1 列字串長度，夾在 [WIDTH_MIN, WIDTH_MAX]。"""
+    head = df.head(max(scan_rows - 1, 0))
+    widths = []
+    for j, h in enumerate(df.columns):
+        col = head.iloc[:, j]
+        lens = col.map(lambda v: 0 if (v is None or (not isinstance(v, str) and pd.isna(v))) else len(str(v)))
+        max_len = max(len(str(h)), int(lens.max()) if len(lens) else 0)
+        widths.append(min(max(WIDTH_MIN, max_len + 2), WIDTH_MAX))
+    return widths
+
+
+def has_inf(df: pd.DataFrame) -> bool:
+    """任何儲存格為 ±inf（xlsxwriter 無法寫成 openpyxl 的 inf 數值）。"""
+    if df is None or df.empty:
+        return False
+    inf = (float("inf"), float("-inf"))
+    return bool(df.isin(inf).to_numpy().any())
+
+
+def write_styled_excel(
+    df: pd.DataFrame,
+    path: str,
+    hide_headers: list[str] | None = None,
+    risk_header: str = "風險提醒",
+    light_marker: str = "燈號",
+    sheet_name: str = "Sheet1",
+    layout: bool = True,
+) -> bool:
+    """
+    一次串流寫出已排版的 xlsx；結果與 to_excel + format_excel_sheet + postprocess_excel 相同：
+    表頭粗體 / 框線 / 底色、全表靠右；燈號值儲存格置中並著色（優先於風險列底色）；
+    風險提醒非空的整列（含燈號欄空白儲存格）淡黃、含 HIGH / 高 淡紅。
+    layout=False：不加表頭底色 / 凍結 / 篩選 / 欄寬 / 風險列底色，樣式與 to_excel + postprocess_excel 相同。
+    回傳 True=已寫出；False=未寫出（xlsxwriter 不可用，或含 ±inf → 呼叫端走 openpyxl 以相同方式寫出 inf）。
+    """
+    try:
+        import xlsxwriter
+    except Exception:
+        return False
+
+    if df is None:
+        df = pd.DataFrame()
+    if has_inf(df):
+        return False
+    headers = [str(c) for c in df.columns]
+    n_rows, n_cols = len(df), len(headers)
+    hide = {str(h).strip() for h in (hide_headers or [])}
+    light_cols = [j for j, h in enumerate(headers) if light_marker in h]
+    risk_col = next((j for j, h in enumerate(headers) if h.strip() == risk_header), None)
+    light_values = set(LIGHT_COLOR_MAP) | set(LIGHT_NA_VALUES)
+
+    wb = xlsxwriter.Workbook(path, {
+        "constant_memory": True,
+        "strings_to_urls": False,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    done = False
+    try:
+        ws = wb.add_worksheet(sheet_name)
+
+        # pandas 表頭（粗體 + 框線）；postprocess_excel 把所有儲存格（含表頭）改為靠右 / 靠下
+        header = {"bold": True, "border": 1, "align": "right", "valign": "bottom"}
+        if layout:
+            header["bg_color"] = HEADER_FILL
+        fmt_header = wb.add_format(header)
+        fmt_cell = wb.add_format({"align": "right", "valign": "bottom"})
+        if layout:
+            # 顏色由條件式格式處理（才能與風險列底色排定優先順序），儲存格只負責置中
+            fmt_center = wb.add_format({"align": "center", "valign": "bottom"})
+            light_value_fmts = {v: fmt_center for v in light_values}
+        else:
+            light_value_fmts = {v: wb.add_format({"font_color": c, "bold": True, "bg_color": LIGHT_FILL_MAP[v],
+                                                  "align": "center", "valign": "bottom"})
+                                for v, c in LIGHT_COLOR_MAP.items()}
+            fmt_na = wb.add_format({"font_color": LIGHT_NA_COLOR, "bold": True, "bg_color": LIGHT_NA_FILL,
+                                    "align": "center", "valign": "bottom"})
+            light_value_fmts.update({v: fmt_na for v in LIGHT_NA_VALUES})
+
+        # Column formats / widths / hidden must be set before rows are streamed
+        widths = column_widths(df) if layout else [None] * n_cols  # None = Excel 預設欄寬
+        for j, w in enumerate(widths):
+            opts = {"hidden": True} if headers[j].strip() in hide else {}
+            ws.set_column(j, j, w, fmt_cell, opts)
+
+        ws.write_row(0, 0, headers, fmt_header)
+
+        if n_rows:
+            values = df.astype(object).where(pd.notna(df), None)
+            light_set = set(light_cols)
+            for i, row in enumerate(values.itertuples(index=False, name=None), start=1):
+                for j, v in enumerate(row):
+                    if v is None or (isinstance(v, str) and v == ""):
+                        continue
+                    if j in light_set and isinstance(v, str) and v in light_value_fmts:
+                        ws.write(i, j, v, light_value_fmts[v])
+                    else:
+                        ws.write(i, j, v)
+
+        if layout:
+            ws.freeze_panes(1, 0)
+            if n_cols:
+                ws.autofilter(0, 0, max(n_rows, 1), n_cols - 1)
+
+            if n_rows:
+                # 先加入者優先：燈號值（stop_if_true，同 postprocess_excel 最後覆寫）→ HIGH / 高 → 一般風險
+                for j in light_cols:
+                    for v, color in LIGHT_COLOR_MAP.items():
+                        fmt = wb.add_format({"font_color": color, "bold": True, "bg_color": LIGHT_FILL_MAP[v]})
+                        ws.conditional_format(1, j, n_rows, j, {"type": "cell", "criteria": "==", "value": f'"{v}"',
+                                                                "format": fmt, "stop_if_true": True})
+                    fmt_na = wb.add_format({"font_color": LIGHT_NA_COLOR, "bold": True, "bg_color": LIGHT_NA_FILL})
+                    for v in LIGHT_NA_VALUES:
+                        ws.conditional_format(1, j, n_rows, j, {"type": "cell", "criteria": "==", "value": f'"{v}"',
+                                                                "format": fmt_na, "stop_if_true": True})
+
+                # Risk rows: every cell of the row (light cells without a light value included)
+                if risk_col is not None and n_cols:
+                    ref = f"${_col_letter(risk_col)}2"
+                    rules = [
+                        (f'=OR(ISNUMBER(SEARCH("HIGH",{ref})),ISNUMBER(SEARCH("高",{ref})))', RISK_HIGH_FILL),
+                        (f"=LEN(TRIM({ref}))>0", RISK_FILL),
+                    ]
+                    for formula, fill in rules:
+                        ws.conditional_format(1, 0, n_rows, n_cols - 1, {
+                            "type": "formula",
+                            "criteria": formula,
+                            "format": wb.add_format({"bg_color": fill}),
+                            "stop_if_true": True,
+                        })
+        done = True
+    finally:
+        try:
+            wb.close()
+        finally:
+            if not done:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    return True
@@ -8,10 +8,14 @@ from pathlib import Path
 
 import pandas as pd
 
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment, Font, PatternFill
-
 from lights_unified import apply_lights, apply_display_overrides
+from topn_select import select_top_n
+
+# Top-N selection settings (env overridable)
+TOP20_N = int(os.environ.get("TOP20_N", "20"))
+TOP20_MARKET_QUOTA = os.environ.get("TOP20_MARKET_QUOTA", "").strip()      # e.g. "TWSE:12,TWO:8"
+TOP20_STRATEGY_QUOTA = os.environ.get("TOP20_STRATEGY_QUOTA", "").strip()  # e.g. "MEAN_REVERT:10,*:6"
+TOP20_MIN_LIGHTS = os.environ.get("TOP20_MIN_LIGHTS", "").strip()          # e.g. "成交值燈號:🟡"
 
 TOP20_COL_ORDER = [
     "進場日期",
@@ -38,10 +42,20 @@ def pick_latest_full(records_dir: str, run_date: str | None):
         cand = os.path.join(records_dir, f"{run_date}_stock_selection.xlsx")
         if os.path.exists(cand):
             return cand
+    # v6.3.29-F4.8: 倉庫索引查詢（沒有倉庫、索引落後於磁碟或檔案已移除時回退 glob）
+    try:
+        from output_warehouse import latest_file
+        hit = latest_file(records_dir, "FULL")
+        if hit and os.path.exists(hit):
+            return hit
+    except Exception:
+        pass
     files = sorted(glob.glob(os.path.join(records_dir, "*_stock_selection.xlsx")))
     return files[-1] if files else None
 
 def apply_alignment_and_lights(wb):
+    from openpyxl.styles import Alignment, Font, PatternFill
+
     color_map = {"🔴": "FFFF0000", "🟡": "FFFFA500", "🟢": "FF00AA00"}
     fill_map  = {"🔴": "FFFFE5E5", "🟡": "FFFFF2CC", "🟢": "FFE2F0D9"}
     na_fill = "FFF2F2F2"
@@ -72,83 +86,154 @@ def apply_alignment_and_lights(wb):
 
 def postprocess_excel(path: str):
     try:
+        from openpyxl import load_workbook
         wb = load_workbook(path)
         apply_alignment_and_lights(wb)
         wb.save(path)
     except Exception:
         return
 
-def build_top20(df_full: pd.DataFrame) -> pd.DataFrame:
+def write_top20_excel(df: pd.DataFrame, out_path: str, log=print):
+    """
+    單次寫出，樣式與 to_excel + postprocess_excel 相同（靠右對齊、燈號著色；不加表頭底色/凍結/篩選/欄寬）。
+    缺 xlsxwriter 或寫出失敗（未完成的檔案已刪除）時回退 to_excel + postprocess_excel。
+    """
+    try:
+        from excel_writer import write_styled_excel
+        if write_styled_excel(df, out_path, layout=False):
+            return
+    except Exception as e:
+        log(f"[top20] styled Excel write failed, fallback to openpyxl: {e!r}")
+    df.to_excel(out_path, index=False)
+    postprocess_excel(out_path)
+
+# internal / legacy column names -> Top20 display names
+TOP20_SOURCE_MAP = {
+    "entry_date": "進場日期",
+    "ticker": "Yahoo代碼",
+    "name_zh": "股票名稱",
+    "strategy_desc": "策略說明",
+    "entry_price": "進場價",
+    "stop_loss_price": "停損價",
+    "bias20": "乖離率(%)",
+    "turnover_rate(%)": "周轉率(%)",
+    "turnover_rate": "周轉率(%)",
+    "trade_value": "成交值(元)",
+    "成交值(元)": "成交值(元)",
+    "trade_value_rank": "成交值排名",
+    "成交值排名": "成交值排名",
+    "position_size": "建議部位(元)",
+    "Risk Alert": "風險提醒",
+    "risk_alert": "風險提醒",
+    "final_score": "綜合分數",
+    "squeeze_pressure": "嘎空壓力",
+    "嘎空壓力": "嘎空壓力",
+}
+
+def top20_out_path(records_dir: str, date_tag: str) -> str:
+    return os.path.join(records_dir, f"{date_tag}_Top20_推薦清單.xlsx")
+
+def build_top20(
+    df_full: pd.DataFrame,
+    prepared: bool = False,
+    n: int | None = None,
+    market_quota=None,
+    strategy_quota=None,
+    min_lights=None,
+) -> pd.DataFrame:
+    """
+    prepared=True：df_full 已是 FULL 中文欄位且已套用 apply_lights / apply_display_overrides
+    （daily_auto_run_final 同程序呼叫），跳過欄位對映與燈號重算。
+    n / 配額 / 最低燈號未指定時使用 TOP20_* 環境設定（預設 20 檔、無配額）。
+    """
     if df_full is None or len(df_full)==0:
         return pd.DataFrame(columns=TOP20_COL_ORDER)
 
     df = df_full.copy()
 
-    mapping = {
-        "entry_date": "進場日期",
-        "ticker": "Yahoo代碼",
-        "name_zh": "股票名稱",
-        "strategy_desc": "策略說明",
-        "entry_price": "進場價",
-        "stop_loss_price": "停損價",
-        "bias20": "乖離率(%)",
-        "turnover_rate(%)": "周轉率(%)",
-        "turnover_rate": "周轉率(%)",
-        "trade_value": "成交值(元)",
-        "成交值(元)": "成交值(元)",
-        "trade_value_rank": "成交值排名",
-        "成交值排名": "成交值排名",
-        "position_size": "建議部位(元)",
-        "Risk Alert": "風險提醒",
-        "risk_alert": "風險提醒",
-        "final_score": "綜合分數",
-        "squeeze_pressure": "嘎空壓力",
-        "嘎空壓力": "嘎空壓力",
-    }
-    for src, dst in mapping.items():
-        if src in df.columns and dst not in df.columns:
-            df[dst] = df[src]
+    if not prepared:
+        for src, dst in TOP20_SOURCE_MAP.items():
+            if src in df.columns and dst not in df.columns:
+                df[dst] = df[src]
 
     for c in TOP20_COL_ORDER:
         if c not in df.columns:
             df[c] = ""
 
-    df = apply_lights(df)
-    df = apply_display_overrides(df)
-
-    score = pd.to_numeric(df.get("綜合分數"), errors="coerce")
-    bias = pd.to_numeric(df.get("乖離率(%)"), errors="coerce")
-    df["__score"] = score
-    df["__bias"] = bias
-    df = df.sort_values(["__score","__bias"], ascending=[False, True], na_position="last")
-
-    top = df.head(20).copy()
+    if not prepared:
+        df = apply_lights(df)
+        df = apply_display_overrides(df)
+
+    top = select_top_n(
+        df,
+        n=TOP20_N if n is None else n,
+        score_col="綜合分數",
+        tiebreak_col="乖離率(%)",
+        market_quota=TOP20_MARKET_QUOTA if market_quota is None else market_quota,
+        strategy_quota=TOP20_STRATEGY_QUOTA if strategy_quota is None else strategy_quota,
+        min_lights=TOP20_MIN_LIGHTS if min_lights is None else min_lights,
+    ).copy()
     top = top.reindex(columns=TOP20_COL_ORDER)
     return top
 
+def export_top20(df_full: pd.DataFrame | None, out_path: str, prepared: bool = False, log=print) -> pd.DataFrame:
+    """Build + write the Top20 workbook; returns the Top20 frame."""
+    top20 = build_top20(df_full, prepared=prepared) if df_full is not None else pd.DataFrame(columns=TOP20_COL_ORDER)
+    write_top20_excel(top20, out_path, log=log)
+    return top20
+
 def main():
+    from datetime import datetime
+    from run_metrics import RunMetrics
+
+    metrics = RunMetrics(datetime.now().strftime("%Y%m%d_%H%M%S"), "export_top20")
+    try:
+        _main(metrics)
+    finally:
+        try:
+            metrics.write(f"run_metrics_top20_{metrics.run_ts}.json")
+        except Exception:
+            pass
+
+def _main(metrics):
     base_dir = os.path.dirname(__file__)
     records_dir = os.path.join(base_dir, "daily_excel_records")
     os.makedirs(records_dir, exist_ok=True)
 
     run_date = os.environ.get("RUN_DATE","").strip() or None
-    full_path = pick_latest_full(records_dir, run_date)
+    with metrics.stage("locate"):
+        full_path = pick_latest_full(records_dir, run_date)
 
+    date_tag = run_date or (os.path.basename(full_path).split("_stock_selection.xlsx")[0] if full_path else "UNKNOWN")
     out_path = os.environ.get("TOP20_OUT_PATH","").strip()
     if not out_path:
-        date_tag = run_date or (os.path.basename(full_path).split("_stock_selection.xlsx")[0] if full_path else "UNKNOWN")
-        out_path = os.path.join(records_dir, f"{date_tag}_Top20_推薦清單.xlsx")
+        out_path = top20_out_path(records_dir, date_tag)
 
     if not full_path:
-        pd.DataFrame(columns=TOP20_COL_ORDER).to_excel(out_path, index=False)
-        postprocess_excel(out_path)
+        with metrics.stage("export", rows_in=0):
+            export_top20(None, out_path)
         return
 
-    df_full = pd.read_excel(full_path)
-    top20 = build_top20(df_full)
-
-    top20.to_excel(out_path, index=False)
-    postprocess_excel(out_path)
+    # typed sidecar (memory-mapped) first; legacy days fall back to read_excel
+    with metrics.stage("load") as rec:
+        df_full = None
+        try:
+            from sidecar_io import load_sidecar
+            df_full = load_sidecar(records_dir, date_tag, "FULL")
+        except Exception:
+            df_full = None
+        rec["source"] = "sidecar" if df_full is not None else "xlsx"
+        if df_full is None:
+            df_full = pd.read_excel(full_path)
+        metrics.set_rows(rows_out=len(df_full))
+    with metrics.stage("export", rows_in=len(df_full)):
+        top20 = export_top20(df_full, out_path)
+        metrics.set_rows(rows_out=len(top20))
+    try:
+        from output_warehouse import append
+        append(records_dir, date_tag, {"TOP20": (top20, out_path)})
+    except Exception:
+        pass
 
 if __name__ == "__main__":
     main()
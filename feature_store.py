@@ -0,0 +1,229 @@
+"""
+feature_store.py  (v6.3.29-F4.8)
+
+每日指標特徵庫，鍵為 (date, ticker)，依月份分區：feature_store/<YYYY-MM>.arrow
+（Arrow IPC，可 memory-map；未安裝 pyarrow 時改存 <YYYY-MM>.pkl）
+
+- update：Stage2 全部標的的歷史價量 → backtest_engine.compute_indicator_panel（與 compute_indicators 相同公式）
+  → 只存暖機完成（≥60 根 K 棒）的 (date, ticker)，同鍵以新值覆蓋
+- extras：當日才有的欄位（券資比 smr、周轉率、綜合分數、策略代碼）掛在各檔最後一根 K 棒上
+- read / read_panel：長表或 dates × tickers 寬表
+- indicator_panel：回測 / 參數掃描直接取用已存指標；面板有缺格時回傳 None（呼叫端自行重算）
+
+    python feature_store.py --cache cache_yf          # 由 cache_yf 建立 / 補齊
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+STORE_DIR = os.environ.get("FEATURE_STORE_DIR", "feature_store")
+WARMUP_BARS = 60
+
+INDICATOR_FIELDS = ["close", "ma20", "bias20", "support_1m", "atr20", "volatility_ratio", "volume_ratio", "vol20"]
+EXTRA_FIELDS = ["smr", "turnover_rate", "score", "strategy"]
+
+# daily 候選表欄位 → extras 欄位
+EXTRA_SOURCE = {
+    "short_margin_ratio(%)": "smr",
+    "turnover_rate(%)": "turnover_rate",
+    "綜合分數": "score",
+    "strategy": "strategy",
+}
+
+
+def _has_arrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except Exception:
+        return False
+
+
+def _partition_files(root: str) -> dict[str, str]:
+    """{YYYY-MM: path}；同月份同時有 .arrow / .pkl 時取 .arrow。"""
+    out = {}
+    for p in sorted(glob.glob(os.path.join(root, "*.pkl"))) + sorted(glob.glob(os.path.join(root, "*.arrow"))):
+        out[os.path.splitext(os.path.basename(p))[0]] = p
+    return out
+
+
+def _read_partition(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    if path.endswith(".arrow"):
+        import pyarrow as pa
+        with pa.memory_map(path, "r") as src:
+            tbl = pa.ipc.open_file(src).read_all()
+        if columns:
+            tbl = tbl.select([c for c in ["date", "ticker"] + columns if c in tbl.column_names])
+        return tbl.to_pandas()
+    df = pd.read_pickle(path)
+    return df[[c for c in ["date", "ticker"] + columns if c in df.columns]] if columns else df
+
+
+def _write_partition(root: str, month: str, df: pd.DataFrame) -> str:
+    os.makedirs(root, exist_ok=True)
+    df = df.sort_values(["date", "ticker"], kind="mergesort").reset_index(drop=True)
+    if _has_arrow():
+        import pyarrow as pa
+        path = os.path.join(root, f"{month}.arrow")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        tmp = path + ".tmp"
+        with pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+        stale = os.path.join(root, f"{month}.pkl")
+        if os.path.exists(stale):
+            os.remove(stale)
+    else:
+        path = os.path.join(root, f"{month}.pkl")
+        tmp = path + ".tmp"
+        df.to_pickle(tmp)
+        os.replace(tmp, path)
+    return path
+
+
+def _long_frame(panel, ind: dict) -> pd.DataFrame:
+    """面板 → 暖機完成格的長表（date, ticker, 指標..., valid）。"""
+    n_obs = np.cumsum(~np.isnan(panel.close), axis=0)
+    t_idx, n_idx = np.nonzero(n_obs >= WARMUP_BARS)
+    out = pd.DataFrame({
+        "date": panel.dates[t_idx].tz_localize(None) if getattr(panel.dates, "tz", None) else panel.dates[t_idx],
+        "ticker": panel.tickers[n_idx].astype(str),
+    })
+    for f in INDICATOR_FIELDS:
+        out[f] = ind[f][t_idx, n_idx]
+    out["valid"] = ind["valid"][t_idx, n_idx]
+    return out
+
+
+def _extras_frame(extras: pd.DataFrame | None) -> pd.DataFrame | None:
+    if extras is None or extras.empty or "ticker" not in extras.columns:
+        return None
+    cols = {src: dst for src, dst in EXTRA_SOURCE.items() if src in extras.columns}
+    ex = extras[["ticker"] + list(cols)].rename(columns=cols).drop_duplicates("ticker", keep="first")
+    for c in ("smr", "turnover_rate", "score"):
+        if c in ex.columns:
+            ex[c] = pd.to_numeric(ex[c], errors="coerce")
+    return ex
+
+
+def update(histories: dict, extras: pd.DataFrame | None = None, root: str = STORE_DIR, log=print) -> int:
+    """histories（Stage2 全部標的）→ 寫入 / 覆蓋各月份分區；回傳寫入列數。"""
+    import backtest_engine as bt
+
+    t0 = time.perf_counter()
+    hist = {t: h for t, h in (histories or {}).items() if h is not None and len(h) >= WARMUP_BARS}
+    if not hist:
+        return 0
+    panel = bt.build_panel(hist, index_ticker=None)
+    new = _long_frame(panel, bt.compute_indicator_panel(panel))
+    if new.empty:
+        return 0
+
+    ex = _extras_frame(extras)
+    if ex is not None:
+        last = new.groupby("ticker", sort=False)["date"].transform("max") == new["date"]
+        tagged = new.loc[last, ["ticker"]].reset_index().merge(ex, on="ticker", how="inner").set_index("index")
+        for c in EXTRA_FIELDS:
+            if c in tagged.columns:
+                new.loc[tagged.index, c] = tagged[c]
+
+    months = new["date"].dt.strftime("%Y-%m")
+    files = _partition_files(root)
+    for month, part in new.groupby(months, sort=True):
+        if month in files:
+            # 新值優先；本次沒有的 extras / 舊日期沿用庫內值
+            key = ["date", "ticker"]
+            old = _read_partition(files[month]).set_index(key)
+            part = part.set_index(key).combine_first(old).reset_index()
+            part["valid"] = part["valid"].fillna(False).astype(bool)
+        _write_partition(root, month, part)
+    log(f"[features] {len(new)} rows ({panel.shape[1]} tickers, {months.nunique()} month partition(s)) "
+        f"-> {root} in {time.perf_counter() - t0:.2f}s")
+    return len(new)
+
+
+# ---------------------------------------------------------------------------
+# readers
+# ---------------------------------------------------------------------------
+def read(start=None, end=None, tickers=None, columns: list[str] | None = None, root: str = STORE_DIR) -> pd.DataFrame:
+    """(date, ticker) 長表；只讀範圍內的月份分區。"""
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    parts = []
+    for month, path in sorted(_partition_files(root).items()):
+        if start is not None and month < start.strftime("%Y-%m"):
+            continue
+        if end is not None and month > end.strftime("%Y-%m"):
+            continue
+        parts.append(_read_partition(path, columns))
+    if not parts:
+        return pd.DataFrame(columns=["date", "ticker"] + (columns or INDICATOR_FIELDS + ["valid"]))
+    df = pd.concat(parts, ignore_index=True)
+    m = np.ones(len(df), dtype=bool)
+    if start is not None:
+        m &= (df["date"] >= start).to_numpy()
+    if end is not None:
+        m &= (df["date"] <= end).to_numpy()
+    if tickers is not None:
+        m &= df["ticker"].isin(list(tickers)).to_numpy()
+    return df[m].reset_index(drop=True)
+
+
+def read_panel(field: str, start=None, end=None, tickers=None, root: str = STORE_DIR) -> pd.DataFrame:
+    """單一欄位的 dates × tickers 寬表。"""
+    df = read(start, end, tickers, columns=[field], root=root)
+    if df.empty or field not in df.columns:
+        return pd.DataFrame()
+    return df.pivot(index="date", columns="ticker", values=field).sort_index()
+
+
+def indicator_panel(panel, root: str = STORE_DIR) -> dict | None:
+    """
+    backtest_engine.Panel → compute_indicator_panel 相同結構的 dict（取自特徵庫）。
+    面板上每個暖機完成的格子都必須在庫內，否則回傳 None（呼叫端重算）。
+    """
+    if not _partition_files(root):
+        return None
+    dates = panel.dates.tz_localize(None) if getattr(panel.dates, "tz", None) else panel.dates
+    tickers = [str(t) for t in panel.tickers]
+    df = read(dates.min(), dates.max(), tickers, columns=INDICATOR_FIELDS + ["valid"], root=root)
+    if df.empty:
+        return None
+    df = df.set_index(["date", "ticker"])
+    grid = pd.MultiIndex.from_product([dates, tickers], names=["date", "ticker"])
+    present = grid.isin(df.index).reshape(len(dates), len(tickers))
+    need = np.cumsum(~np.isnan(panel.close), axis=0) >= WARMUP_BARS
+    if not present[need].all():
+        return None
+    aligned = df.reindex(grid)
+    shape = (len(dates), len(tickers))
+    ind = {f: aligned[f].to_numpy(dtype="float64").reshape(shape) for f in INDICATOR_FIELDS}
+    ind["close"] = panel.close
+    ind["valid"] = aligned["valid"].fillna(False).to_numpy(dtype=bool).reshape(shape)
+    return ind
+
+
+def main(argv=None) -> int:
+    import backtest_engine as bt
+
+    ap = argparse.ArgumentParser(description="Build / refresh the per-ticker daily feature store")
+    ap.add_argument("--cache", default="cache_yf")
+    ap.add_argument("--root", default=STORE_DIR)
+    args = ap.parse_args(argv)
+    hist = bt.load_cached_histories(args.cache)
+    if not hist:
+        print(f"[features] no cached histories in {args.cache}")
+        return 1
+    update(hist, root=args.root)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
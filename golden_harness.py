@@ -0,0 +1,351 @@
+"""
+golden_harness.py  (v6.3.29-F4.8)
+
+Golden-output 等價驗證：v6.3.29 凍結輸出，任何加速改寫都要證明 FULL / Decision / Top20 不變。
+
+流程：
+1) record：把一次正常執行留下的「外部輸入」封存成 golden 快照
+   - checkpoints/<day>/ 的 universe / margin / prefilter / histories（網路抓取的部分）
+   - cache/shares_map.json、cache/yahoo_volume_map_*.json、策略權重狀態、performance_summary.xlsx
+2) run：baseline 與 candidate 各自在獨立子程序 + 暫存工作目錄中，以同一份快照 main(resume=True) 重放
+   （不連網；Email 關閉），並對 FULL 再單獨計時 build_top20
+3) 逐格比對 FULL / Decision / Top20：數值欄允許容差，燈號/文字必須完全一致；並排列出各 stage 秒數
+
+實作（impl）可以是目錄（含 daily_auto_run_final.py 等模組）或 git:<ref>（暫時 git worktree）。
+
+    python golden_harness.py record --day 20240628 --name 2024-06-28
+    python golden_harness.py run --name 2024-06-28 --baseline git:HEAD~1 --candidate .
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+GOLDEN_DIR = "golden"
+INPUT_STAGES = ["universe", "margin", "prefilter", "histories"]
+INPUT_FILES = [
+    os.path.join("cache", "shares_map.json"),
+    os.path.join("cache", "yahoo_volume_map_*.json"),
+    "strategy_weights_state.json",
+    "performance_summary.xlsx",
+]
+RECORDS_DIR = "daily_excel_records"
+CHECKPOINT_DIR = "checkpoints"
+
+ATOL = 1e-6
+RTOL = 1e-9
+MAX_EXAMPLES = 20
+
+
+# ---------------------------------------------------------------------------
+# record
+# ---------------------------------------------------------------------------
+def record(day: str, name: str | None = None, src_root: str = ".", golden_dir: str = GOLDEN_DIR) -> str:
+    from pipeline_stages import CheckpointStore
+
+    store = CheckpointStore(os.path.join(src_root, CHECKPOINT_DIR), day)
+    missing = [s for s in INPUT_STAGES if not store.has(s)]
+    if missing:
+        raise SystemExit(f"checkpoints missing for {day}: {missing} (run daily_auto_run_final.py first)")
+    dst = os.path.join(golden_dir, name or day)
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    os.makedirs(os.path.join(dst, "checkpoints"))
+    for s in INPUT_STAGES:
+        p = store.path(s)
+        shutil.copy2(p, os.path.join(dst, "checkpoints", os.path.basename(p)))
+    files = []
+    for pat in INPUT_FILES:
+        for p in glob.glob(os.path.join(src_root, pat)):
+            rel = os.path.relpath(p, src_root)
+            os.makedirs(os.path.dirname(os.path.join(dst, "files", rel)) or ".", exist_ok=True)
+            shutil.copy2(p, os.path.join(dst, "files", rel))
+            files.append(rel)
+    with open(os.path.join(dst, "golden.json"), "w", encoding="utf-8") as f:
+        json.dump({"day": day, "stages": INPUT_STAGES, "files": files,
+                   "recorded": time.strftime("%Y-%m-%d %H:%M:%S")}, f, ensure_ascii=False, indent=2)
+    return dst
+
+
+# ---------------------------------------------------------------------------
+# worker (runs inside a fresh interpreter, cwd = temp workdir, sys.path[0] = impl dir)
+# ---------------------------------------------------------------------------
+def _worker(impl_dir: str, golden: str, workdir: str) -> None:
+    sys.path.insert(0, impl_dir)
+    os.chdir(workdir)
+
+    # replay inputs: files + recorded network stages under today's checkpoint day
+    files_dir = os.path.join(golden, "files")
+    if os.path.isdir(files_dir):
+        shutil.copytree(files_dir, workdir, dirs_exist_ok=True)
+
+    import daily_auto_run_final as mod
+
+    today = mod._today_str()
+    now = time.time()
+    vol_maps = sorted(glob.glob(os.path.join("cache", "yahoo_volume_map_*.json")))
+    if vol_maps:
+        # scoring 以執行日為快取鍵；把錄製日的成交量表改名成今天，避免重放時連網
+        want = os.path.join("cache", f"yahoo_volume_map_{time.strftime('%Y-%m-%d')}.json")
+        if not os.path.exists(want):
+            shutil.copy2(vol_maps[-1], want)
+    for p in glob.glob(os.path.join("cache", "*.json")):
+        os.utime(p, (now, now))  # shares_map 72h 有效期以 mtime 判斷
+    ck_day = os.path.join(workdir, CHECKPOINT_DIR, today)
+    os.makedirs(ck_day, exist_ok=True)
+    for p in glob.glob(os.path.join(golden, "checkpoints", "*.pkl")):
+        shutil.copy2(p, ck_day)
+
+    mod.ENABLE_EMAIL = False
+    mod.CHECKPOINT_DIR = os.path.join(workdir, CHECKPOINT_DIR)
+    mod.LOCAL_EXCEL_FOLDER = os.path.join(workdir, RECORDS_DIR)
+
+    timings = {}
+    t0 = time.perf_counter()
+    mod.main(resume=True)
+    timings["main"] = time.perf_counter() - t0
+
+    stages = {}
+    try:
+        with open(mod.METRICS_FILE, "r", encoding="utf-8") as f:
+            for rec in json.load(f).get("stages", []):
+                if not rec.get("parent"):
+                    stages[rec["stage"]] = rec.get("wall_s")
+    except Exception:
+        pass
+
+    # build_top20 on the FULL just produced (standalone entry, not the in-process call)
+    full = os.path.join(mod.LOCAL_EXCEL_FOLDER, f"{today}_stock_selection.xlsx")
+    if os.path.exists(full):
+        import pandas as pd
+        from export_top20 import build_top20
+        df_full = pd.read_excel(full)
+        t0 = time.perf_counter()
+        build_top20(df_full)
+        timings["build_top20"] = time.perf_counter() - t0
+
+    try:
+        mod.LOGGER.close()
+    except Exception:
+        pass
+    with open(os.path.join(workdir, "harness_result.json"), "w", encoding="utf-8") as f:
+        json.dump({"today": today, "timings": timings, "stages": stages}, f, ensure_ascii=False, indent=2)
+
+
+# ---------------------------------------------------------------------------
+# impl resolution / execution
+# ---------------------------------------------------------------------------
+class _Impl:
+    def __init__(self, spec: str):
+        self.spec = spec
+        self._worktree = None
+        if spec.startswith("git:"):
+            ref = spec[4:]
+            self._worktree = tempfile.mkdtemp(prefix="golden_wt_")
+            os.rmdir(self._worktree)
+            subprocess.run(["git", "worktree", "add", "--detach", self._worktree, ref], check=True,
+                           stdout=subprocess.DEVNULL)
+            self.dir = self._worktree
+        else:
+            self.dir = os.path.abspath(spec)
+
+    def close(self) -> None:
+        if self._worktree:
+            subprocess.run(["git", "worktree", "remove", "--force", self._worktree], check=False)
+
+
+def run_impl(impl: _Impl, golden: str) -> dict:
+    workdir = tempfile.mkdtemp(prefix="golden_run_")
+    cmd = [sys.executable, os.path.abspath(__file__), "_worker",
+           "--impl", impl.dir, "--golden", os.path.abspath(golden), "--workdir", workdir]
+    env = dict(os.environ, TOP20_INPROC="1")
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f"{impl.spec} failed (exit {proc.returncode}):\n{proc.stderr[-4000:]}")
+    with open(os.path.join(workdir, "harness_result.json"), "r", encoding="utf-8") as f:
+        res = json.load(f)
+    res["wall_process"] = wall
+    res["workdir"] = workdir
+    res["outputs"] = _outputs(os.path.join(workdir, RECORDS_DIR), res["today"])
+    return res
+
+
+def _outputs(records_dir: str, day: str) -> dict:
+    return {
+        "FULL": os.path.join(records_dir, f"{day}_stock_selection.xlsx"),
+        "DECISION": os.path.join(records_dir, f"{day}_stock_selection_決策8欄.xlsx"),
+        "TOP20": os.path.join(records_dir, f"{day}_Top20_推薦清單.xlsx"),
+    }
+
+
+# ---------------------------------------------------------------------------
+# cell-by-cell diff
+# ---------------------------------------------------------------------------
+def _is_blank(v) -> bool:
+    if v is None:
+        return True
+    if isinstance(v, float) and math.isnan(v):
+        return True
+    return isinstance(v, str) and v.strip() == ""
+
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def cells_equal(a, b, atol: float = ATOL, rtol: float = RTOL) -> bool:
+    """
+    空值（None/NaN/空字串）彼此相等；兩邊都是數值 → |a-b| <= atol + rtol*|b|；
+    其餘（燈號 / 標籤 / 文字，以及數值 vs 字串）必須完全一致。
+    """
+    if _is_blank(a) and _is_blank(b):
+        return True
+    if _is_number(a) and _is_number(b):
+        return abs(float(a) - float(b)) <= atol + rtol * abs(float(b))
+    return type(a) is type(b) and str(a) == str(b)
+
+
+def diff_tables(base, cand, atol: float = ATOL, rtol: float = RTOL, max_examples: int = MAX_EXAMPLES) -> dict:
+    """按列位置逐格比對（排序也是輸出的一部分）。"""
+    rep = {"rows": (len(base), len(cand)), "columns_only_base": [], "columns_only_cand": [],
+           "cells_compared": 0, "cells_different": 0, "examples": []}
+    bcols, ccols = [str(c) for c in base.columns], [str(c) for c in cand.columns]
+    rep["columns_only_base"] = [c for c in bcols if c not in ccols]
+    rep["columns_only_cand"] = [c for c in ccols if c not in bcols]
+    if bcols != ccols and not rep["columns_only_base"] and not rep["columns_only_cand"]:
+        rep["column_order_differs"] = True
+    common = [c for c in bcols if c in ccols]
+    n = min(len(base), len(cand))
+    b = base.astype(object).set_axis(bcols, axis=1)
+    c = cand.astype(object).set_axis(ccols, axis=1)
+    for col in common:
+        bv, cv = b[col].tolist(), c[col].tolist()
+        for i in range(n):
+            rep["cells_compared"] += 1
+            if not cells_equal(bv[i], cv[i], atol, rtol):
+                rep["cells_different"] += 1
+                if len(rep["examples"]) < max_examples:
+                    rep["examples"].append({"row": i + 2, "column": col, "baseline": repr(bv[i]), "candidate": repr(cv[i])})
+    rep["equal"] = (rep["cells_different"] == 0 and rep["rows"][0] == rep["rows"][1]
+                    and not rep["columns_only_base"] and not rep["columns_only_cand"]
+                    and not rep.get("column_order_differs"))
+    return rep
+
+
+def compare_outputs(base_res: dict, cand_res: dict, atol: float = ATOL, rtol: float = RTOL) -> dict:
+    import pandas as pd
+    out = {}
+    for table, bpath in base_res["outputs"].items():
+        cpath = cand_res["outputs"][table]
+        bex, cex = os.path.exists(bpath), os.path.exists(cpath)
+        if not bex or not cex:
+            out[table] = {"equal": bex == cex, "missing": {"baseline": not bex, "candidate": not cex}}
+            continue
+        out[table] = diff_tables(pd.read_excel(bpath), pd.read_excel(cpath), atol, rtol)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# report
+# ---------------------------------------------------------------------------
+def print_report(base_res: dict, cand_res: dict, diffs: dict) -> None:
+    print("=== Timing (s) ===")
+    print(f"{'step':<14}{'baseline':>12}{'candidate':>12}{'ratio':>8}")
+    keys = list(dict.fromkeys(list(base_res["stages"]) + list(cand_res["stages"])))
+    rows = [(k, base_res["stages"].get(k), cand_res["stages"].get(k)) for k in keys]
+    rows += [(k, base_res["timings"].get(k), cand_res["timings"].get(k)) for k in ("main", "build_top20")]
+    for k, b, c in rows:
+        ratio = f"{c / b:.2f}" if (b and c) else "-"
+        print(f"{k:<14}{(b or 0):>12.3f}{(c or 0):>12.3f}{ratio:>8}")
+    print("=== Outputs ===")
+    for table, d in diffs.items():
+        if "missing" in d:
+            print(f"{table:<9} {'OK' if d['equal'] else 'MISSING'} {d['missing']}")
+            continue
+        status = "OK" if d["equal"] else "DIFF"
+        print(f"{table:<9} {status}  rows={d['rows']}  cells={d['cells_compared']}  different={d['cells_different']}")
+        for c in d["columns_only_base"]:
+            print(f"    column only in baseline: {c}")
+        for c in d["columns_only_cand"]:
+            print(f"    column only in candidate: {c}")
+        if d.get("column_order_differs"):
+            print("    column order differs")
+        for ex in d["examples"]:
+            print(f"    row {ex['row']} [{ex['column']}]: {ex['baseline']} -> {ex['candidate']}")
+
+
+def run(name: str, baseline: str, candidate: str, golden_dir: str = GOLDEN_DIR,
+        atol: float = ATOL, rtol: float = RTOL, keep: bool = False, report_path: str | None = None) -> bool:
+    golden = os.path.join(golden_dir, name)
+    if not os.path.exists(os.path.join(golden, "golden.json")):
+        raise SystemExit(f"golden snapshot not found: {golden} (use `record` first)")
+    impls = [_Impl(baseline), _Impl(candidate)]
+    results = []
+    try:
+        for impl in impls:
+            results.append(run_impl(impl, golden))
+        diffs = compare_outputs(results[0], results[1], atol, rtol)
+        print_report(results[0], results[1], diffs)
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump({"baseline": results[0],
+                           "candidate": results[1],
+                           "diffs": diffs}, f, ensure_ascii=False, indent=2, default=str)
+        return all(d.get("equal") for d in diffs.values())
+    finally:
+        for impl in impls:
+            impl.close()
+        if not keep:
+            for r in results:
+                shutil.rmtree(r["workdir"], ignore_errors=True)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Golden-output equivalence harness (FULL / Decision / Top20)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("record", help="snapshot recorded inputs from checkpoints/<day>")
+    r.add_argument("--day", required=True, help="checkpoint day (YYYYMMDD)")
+    r.add_argument("--name", default=None)
+    r.add_argument("--src", default=".")
+    r.add_argument("--golden-dir", default=GOLDEN_DIR)
+
+    x = sub.add_parser("run", help="replay baseline vs candidate and diff outputs")
+    x.add_argument("--name", required=True)
+    x.add_argument("--baseline", default="git:HEAD", help="directory or git:<ref>")
+    x.add_argument("--candidate", default=".", help="directory or git:<ref>")
+    x.add_argument("--golden-dir", default=GOLDEN_DIR)
+    x.add_argument("--atol", type=float, default=ATOL)
+    x.add_argument("--rtol", type=float, default=RTOL)
+    x.add_argument("--keep", action="store_true", help="keep temp workdirs for inspection")
+    x.add_argument("--report", default=None, help="write JSON report")
+
+    w = sub.add_parser("_worker")
+    w.add_argument("--impl", required=True)
+    w.add_argument("--golden", required=True)
+    w.add_argument("--workdir", required=True)
+
+    args = ap.parse_args(argv)
+    if args.cmd == "record":
+        print(f"golden snapshot: {record(args.day, args.name, args.src, args.golden_dir)}")
+        return 0
+    if args.cmd == "_worker":
+        _worker(args.impl, args.golden, args.workdir)
+        return 0
+    ok = run(args.name, args.baseline, args.candidate, args.golden_dir, args.atol, args.rtol, args.keep, args.report)
+    print("EQUIVALENT" if ok else "NOT EQUIVALENT")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
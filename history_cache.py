@@ -0,0 +1,310 @@
+"""
+history_cache.py  (v6.3.29-F4.8)
+
+cache_yf 的快取管理：新鮮度、容量上限、LRU / 閒置淘汰、壓實、命中統計。
+
+- 新鮮度（取代 mtime 的 .days <= CACHE_TTL_DAYS）：存檔未超過 TTL（以秒計），
+  且存檔時間晚於「應有最後一根 K 棒」那天收盤（CLOSE_TIME），且最後一根 K 棒 ≥ 該日
+  （該日之後才下載卻沒有該日 K 棒 = 休市，視為新鮮）
+- 批次庫（history_ingest.HistoryStore）index 的 used 記錄最後取用時間（每次執行一次寫回）
+- evict：閒置超過 HISTORY_CACHE_MAX_IDLE_DAYS、或總量超過 HISTORY_CACHE_MAX_MB 時依 LRU 移出 index；
+  舊版 <ticker>.pkl 已被批次庫取代或過舊即刪除；移出後磁碟仍超量只標記 needs_compact（不在執行流程內壓實）
+- compact：部分失效 / 過小的批次檔與舊版 pkl 重寫成每檔 COMPACT_TICKERS 檔標的的大批次
+  （保留原 saved / used），目錄檔案數維持在少量
+- 計數器：hits / misses / stale / evicted（同步寫入 RunMetrics 的 cache_*）
+
+    python history_cache.py stats
+    python history_cache.py evict                   # 仍超量時接著壓實
+    python history_cache.py compact                 # cron 每週一次（盤前流程不做壓實）
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+from datetime import time as dtime
+
+import pandas as pd
+
+from history_ingest import HistoryStore, from_frames
+
+MAX_BYTES = int(float(os.environ.get("HISTORY_CACHE_MAX_MB", "512")) * 1024 * 1024)
+MAX_IDLE_DAYS = float(os.environ.get("HISTORY_CACHE_MAX_IDLE_DAYS", "30"))
+COMPACT_TICKERS = int(os.environ.get("HISTORY_CACHE_COMPACT_TICKERS", "400"))
+COMPACT_MIN_LIVE = 0.5
+CLOSE_TIME = dtime(14, 0)  # 台股 13:30 收盤，保留 Yahoo 更新時間
+
+
+def expected_bar_date(now: datetime | None = None) -> date:
+    """now 時點快取應有的最後一根日 K：平日收盤後為當天，否則為前一個平日。"""
+    now = now or datetime.now()
+    d = now.date()
+    if d.weekday() < 5 and now.time() >= CLOSE_TIME:
+        return d
+    d -= timedelta(days=1)
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d
+
+
+def is_fresh(saved_ts: float, last_bar, ttl_days: float, now: datetime | None = None) -> bool:
+    now = now or datetime.now()
+    saved = datetime.fromtimestamp(saved_ts)
+    if (now - saved).total_seconds() > ttl_days * 86400:
+        return False
+    exp = expected_bar_date(now)
+    if saved < datetime.combine(exp, CLOSE_TIME):
+        return False  # 該日收盤前存的（缺該日或為盤中未完成 K 棒）
+    if last_bar is None:
+        return False
+    last = last_bar if isinstance(last_bar, date) else datetime.strptime(str(last_bar)[:10], "%Y-%m-%d").date()
+    return last >= exp or saved.date() > exp
+
+
+def _legacy_path(cache_dir: str, ticker: str) -> str:
+    return os.path.join(cache_dir, f"{ticker.replace('^', 'IDX_')}.pkl")
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class HistoryCache:
+    """download_histories 的快取入口；計數器每個實例（= 每次下載）重新計算。"""
+
+    def __init__(self, cache_dir: str = "cache_yf", ttl_days: float = 2, store: HistoryStore | None = None,
+                 max_bytes: int = MAX_BYTES, max_idle_days: float = MAX_IDLE_DAYS, incr=None):
+        self.cache_dir = cache_dir
+        self.store = store or HistoryStore(cache_dir)
+        self.ttl_days = ttl_days
+        self.max_bytes = max_bytes
+        self.max_idle_days = max_idle_days
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "evicted": 0}
+        self._incr = incr
+        self._used = []
+
+    def _count(self, key: str, n: int = 1) -> None:
+        self.counters[key] += n
+        if self._incr is not None:
+            self._incr(f"cache_{key}", n)
+
+    # ----- lookup -----
+    def lookup(self, ticker: str):
+        """(Batch, 欄位)（批次庫）/ DataFrame（舊版 pkl）/ None（未命中或過期）。"""
+        e = self.store.entries().get(ticker)
+        if e is not None:
+            if is_fresh(e["saved"], e.get("last"), self.ttl_days):
+                src = self.store.source(ticker)
+                if src is not None:
+                    self._count("hits")
+                    self._used.append(ticker)
+                    return src
+            else:
+                self._count("stale")
+            self._count("misses")
+            return None
+        path = _legacy_path(self.cache_dir, ticker)
+        if os.path.exists(path):
+            try:
+                df = pd.read_pickle(path)
+                if len(df) and is_fresh(os.path.getmtime(path), df.index[-1].date(), self.ttl_days):
+                    self._count("hits")
+                    return df
+                self._count("stale")
+            except Exception:
+                pass
+        self._count("misses")
+        return None
+
+    def touch(self) -> None:
+        """本次命中的批次庫標的更新 used（LRU 依據）；一次寫回 index。"""
+        used, self._used = self._used, []
+        if not used:
+            return
+        now = time.time()
+
+        def apply(index):
+            for t in used:
+                if t in index:
+                    index[t]["used"] = now
+
+        self.store.update_index(apply)
+
+    # ----- usage / eviction -----
+    def _legacy_files(self) -> list[str]:
+        return glob.glob(os.path.join(self.cache_dir, "*.pkl"))
+
+    def usage(self) -> dict:
+        files = glob.glob(os.path.join(self.store.root, "*.npz"))
+        legacy = self._legacy_files()
+        return {
+            "entries": len(self.store.entries()),
+            "batch_files": len(files),
+            "batch_bytes": sum(_file_size(p) for p in files),
+            "legacy_files": len(legacy),
+            "legacy_bytes": sum(_file_size(p) for p in legacy),
+        }
+
+    def _entry_bytes(self, index: dict) -> dict:
+        """每個 ticker 分攤的位元組 = 批次檔大小 / 檔內標的數。"""
+        sizes = {}
+        out = {}
+        for t, e in index.items():
+            f = e["file"]
+            if f not in sizes:
+                sizes[f] = _file_size(os.path.join(self.store.root, f))
+            out[t] = sizes[f] / max(int(e.get("n") or 1), 1)
+        return out
+
+    def evict(self, log=print) -> dict:
+        now = time.time()
+        idle_s = self.max_idle_days * 86400
+        index_now = self.store.entries()
+        removed_legacy = 0
+        for p in self._legacy_files():
+            t = os.path.splitext(os.path.basename(p))[0]
+            try:
+                old = now - os.path.getmtime(p) > idle_s
+            except OSError:
+                continue
+            if t in index_now or old:
+                try:
+                    os.remove(p)
+                    removed_legacy += 1
+                except OSError:
+                    pass
+        legacy_bytes = sum(_file_size(p) for p in self._legacy_files())
+        dropped = []
+
+        def apply(index):
+            for t in [t for t, e in index.items() if now - float(e.get("used") or e["saved"]) > idle_s]:
+                dropped.append(t)
+                del index[t]
+            sizes = self._entry_bytes(index)
+            total = sum(sizes.values()) + legacy_bytes
+            if total > self.max_bytes:
+                for t in sorted(index, key=lambda k: float(index[k].get("used") or index[k]["saved"])):
+                    if total <= self.max_bytes:
+                        break
+                    total -= sizes[t]
+                    dropped.append(t)
+                    del index[t]
+            return bool(dropped)
+
+        if index_now:
+            self.store.update_index(apply)
+        self._count("evicted", len(dropped) + removed_legacy)
+        res = {"evicted": len(dropped), "legacy_removed": removed_legacy, "needs_compact": self.needs_compact()}
+        if res["needs_compact"]:
+            log(f"[cache] over budget after eviction; run `python history_cache.py compact --cache {self.cache_dir}`")
+        return res
+
+    def needs_compact(self) -> bool:
+        """磁碟用量仍超過上限（移出 index 的標的要等壓實重寫批次檔才釋放空間）。"""
+        u = self.usage()
+        return u["batch_bytes"] + u["legacy_bytes"] > self.max_bytes
+
+    # ----- compaction -----
+    def compact(self, log=print) -> dict:
+        """部分失效 / 過小的批次檔與舊版 pkl 重寫成大批次（保留 saved / used / last）。"""
+        index = dict(self.store.entries())
+        refs = {}
+        for t, e in index.items():
+            refs.setdefault(e["file"], []).append(t)
+        sparse = [f for f, ts in refs.items() if len(ts) / max(int(index[ts[0]].get("n") or len(ts)), 1) < COMPACT_MIN_LIVE]
+        small = [f for f, ts in refs.items() if len(ts) < COMPACT_TICKERS and f not in sparse]
+        rewrite = sparse + (small if len(small) > 1 else [])
+        tickers = [t for f in rewrite for t in refs[f]]
+        legacy = [p for p in self._legacy_files()
+                  if not os.path.basename(p).startswith("IDX_") and os.path.splitext(os.path.basename(p))[0] not in index]
+        if not rewrite and not legacy:
+            return {"files_before": len(refs), "rewritten": 0, "migrated": 0}
+
+        frames, meta, expect, migrated = {}, {}, {}, []
+        for t in tickers:
+            src = self.store.source(t)
+            if src is None:
+                continue
+            frames[t] = src[0].frame(src[1])
+            meta[t] = {k: index[t][k] for k in ("saved", "used", "last") if k in index[t]}
+            expect[t] = index[t]["file"]
+        for p in legacy:
+            t = os.path.splitext(os.path.basename(p))[0]
+            try:
+                df = pd.read_pickle(p)
+            except Exception:
+                continue
+            if isinstance(df, pd.DataFrame) and len(df):
+                frames[t] = df
+                mt = os.path.getmtime(p)
+                meta[t] = {"saved": mt, "used": mt}
+                expect[t] = None
+                migrated.append(p)
+
+        written = 0
+        names = list(frames)
+        for i in range(0, len(names), COMPACT_TICKERS):
+            chunk = {t: frames[t] for t in names[i:i + COMPACT_TICKERS]}
+            try:
+                b = from_frames(chunk)
+            except Exception as e:  # 時區 / 欄位不一致：逐檔寫入
+                log(f"[cache] compact chunk failed ({e!r}); writing per ticker")
+                for t, df in chunk.items():
+                    try:
+                        written += self.store.write(from_frames({t: df}), meta=meta, expect=expect)
+                    except Exception:
+                        continue
+                continue
+            written += self.store.write(b, meta=meta, expect=expect)
+        for p in migrated:
+            t = os.path.splitext(os.path.basename(p))[0]
+            if t in self.store.entries():
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+        res = {"files_before": len(refs), "files_after": len({e["file"] for e in self.store.entries().values()}),
+               "rewritten": written, "migrated": len(migrated)}
+        log(f"[cache] compact: {res}")
+        return res
+
+    def summary(self) -> str:
+        c = self.counters
+        u = self.usage()
+        mb = (u["batch_bytes"] + u["legacy_bytes"]) / 1024 / 1024
+        return (f"history cache: hits={c['hits']} misses={c['misses']} stale={c['stale']} evicted={c['evicted']} "
+                f"size={mb:.1f}MB/{self.max_bytes / 1024 / 1024:.0f}MB files={u['batch_files'] + u['legacy_files']}")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Maintain the cache_yf history cache")
+    ap.add_argument("--cache", default="cache_yf")
+    ap.add_argument("cmd", choices=["stats", "evict", "compact"])
+    args = ap.parse_args(argv)
+    cache = HistoryCache(args.cache)
+    if args.cmd == "evict":
+        res = cache.evict()
+        print(json.dumps(res, indent=2))
+        if res["needs_compact"]:
+            cache.compact()
+    elif args.cmd == "compact":
+        cache.compact()
+    u = cache.usage()
+    idx = cache.store.entries()
+    if idx:
+        oldest = min(float(e.get("used") or e["saved"]) for e in idx.values())
+        u["oldest_used"] = datetime.fromtimestamp(oldest).strftime("%Y-%m-%d %H:%M")
+    u["max_bytes"] = cache.max_bytes
+    u["needs_compact"] = cache.needs_compact()
+    print(json.dumps(u, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,359 @@
+"""
+history_ingest.py  (v6.3.29-F4.8)
+
+yf.download 批次結果直接轉成陣列，不再逐檔 data[t].dropna(how="all") + 逐檔 pickle。
+
+- from_download：寬表（欄位 = ticker × OHLCV 的 MultiIndex）一次 reindex + reshape
+  → Batch(values: 日期 × 標的 × 欄位, valid: 日期 × 標的)；valid = 該列任一欄位有值（= dropna(how="all")）
+- Batch.tail_mean：每檔最後 n 根有效 K 棒的平均（Stage1 五日均量），整批向量化
+- HistoryStore：cache_yf/batches/<批次>.npz 一次寫入 + index.json（ticker → 檔案 / 欄位 / 存檔時間）；
+  已無任何 ticker 引用的批次檔隨即刪除（容量上限 / 淘汰 / 壓實見 history_cache.py）
+- HistoryMap：{ticker: OHLCV DataFrame} 的唯讀 Mapping，DataFrame 在第一次取用時才由陣列切出；
+  pickle（checkpoint）時只存陣列；memo=False 時不保留切出的 DataFrame
+- read_cached：批次庫 + 舊版 cache_yf/<ticker>.pkl（批次庫優先）
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+import uuid
+from collections.abc import Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+STORE_SUBDIR = "batches"
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+
+
+@dataclass(eq=False)
+class Batch:
+    dates: pd.DatetimeIndex
+    tickers: np.ndarray                # (N,) str
+    fields: tuple                      # ("Open", "High", ...)
+    values: np.ndarray                 # (T, N, F) float64
+    valid: np.ndarray                  # (T, N) bool
+    present: np.ndarray | None = None  # (N,) bool：下載結果內有此 ticker 的欄位
+    _col: dict = field(default=None, repr=False, compare=False)
+
+    @property
+    def has_data(self) -> np.ndarray:
+        return self.valid.any(axis=0)
+
+    def col(self, ticker: str) -> int:
+        if self._col is None:
+            self._col = {str(t): j for j, t in enumerate(self.tickers)}
+        return self._col[ticker]
+
+    def invalid_tickers(self) -> list[str]:
+        """有欄位但整段無資料的 ticker（原逐檔流程加入 INVALID_TICKERS 的條件）。"""
+        present = self.present if self.present is not None else np.ones(len(self.tickers), dtype=bool)
+        return [str(t) for t in self.tickers[present & ~self.has_data]]
+
+    def frame(self, j: int) -> pd.DataFrame:
+        m = self.valid[:, j]
+        return pd.DataFrame(self.values[m, j, :], index=self.dates[m], columns=list(self.fields))
+
+    def field_values(self, name: str) -> np.ndarray | None:
+        return self.values[:, :, self.fields.index(name)] if name in self.fields else None
+
+    def tail_mean(self, name: str, n: int) -> np.ndarray:
+        """每檔最後 n 根有效 K 棒上 name 欄位的平均（略過 NaN；無值為 NaN）。"""
+        v = self.field_values(name)
+        if v is None:
+            return np.full(len(self.tickers), np.nan)
+        from_end = np.cumsum(self.valid[::-1], axis=0)[::-1]
+        ok = self.valid & (from_end <= n) & ~np.isnan(v)
+        cnt = ok.sum(axis=0)
+        tot = np.where(ok, v, 0.0).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(cnt > 0, tot / cnt, np.nan)
+
+    def subset(self, cols: np.ndarray) -> "Batch":
+        """只保留 cols 欄（標的）與其有效列。"""
+        valid = self.valid[:, cols]
+        rows = valid.any(axis=1)
+        return Batch(self.dates[rows], self.tickers[cols], self.fields, self.values[rows][:, cols, :], valid[rows])
+
+
+def from_download(data: pd.DataFrame, tickers: list[str]) -> Batch:
+    """yf.download(group_by="ticker") 結果 → Batch（一次 reshape，不逐檔切 DataFrame）。"""
+    tickers = [str(t) for t in tickers]
+    if data is None or data.empty:
+        return Batch(pd.DatetimeIndex([]), np.array(tickers, dtype=str), (), np.empty((0, len(tickers), 0)),
+                     np.zeros((0, len(tickers)), dtype=bool), np.zeros(len(tickers), dtype=bool))
+    if isinstance(data.columns, pd.MultiIndex):
+        fields = tuple(dict.fromkeys(data.columns.get_level_values(1)))
+        got = set(data.columns.get_level_values(0))
+        cols = pd.MultiIndex.from_product([tickers, fields])
+        arr = data.reindex(columns=cols).to_numpy(dtype="float64").reshape(len(data), len(tickers), len(fields))
+        present = np.array([t in got for t in tickers], dtype=bool)
+    else:
+        # 單一標的時 yfinance 可能回傳一般欄位（原流程對批次內每檔套用同一張表）
+        fields = tuple(data.columns)
+        one = data.to_numpy(dtype="float64")[:, None, :]
+        arr = np.broadcast_to(one, (len(data), len(tickers), len(fields)))
+        present = np.ones(len(tickers), dtype=bool)
+    valid = ~np.isnan(arr).all(axis=2)
+    return Batch(pd.DatetimeIndex(data.index), np.array(tickers, dtype=str), fields, arr, valid, present)
+
+
+def from_frames(frames: dict) -> Batch:
+    """{ticker: OHLCV DataFrame} → Batch（日期取聯集；history_cache 壓實 / 舊版 pkl 轉入用）。"""
+    tickers = list(frames)
+    if not tickers:
+        return from_download(None, [])
+    return from_download(pd.concat(frames, axis=1, keys=tickers).sort_index(), tickers)
+
+
+# ---------------------------------------------------------------------------
+# lazy {ticker: DataFrame}
+# ---------------------------------------------------------------------------
+class HistoryMap(Mapping):
+    """
+    download_histories 的回傳值；批次來源的 DataFrame 取用時才切出（並快取）。
+    memo=False：每次取用都重新切出、不保留（串流模式只留陣列，不留 DataFrame）。
+    """
+
+    memo = True
+
+    def __init__(self, memo: bool = True):
+        self._src = {}   # ticker -> (Batch, j) | None（None = 直接加入的 DataFrame）
+        self._memo = {}  # ticker -> DataFrame
+        self.memo = memo
+
+    def add_frame(self, ticker: str, df: pd.DataFrame) -> None:
+        self._src[ticker] = None
+        self._memo[ticker] = df
+
+    def add_batch(self, batch: Batch, tickers=None) -> None:
+        cols = np.flatnonzero(batch.has_data) if tickers is None else [batch.col(t) for t in tickers]
+        for j in cols:
+            t = str(batch.tickers[j])
+            self._src[t] = (batch, int(j))
+            self._memo.pop(t, None)
+
+    def __getitem__(self, ticker):
+        if ticker in self._memo:
+            return self._memo[ticker]
+        src = self._src[ticker]  # KeyError: 不在此 map
+        df = src[0].frame(src[1])
+        if self.memo:
+            self._memo[ticker] = df
+        return df
+
+    def __iter__(self):
+        return iter(self._src)
+
+    def __len__(self):
+        return len(self._src)
+
+    def batches(self) -> list[Batch]:
+        seen = {}
+        for src in self._src.values():
+            if src is not None:
+                seen[id(src[0])] = src[0]
+        return list(seen.values())
+
+    def __getstate__(self):
+        return {"_src": self._src, "_memo": {t: df for t, df in self._memo.items() if self._src.get(t) is None},
+                "memo": self.memo}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+# ---------------------------------------------------------------------------
+# batch-file history store
+# ---------------------------------------------------------------------------
+def _encode_dates(dates: pd.DatetimeIndex) -> tuple[np.ndarray, str]:
+    tz = str(dates.tz) if dates.tz is not None else ""
+    return dates.asi8.copy(), tz
+
+
+def _decode_dates(ns: np.ndarray, tz: str, name) -> pd.DatetimeIndex:
+    idx = pd.DatetimeIndex(pd.to_datetime(ns, utc=True).tz_convert(tz)) if tz else pd.DatetimeIndex(pd.to_datetime(ns))
+    idx.name = name
+    return idx
+
+
+class HistoryStore:
+    def __init__(self, cache_dir: str = "cache_yf"):
+        self.cache_dir = cache_dir
+        self.root = os.path.join(cache_dir, STORE_SUBDIR)
+        self._index = None
+        self._index_mtime = None
+        self._batches = {}  # file -> Batch（批次檔寫入後不再變動）
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, INDEX_FILE)
+
+    @contextmanager
+    def _locked(self, wait_s: float = 10.0):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, LOCK_FILE)
+        t_end = time.time() + wait_s
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                break
+            except FileExistsError:
+                if time.time() > t_end:  # 前一個程序異常結束留下的鎖
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    t_end = time.time() + wait_s
+                    continue
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # ----- index -----
+    def entries(self) -> dict:
+        """{ticker: {"file", "col", "n", "saved", "used", "last"}}；index.json 有變動才重讀。"""
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            self._index, self._index_mtime = {}, None
+            return self._index
+        if self._index is None or mtime != self._index_mtime:
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except Exception:
+                self._index = {}
+            self._index_mtime = mtime
+            live = {e["file"] for e in self._index.values()}
+            self._batches = {k: v for k, v in self._batches.items() if k in live}
+        return self._index
+
+    def _save_index(self, index: dict) -> None:
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+    def update_index(self, fn) -> dict:
+        """鎖定後重讀 index → fn(index) 就地修改 → 寫回（fn 回傳 False 表示未變動）；不再被引用的批次檔刪除。"""
+        with self._locked():
+            self._index = None
+            index = dict(self.entries())
+            before = {e["file"] for e in index.values()}
+            if fn(index) is False:
+                return index
+            self._save_index(index)
+            self._index, self._index_mtime = index, os.path.getmtime(self.index_path)
+            # 只刪本次失去引用的檔案（其他程序剛寫出、尚未登記的批次檔不動）
+            for name in before - {e["file"] for e in index.values()}:
+                self._batches.pop(name, None)
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+        return index
+
+    # ----- write -----
+    def write(self, batch: Batch, meta: dict | None = None, expect: dict | None = None) -> int:
+        """
+        有資料的標的一次寫成一個批次檔並更新 index；回傳寫入標的數。
+        meta：{ticker: 覆寫的 index 欄位}（如沿用原 saved）；expect：{ticker: 原檔名}，
+        index 已指向其他檔案（期間被重新下載）的標的不覆蓋。
+        """
+        cols = np.flatnonzero(batch.has_data)
+        if not len(cols):
+            return 0
+        b = batch.subset(cols)
+        os.makedirs(self.root, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.npz"
+        path = os.path.join(self.root, name)
+        ns, tz = _encode_dates(b.dates)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, values=b.values, valid=b.valid, dates=ns, tz=np.array(tz),
+                     date_name=np.array(b.dates.name or ""), tickers=b.tickers.astype(str),
+                     fields=np.array(b.fields, dtype=str))
+        os.replace(path + ".tmp", path)
+        self._batches[name] = b
+
+        saved = time.time()
+        last = b.valid[::-1].argmax(axis=0)  # 由尾端數第一個有效列
+        written = []
+
+        def apply(index):
+            for j, t in enumerate(b.tickers.tolist()):
+                if expect is not None and (index.get(t) or {}).get("file") != expect.get(t):
+                    continue
+                ent = {"file": name, "col": j, "n": len(b.tickers), "saved": saved, "used": saved,
+                       "last": str(b.dates[len(b.dates) - 1 - last[j]].date())}
+                ent.update((meta or {}).get(t) or {})
+                index[t] = ent
+                written.append(t)
+
+        self.update_index(apply)
+        if not written:
+            self._batches.pop(name, None)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(written)
+
+    # ----- read -----
+    def batch(self, name: str) -> Batch:
+        if name not in self._batches:
+            with np.load(os.path.join(self.root, name), allow_pickle=False) as z:
+                dates = _decode_dates(z["dates"], str(z["tz"]), str(z["date_name"]) or None)
+                self._batches[name] = Batch(dates, z["tickers"], tuple(str(f) for f in z["fields"]),
+                                            z["values"], z["valid"])
+        return self._batches[name]
+
+    def source(self, ticker: str, fresh=None) -> tuple[Batch, int] | None:
+        """(Batch, 欄位) 或 None（不在庫內 / fresh(entry) 為 False / 批次檔讀取失敗）。"""
+        e = self.entries().get(ticker)
+        if e is None or (fresh is not None and not fresh(e)):
+            return None
+        try:
+            return self.batch(e["file"]), int(e["col"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def load(self, tickers=None, fresh=None) -> HistoryMap:
+        """tickers=None 全部；fresh(entry) 為 False 的項目略過（呼叫端自行重新下載）。"""
+        out = HistoryMap()
+        for t in list(self.entries()) if tickers is None else tickers:
+            src = self.source(t, fresh)
+            if src is not None:
+                out.add_batch(src[0], [t])
+        return out
+
+
+def read_cached(cache_dir: str = "cache_yf", tickers=None) -> dict[str, pd.DataFrame]:
+    """批次庫 + 舊版 <ticker>.pkl；同一 ticker 以批次庫為準。"""
+    import glob
+
+    out = dict(HistoryStore(cache_dir).load(tickers).items())
+    if tickers is None:
+        pairs = [(os.path.splitext(os.path.basename(p))[0], p) for p in sorted(glob.glob(os.path.join(cache_dir, "*.pkl")))]
+    else:
+        pairs = [(t, os.path.join(cache_dir, f"{t.replace('^', 'IDX_')}.pkl")) for t in tickers]
+    for t, p in pairs:
+        if t in out or not os.path.exists(p):
+            continue
+        try:
+            df = pd.read_pickle(p)
+        except Exception:
+            continue
+        if isinstance(df, pd.DataFrame):
+            out[t] = df
+    return out
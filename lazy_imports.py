@@ -0,0 +1,88 @@
+"""
+lazy_imports.py  (v6.3.29-F4.8)
+
+延遲匯入（加速入口腳本啟動）：
+- lazy_module("yfinance")：第一次取屬性時才 import；之後把模組屬性複製到 proxy 上，
+  熱迴圈中的 pd.to_numeric / yf.download 不再經過 __getattr__
+- LazyObject(factory)：第一次使用時才建立物件（例如 requests.Session）
+
+`python daily_auto_run_final.py --help`、重放執行、Top20 重產不再先付 yfinance / requests /
+pandas / openpyxl 的 import 成本。量測：python benchmark_suite.py --startup
+"""
+from __future__ import annotations
+
+import importlib
+import threading
+import types
+
+_LOCK = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name: str, on_load=None):
+        super().__init__(name)
+        self.__dict__["_lazy_name"] = name
+        self.__dict__["_lazy_on_load"] = on_load
+        self.__dict__["_lazy_mod"] = None
+
+    def _lazy_load(self):
+        with _LOCK:
+            mod = self.__dict__["_lazy_mod"]
+            if mod is None:
+                mod = importlib.import_module(self.__dict__["_lazy_name"])
+                self.__dict__.update(mod.__dict__)
+                self.__dict__["_lazy_mod"] = mod
+                cb = self.__dict__["_lazy_on_load"]
+                if cb is not None:
+                    cb(mod)
+            return mod
+
+    def __getattr__(self, attr: str):
+        if attr.startswith("_lazy_"):
+            raise AttributeError(attr)
+        return getattr(self._lazy_load(), attr)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_mod"] is not None else "not loaded"
+        return f"<lazy module {self.__dict__['_lazy_name']!r} ({state})>"
+
+
+def lazy_module(name: str, on_load=None) -> LazyModule:
+    return LazyModule(name, on_load=on_load)
+
+
+def is_loaded(obj) -> bool:
+    if isinstance(obj, LazyModule):
+        return obj.__dict__["_lazy_mod"] is not None
+    if isinstance(obj, LazyObject):
+        return object.__getattribute__(obj, "_obj") is not None
+    return True
+
+
+class LazyObject:
+    """第一次存取屬性時呼叫 factory() 建立實體，之後轉發所有屬性存取。"""
+
+    __slots__ = ("_factory", "_obj")
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_obj", None)
+
+    def _get(self):
+        obj = object.__getattribute__(self, "_obj")
+        if obj is None:
+            with _LOCK:
+                obj = object.__getattribute__(self, "_obj")
+                if obj is None:
+                    obj = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_obj", obj)
+        return obj
+
+    def __getattr__(self, attr: str):
+        return getattr(self._get(), attr)
+
+    def __setattr__(self, attr: str, value) -> None:
+        setattr(self._get(), attr, value)
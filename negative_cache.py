@@ -0,0 +1,135 @@
+"""
+negative_cache.py  (v6.3.29-F4.8)
+
+無資料 / 已下市 ticker 的持久化負快取（cache/negative_tickers.json）。
+Stage1（prefilter_by_liquidity）與 Stage2（download_histories）分批前先排除，
+不再每天占用 Yahoo 批次名額與限流額度。
+
+- 下載結果整段無資料 → 記一次失敗；第 k 次失敗後隔 min(NEG_CACHE_BASE_DAYS × 2^(k-1), NEG_CACHE_MAX_DAYS)
+  個交易日（平日）才重新探測
+- 重新探測有資料 → 立即移除
+- 單一批次無資料比例 > NEG_CACHE_MAX_BATCH_FAIL（多半是限流）時該批失敗不記錄
+- 最後一次失敗超過 NEG_CACHE_TTL_DAYS 天的項目丟棄（之後視同未知 ticker）
+- NEG_CACHE=0 停用
+
+    python negative_cache.py list
+    python negative_cache.py clear [TICKER ...]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from datetime import date, datetime, timedelta
+
+CACHE_PATH = os.environ.get("NEG_CACHE_PATH", os.path.join("cache", "negative_tickers.json"))
+BASE_DAYS = int(os.environ.get("NEG_CACHE_BASE_DAYS", "2"))
+MAX_DAYS = int(os.environ.get("NEG_CACHE_MAX_DAYS", "20"))
+TTL_DAYS = int(os.environ.get("NEG_CACHE_TTL_DAYS", "90"))
+MAX_BATCH_FAIL = float(os.environ.get("NEG_CACHE_MAX_BATCH_FAIL", "0.5"))
+
+
+def add_trading_days(d: date, n: int) -> date:
+    """d 之後第 n 個平日（不含國定假日；重新探測時間只需大致正確）。"""
+    while n > 0:
+        d += timedelta(days=1)
+        if d.weekday() < 5:
+            n -= 1
+    return d
+
+
+def retry_interval(fails: int) -> int:
+    return min(BASE_DAYS * 2 ** max(fails - 1, 0), MAX_DAYS)
+
+
+class NegativeCache:
+    def __init__(self, path: str = CACHE_PATH, today: date | None = None):
+        self.path = path
+        self.today = today or date.today()
+        self.entries = {}
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except Exception:
+            self.entries = {}
+        cutoff = str(self.today - timedelta(days=TTL_DAYS))
+        expired = [t for t, e in self.entries.items() if e.get("last", "") < cutoff]
+        for t in expired:
+            del self.entries[t]
+        self._dirty = bool(expired)
+
+    def blocked(self, ticker: str) -> bool:
+        e = self.entries.get(ticker)
+        return e is not None and str(self.today) < e["retry_after"]
+
+    def split(self, tickers: list[str]) -> tuple[list[str], list[str]]:
+        """(要下載的, 排除的)；順序不變。"""
+        keep, skip = [], []
+        for t in tickers:
+            (skip if self.blocked(t) else keep).append(t)
+        return keep, skip
+
+    def record(self, failed=(), ok=()) -> None:
+        today = str(self.today)
+        for t in failed:
+            e = self.entries.get(t) or {"first": today, "fails": 0}
+            if e.get("last") == today:
+                continue  # 同日 Stage1 / Stage2 重複失敗只算一次
+            e["fails"] = int(e["fails"]) + 1
+            e["last"] = today
+            e["retry_after"] = str(add_trading_days(self.today, retry_interval(e["fails"])))
+            self.entries[t] = e
+            self._dirty = True
+        for t in ok:
+            if self.entries.pop(t, None) is not None:
+                self._dirty = True
+
+    def record_batch(self, failed: list[str], ok: list[str]) -> bool:
+        """
+        一個下載批次的結果；無資料比例超過 NEG_CACHE_MAX_BATCH_FAIL 多半是限流 / Yahoo 異常，
+        只記成功、不記失敗。回傳是否記錄了失敗。
+        """
+        n = len(failed) + len(ok)
+        suspicious = n > 0 and len(failed) / n > MAX_BATCH_FAIL
+        self.record(() if suspicious else failed, ok)
+        return not suspicious
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Inspect / clear the persisted negative ticker cache")
+    ap.add_argument("--path", default=CACHE_PATH)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list")
+    c = sub.add_parser("clear")
+    c.add_argument("tickers", nargs="*", help="default: all")
+    args = ap.parse_args(argv)
+
+    nc = NegativeCache(args.path)
+    if args.cmd == "list":
+        for t, e in sorted(nc.entries.items(), key=lambda kv: kv[1]["retry_after"]):
+            state = "blocked" if nc.blocked(t) else "retry"
+            print(f"{t:<12} fails={e['fails']:<3} last={e['last']} retry_after={e['retry_after']} ({state})")
+        print(f"{len(nc.entries)} ticker(s), {sum(nc.blocked(t) for t in nc.entries)} blocked as of {nc.today}")
+        return 0
+    drop = args.tickers or list(nc.entries)
+    for t in drop:
+        nc.entries.pop(t, None)
+    nc._dirty = True
+    nc.save()
+    print(f"cleared {len(drop)} ticker(s) at {datetime.now():%Y-%m-%d %H:%M:%S}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
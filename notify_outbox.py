@@ -0,0 +1,280 @@
+"""
+notify_outbox.py  (v6.3.29-F4.8)
+
+非阻塞寄信：執行流程只把信件記錄寫進本機佇列，另由 drain 寄出（重試 + 指數退避）。
+
+    outbox/pending/<id>.json   待寄（含 attempts / next_attempt / last_error）
+    outbox/sending/<id>.json   drain 處理中（rename 即取得，多個 drain 不會重複寄；mtime = 取得時間）
+                               超過 OUTBOX_CLAIM_STALE_S 仍在此（drain 被終止 / 重開機）→ 下次 drain 移回 pending
+    outbox/sent/<id>.json      已寄出
+    outbox/failed/<id>.json    超過 OUTBOX_MAX_ATTEMPTS 或附件遺失
+
+    python notify_outbox.py drain                    # 寄出到期的信件（cron 可每 10 分鐘一次）
+    python notify_outbox.py drain --until-empty      # 持續重試直到佇列清空或 --max-wait 秒
+    python notify_outbox.py status
+
+SMTP 設定（環境變數）：
+    SMTP_HOST=smtp.gmail.com  SMTP_PORT=465  SMTP_SSL=1  SMTP_LOGIN=1
+    SMTP_USER（預設寄件者）  SMTP_PASSWORD_ENV=GMAIL_APP_PASSWORD（密碼所在的環境變數名稱）
+本機測試：python -m aiosmtpd -n -l localhost:1025 並設 SMTP_HOST=localhost SMTP_PORT=1025 SMTP_SSL=0 SMTP_LOGIN=0
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import mimetypes
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+
+OUTBOX_DIR = os.environ.get("OUTBOX_DIR", "outbox")
+MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "6"))
+BACKOFF_BASE_S = float(os.environ.get("OUTBOX_BACKOFF_S", "60"))
+BACKOFF_MAX_S = float(os.environ.get("OUTBOX_BACKOFF_MAX_S", "3600"))
+CLAIM_STALE_S = float(os.environ.get("OUTBOX_CLAIM_STALE_S", "900"))
+STATES = ("pending", "sending", "sent", "failed")
+
+XLSX_TYPE = ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+
+def smtp_settings() -> dict:
+    return {
+        "host": os.environ.get("SMTP_HOST", "smtp.gmail.com"),
+        "port": int(os.environ.get("SMTP_PORT", "465")),
+        "ssl": os.environ.get("SMTP_SSL", "1").strip() != "0",
+        "login": os.environ.get("SMTP_LOGIN", "1").strip() != "0",
+        "user": os.environ.get("SMTP_USER", "").strip() or None,
+        "password_env": os.environ.get("SMTP_PASSWORD_ENV", "GMAIL_APP_PASSWORD"),
+        "timeout": float(os.environ.get("SMTP_TIMEOUT", "30")),
+    }
+
+
+def _dir(state: str, root: str = OUTBOX_DIR) -> str:
+    p = os.path.join(root, state)
+    os.makedirs(p, exist_ok=True)
+    return p
+
+
+def _write(path: str, rec: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(rec, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _read(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def enqueue(to: str, subject: str, body: str, attachments: list[str] | None = None, sender: str | None = None,
+            root: str = OUTBOX_DIR) -> str:
+    """寫入 pending；回傳訊息 id。附件以絕對路徑記錄（寄出時才讀檔）。"""
+    mid = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:8]
+    rec = {
+        "id": mid,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "from": sender,
+        "to": to,
+        "subject": subject,
+        "body": body,
+        "attachments": [os.path.abspath(p) for p in (attachments or [])],
+        "attempts": 0,
+        "next_attempt": 0.0,
+        "last_error": None,
+    }
+    _write(os.path.join(_dir("pending", root), f"{mid}.json"), rec)
+    return mid
+
+
+def build_message(rec: dict, sender: str):
+    from email.message import EmailMessage
+
+    msg = EmailMessage()
+    msg["Subject"] = rec["subject"]
+    msg["From"] = rec.get("from") or sender
+    msg["To"] = rec["to"]
+    msg.set_content(rec.get("body") or "")
+    for p in rec.get("attachments") or []:
+        with open(p, "rb") as f:
+            data = f.read()
+        if p.lower().endswith(".xlsx"):
+            maintype, subtype = XLSX_TYPE
+        else:
+            ctype = mimetypes.guess_type(p)[0] or "application/octet-stream"
+            maintype, subtype = ctype.split("/", 1)
+        msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=os.path.basename(p))
+    return msg
+
+
+def send_message(msg, settings: dict | None = None) -> None:
+    """同步寄出一封（drain 與手動寄信共用）。"""
+    import smtplib
+
+    cfg = settings or smtp_settings()
+    cls = smtplib.SMTP_SSL if cfg["ssl"] else smtplib.SMTP
+    with cls(cfg["host"], cfg["port"], timeout=cfg["timeout"]) as smtp:
+        if cfg["login"]:
+            pw = os.environ.get(cfg["password_env"], "").strip()
+            if not pw:
+                raise RuntimeError(f"Missing SMTP password env var: {cfg['password_env']}")
+            smtp.login(cfg["user"] or msg["From"], pw)
+        smtp.send_message(msg)
+
+
+def _backoff(attempts: int) -> float:
+    return min(BACKOFF_BASE_S * (2 ** max(attempts - 1, 0)), BACKOFF_MAX_S)
+
+
+def reclaim_stale(root: str = OUTBOX_DIR, stale_s: float | None = None, log=print) -> int:
+    """
+    sending/ 內取得後超過 stale_s 秒的紀錄移回 pending（drain 中途被終止）；回傳件數。
+    門檻至少 SMTP timeout + 60 秒，避免搶走仍在寄送中的信。被終止的 drain 可能已寄出 → 至多重複一封。
+    """
+    stale_s = max(CLAIM_STALE_S if stale_s is None else stale_s, smtp_settings()["timeout"] + 60.0)
+    n = 0
+    now = time.time()
+    for name in os.listdir(_dir("sending", root)):
+        if not name.endswith(".json"):
+            continue
+        src = os.path.join(root, "sending", name)
+        try:
+            if now - os.path.getmtime(src) < stale_s:
+                continue
+            os.rename(src, os.path.join(_dir("pending", root), name))
+        except OSError:
+            continue
+        n += 1
+        log(f"[outbox] {name[:-5]}: stale claim in sending/ returned to pending")
+    return n
+
+
+def drain(sender: str | None = None, root: str = OUTBOX_DIR, settings: dict | None = None, log=print) -> dict:
+    """寄出所有到期的 pending（先回收逾時的 sending）；回傳 {"sent", "retry", "failed", "pending"}。"""
+    cfg = settings or smtp_settings()
+    sender = sender or cfg["user"] or ""
+    res = {"sent": 0, "retry": 0, "failed": 0, "pending": 0}
+    reclaim_stale(root, log=log)
+    now = time.time()
+    for name in sorted(os.listdir(_dir("pending", root))):
+        if not name.endswith(".json"):
+            continue
+        src = os.path.join(root, "pending", name)
+        try:
+            if _read(src).get("next_attempt", 0) > now:
+                res["pending"] += 1
+                continue
+            claimed = os.path.join(_dir("sending", root), name)
+            os.rename(src, claimed)  # 另一個 drain 已取走 → FileNotFoundError
+            os.utime(claimed)  # 取得時間（rename 保留舊 mtime）
+            rec = _read(claimed)
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+        rec["attempts"] = int(rec.get("attempts", 0)) + 1
+        missing = [p for p in rec.get("attachments") or [] if not os.path.exists(p)]
+        try:
+            if missing:
+                raise FileNotFoundError(f"attachment(s) missing: {missing}")
+            send_message(build_message(rec, sender), cfg)
+        except Exception as e:
+            rec["last_error"] = repr(e)
+            if missing or rec["attempts"] >= MAX_ATTEMPTS:
+                _write(os.path.join(_dir("failed", root), name), rec)
+                res["failed"] += 1
+                log(f"[outbox] {rec['id']}: failed permanently after {rec['attempts']} attempt(s): {e!r}")
+            else:
+                rec["next_attempt"] = time.time() + _backoff(rec["attempts"])
+                _write(os.path.join(_dir("pending", root), name), rec)
+                res["retry"] += 1
+                log(f"[outbox] {rec['id']}: attempt {rec['attempts']} failed ({e!r}); "
+                    f"retry in {_backoff(rec['attempts']):.0f}s")
+        else:
+            rec["sent"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            rec["last_error"] = None
+            _write(os.path.join(_dir("sent", root), name), rec)
+            res["sent"] += 1
+            log(f"[outbox] {rec['id']}: sent to {rec['to']} ({rec['subject']})")
+        finally:
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+    return res
+
+
+def next_due(root: str = OUTBOX_DIR) -> float | None:
+    due = []
+    for name in os.listdir(_dir("pending", root)):
+        if name.endswith(".json"):
+            try:
+                due.append(float(_read(os.path.join(root, "pending", name)).get("next_attempt", 0)))
+            except Exception:
+                continue
+    return min(due) if due else None
+
+
+def drain_until_empty(max_wait: float = 3 * 3600, root: str = OUTBOX_DIR, sender: str | None = None, log=print) -> dict:
+    """重複 drain，等待下一封到期，直到 pending 清空或超過 max_wait 秒。"""
+    t_end = time.time() + max_wait
+    total = {"sent": 0, "retry": 0, "failed": 0, "pending": 0}
+    while True:
+        r = drain(sender=sender, root=root, log=log)
+        for k in ("sent", "retry", "failed"):
+            total[k] += r[k]
+        due = next_due(root)
+        if due is None:
+            total["pending"] = 0
+            return total
+        if due > t_end:
+            total["pending"] = len([n for n in os.listdir(_dir("pending", root)) if n.endswith(".json")])
+            return total
+        time.sleep(max(due - time.time(), 0.5))
+
+
+def spawn_drain(root: str = OUTBOX_DIR, sender: str | None = None) -> bool:
+    """背景啟動 drain --until-empty（不等待；執行流程結束時間不受 SMTP 影響）。"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--root", root, "drain", "--until-empty"]
+    if sender:
+        cmd += ["--sender", sender]
+    try:
+        log_path = os.path.join(_dir("", root), "drain.log")
+        with open(log_path, "a", encoding="utf-8") as out:
+            kw = {"start_new_session": True} if os.name != "nt" else {"creationflags": 0x00000008}  # DETACHED_PROCESS
+            subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, **kw)
+        return True
+    except Exception:
+        return False
+
+
+def status(root: str = OUTBOX_DIR) -> dict:
+    return {s: len([n for n in os.listdir(_dir(s, root)) if n.endswith(".json")]) for s in STATES}
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Email outbox: drain queued notifications with retries")
+    ap.add_argument("--root", default=OUTBOX_DIR)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    d = sub.add_parser("drain")
+    d.add_argument("--until-empty", action="store_true")
+    d.add_argument("--max-wait", type=float, default=3 * 3600, help="seconds (with --until-empty)")
+    d.add_argument("--sender", default=None)
+    sub.add_parser("status")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "status":
+        print(json.dumps(status(args.root), indent=2))
+        return 0
+    stamp = lambda m: print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {m}", flush=True)  # noqa: E731
+    if args.until_empty:
+        res = drain_until_empty(args.max_wait, root=args.root, sender=args.sender, log=stamp)
+    else:
+        res = drain(sender=args.sender, root=args.root, log=stamp)
+    stamp(f"[outbox] drain: {res}")
+    return 0 if res["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,322 @@
+"""
+output_warehouse.py  (v6.3.29-F4.8)
+
+每日輸出（FULL / DECISION / TOP20）累積到本機 SQLite 倉庫 daily_excel_records/warehouse.sqlite：
+- outputs：每個 (run_date, kind) 一列（檔名 / 列數 / 檔案 mtime）→ pick_latest_full 改為索引查詢
+- rows   ：每列一筆；常用欄位（ticker / symbol / market / strategy / 綜合分數 / 進場價 ...）獨立成欄並建索引，
+           完整列（sidecar_io.typed_frame 定型後）以 JSON 保存，load_table 可原樣還原
+- 同日重跑：先刪後寫（以最後一次為準）
+
+    python output_warehouse.py backfill                 # 一次性匯入既有 xlsx（已匯入且 mtime 未變者略過）
+    python output_warehouse.py appearances 2330 --days 60
+    python output_warehouse.py top --days 60 --kind DECISION
+
+--days 為最近 N 個執行日（不是日曆天）。
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+WAREHOUSE_FILE = "warehouse.sqlite"
+KINDS = ("FULL", "DECISION", "TOP20")
+
+# 檔名規則（daily_auto_run_final / export_top20）
+FILE_PATTERNS = {
+    "FULL": re.compile(r"^(\d{4}-\d{2}-\d{2})_stock_selection\.xlsx$"),
+    "DECISION": re.compile(r"^(\d{4}-\d{2}-\d{2})_stock_selection_決策8欄\.xlsx$"),
+    "TOP20": re.compile(r"^(\d{4}-\d{2}-\d{2})_Top20_推薦清單\.xlsx$"),
+}
+
+FILE_TEMPLATES = {
+    "FULL": "{}_stock_selection.xlsx",
+    "DECISION": "{}_stock_selection_決策8欄.xlsx",
+    "TOP20": "{}_Top20_推薦清單.xlsx",
+}
+# latest_file 的新鮮度檢查：逐日 stat 索引日期之後的預期檔名；落後超過此天數直接回退 glob
+STALE_CHECK_MAX_DAYS = 31
+
+# 索引欄位：第一個存在的來源欄（中文顯示欄優先，英文內部欄為備援）
+KEY_COLUMNS = {
+    "ticker": ("Yahoo代碼", "ticker"),
+    "symbol": ("股票代號", "symbol"),
+    "name": ("股票名稱", "name_zh"),
+    "market": ("市場", "market"),
+    "strategy": ("策略代碼", "strategy"),
+    "strategy_desc": ("策略說明", "strategy_desc"),
+    "entry_date": ("進場日期", "entry_date"),
+    "entry_price": ("進場價", "entry_price"),
+    "stop_loss_price": ("停損價", "stop_loss_price"),
+    "score": ("綜合分數", "final_score"),
+    "position_size": ("建議部位(元)", "position_size"),
+}
+NUMERIC_KEYS = ("entry_price", "stop_loss_price", "score", "position_size")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    run_date   TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    file       TEXT,
+    rows       INTEGER,
+    file_mtime REAL,
+    imported   TEXT,
+    PRIMARY KEY (run_date, kind)
+);
+CREATE TABLE IF NOT EXISTS rows (
+    run_date        TEXT NOT NULL,
+    kind            TEXT NOT NULL,
+    row_no          INTEGER NOT NULL,
+    ticker          TEXT,
+    symbol          TEXT,
+    name            TEXT,
+    market          TEXT,
+    strategy        TEXT,
+    strategy_desc   TEXT,
+    entry_date      TEXT,
+    entry_price     REAL,
+    stop_loss_price REAL,
+    score           REAL,
+    position_size   REAL,
+    data            TEXT,
+    PRIMARY KEY (run_date, kind, row_no)
+);
+CREATE INDEX IF NOT EXISTS ix_rows_ticker ON rows (ticker, run_date);
+CREATE INDEX IF NOT EXISTS ix_rows_symbol ON rows (symbol, run_date);
+CREATE INDEX IF NOT EXISTS ix_rows_strategy ON rows (strategy, run_date);
+CREATE INDEX IF NOT EXISTS ix_rows_kind_date ON rows (kind, run_date);
+CREATE INDEX IF NOT EXISTS ix_outputs_kind_date ON outputs (kind, run_date);
+"""
+
+
+def warehouse_path(records_dir: str) -> str:
+    return os.environ.get("WAREHOUSE_PATH", "").strip() or os.path.join(records_dir, WAREHOUSE_FILE)
+
+
+def connect(records_dir: str) -> sqlite3.Connection:
+    con = sqlite3.connect(warehouse_path(records_dir))
+    con.executescript(SCHEMA)
+    return con
+
+
+def _key_frame(df: pd.DataFrame) -> pd.DataFrame:
+    out = pd.DataFrame(index=df.index)
+    for key, sources in KEY_COLUMNS.items():
+        src = next((c for c in sources if c in df.columns), None)
+        s = df[src] if src is not None else pd.Series(None, index=df.index, dtype=object)
+        if key in NUMERIC_KEYS:
+            out[key] = pd.to_numeric(s, errors="coerce")
+        else:
+            out[key] = s.map(lambda v: None if v is None or (not isinstance(v, str) and pd.isna(v)) or str(v).strip() in ("", "N/A") else str(v))
+    # 決策 / Top20 沒有股票代號欄：由 Yahoo 代碼推得
+    miss = out["symbol"].isna() & out["ticker"].notna()
+    out.loc[miss, "symbol"] = out.loc[miss, "ticker"].map(lambda t: t.split(".")[0])
+    return out
+
+
+def _json_rows(df: pd.DataFrame) -> list[str]:
+    from sidecar_io import typed_frame
+
+    tdf = typed_frame(df).astype(object)
+    tdf = tdf.where(tdf.notna(), None)
+    return [json.dumps(r, ensure_ascii=False, default=str) for r in tdf.to_dict("records")]
+
+
+def append(records_dir: str, run_date: str, tables: dict, con: sqlite3.Connection | None = None) -> dict:
+    """
+    tables: {"FULL": (df, xlsx_path), "DECISION": (df, xlsx_path), "TOP20": (df, xlsx_path)}
+    回傳 {kind: 寫入列數}。同一 (run_date, kind) 先刪後寫。
+    """
+    own = con is None
+    con = con or connect(records_dir)
+    out = {}
+    try:
+        with con:
+            for kind, (df, path) in tables.items():
+                if df is None:
+                    continue
+                df = df.reset_index(drop=True)
+                keys = _key_frame(df)
+                data = _json_rows(df)
+                con.execute("DELETE FROM rows WHERE run_date=? AND kind=?", (run_date, kind))
+                con.executemany(
+                    "INSERT INTO rows (run_date, kind, row_no, " + ", ".join(KEY_COLUMNS) + ", data) "
+                    "VALUES (?,?,?," + ",".join("?" * len(KEY_COLUMNS)) + ",?)",
+                    [(run_date, kind, i, *(None if pd.isna(v) else v for v in kv), d)
+                     for i, (kv, d) in enumerate(zip(keys.itertuples(index=False, name=None), data))],
+                )
+                try:
+                    mtime = os.path.getmtime(path) if path else None
+                except OSError:
+                    mtime = None
+                con.execute(
+                    "INSERT OR REPLACE INTO outputs (run_date, kind, file, rows, file_mtime, imported) VALUES (?,?,?,?,?,?)",
+                    (run_date, kind, os.path.basename(path) if path else None, len(df), mtime,
+                     datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                out[kind] = len(df)
+            # 決策 / Top20 只有策略說明：以同日 FULL 的策略代碼補上
+            con.execute(
+                "UPDATE rows SET strategy = (SELECT f.strategy FROM rows f WHERE f.run_date = rows.run_date "
+                "AND f.kind = 'FULL' AND f.ticker = rows.ticker AND f.strategy IS NOT NULL LIMIT 1) "
+                "WHERE run_date = ? AND kind != 'FULL' AND strategy IS NULL", (run_date,))
+    finally:
+        if own:
+            con.close()
+    return out
+
+
+def scan_records(records_dir: str) -> list[tuple[str, str, str]]:
+    """records_dir 內的每日輸出 → [(run_date, kind, path)]（依日期排序）。"""
+    found = []
+    for p in glob.glob(os.path.join(records_dir, "*.xlsx")):
+        name = os.path.basename(p)
+        for kind, pat in FILE_PATTERNS.items():
+            m = pat.match(name)
+            if m:
+                found.append((m.group(1), kind, p))
+                break
+    return sorted(found, key=lambda x: (x[0], KINDS.index(x[1])))
+
+
+def backfill(records_dir: str, force: bool = False, log=print) -> int:
+    """一次性匯入既有 xlsx（有 sidecar 時讀 sidecar）；已匯入且 mtime 未變者略過。回傳匯入檔案數。"""
+    from sidecar_io import load_sidecar
+
+    n = 0
+    with connect(records_dir) as con:
+        done = {(d, k): (f, m) for d, k, f, m in con.execute("SELECT run_date, kind, file, file_mtime FROM outputs")}
+        for run_date, kind, path in scan_records(records_dir):
+            prev = done.get((run_date, kind))
+            if not force and prev and prev[0] == os.path.basename(path) and prev[1] == os.path.getmtime(path):
+                continue
+            df = load_sidecar(records_dir, run_date, kind) if kind != "TOP20" else None
+            if df is None:
+                try:
+                    df = pd.read_excel(path)
+                except Exception as e:
+                    log(f"[warehouse] skip {os.path.basename(path)}: {e!r}")
+                    continue
+            append(records_dir, run_date, {kind: (df, path)}, con=con)
+            n += 1
+    log(f"[warehouse] backfill: {n} file(s) imported into {warehouse_path(records_dir)}")
+    return n
+
+
+# ---------------------------------------------------------------------------
+# query API
+# ---------------------------------------------------------------------------
+def query(records_dir: str, sql: str, params: tuple = ()) -> pd.DataFrame:
+    with connect(records_dir) as con:
+        return pd.read_sql_query(sql, con, params=params)
+
+
+def latest_file(records_dir: str, kind: str = "FULL", run_date: str | None = None) -> str | None:
+    """
+    (kind, run_date) 索引查詢；run_date 未指定時取最新一日。
+    回傳 None（呼叫端回退 glob）：沒有倉庫、指定日期不在索引內、或磁碟上有比索引更新的檔案
+    （例如倉庫寫入失敗、檔案由其他程序產生）。
+    """
+    if not os.path.exists(warehouse_path(records_dir)):
+        return None
+    with connect(records_dir) as con:
+        if run_date:
+            row = con.execute("SELECT run_date, file FROM outputs WHERE kind=? AND run_date=?",
+                              (kind, run_date)).fetchone()
+        else:
+            row = con.execute("SELECT run_date, file FROM outputs WHERE kind=? ORDER BY run_date DESC LIMIT 1",
+                              (kind,)).fetchone()
+    if not row or not row[1]:
+        return None
+    if not run_date and _newer_on_disk(records_dir, kind, row[0]):
+        return None
+    return os.path.join(records_dir, row[1])
+
+
+def _newer_on_disk(records_dir: str, kind: str, indexed_date: str) -> bool:
+    """索引日期之後（到今天）是否有該 kind 的檔案；只 stat 預期檔名，不 glob 整個目錄。"""
+    tmpl = FILE_TEMPLATES.get(kind)
+    try:
+        d = date.fromisoformat(indexed_date)
+    except (TypeError, ValueError):
+        return True
+    today = date.today()
+    if tmpl is None or (today - d).days > STALE_CHECK_MAX_DAYS:
+        return True
+    while d < today:
+        d += timedelta(days=1)
+        if os.path.exists(os.path.join(records_dir, tmpl.format(d.isoformat()))):
+            return True
+    return False
+
+
+def load_table(records_dir: str, run_date: str, kind: str = "FULL") -> pd.DataFrame | None:
+    """還原某日的完整輸出表（欄位與順序同寫入時）。"""
+    with connect(records_dir) as con:
+        data = [r[0] for r in con.execute(
+            "SELECT data FROM rows WHERE run_date=? AND kind=? ORDER BY row_no", (run_date, kind))]
+    if not data:
+        return None
+    return pd.DataFrame([json.loads(d) for d in data])
+
+
+def _recent_dates(days: int | None, kind: str) -> tuple[str, tuple]:
+    if not days:
+        return "", ()
+    return (" AND run_date IN (SELECT run_date FROM outputs WHERE kind = ? ORDER BY run_date DESC LIMIT ?)",
+            (kind, int(days)))
+
+
+def appearances(records_dir: str, code: str, days: int | None = 60, kind: str = "FULL") -> pd.DataFrame:
+    """某檔（Yahoo 代碼或股票代號）最近 N 個執行日的出現紀錄。"""
+    clause, params = _recent_dates(days, kind)
+    col = "ticker" if "." in code else "symbol"
+    sql = (f"SELECT run_date, ticker, name, strategy, score, entry_price, stop_loss_price, position_size "
+           f"FROM rows WHERE {col} = ? AND kind = ?{clause} ORDER BY run_date, row_no")
+    return query(records_dir, sql, (code, kind) + params)
+
+
+def top_appearances(records_dir: str, days: int | None = 60, kind: str = "FULL", limit: int = 30) -> pd.DataFrame:
+    """最近 N 個執行日出現次數最多的標的。"""
+    clause, params = _recent_dates(days, kind)
+    sql = (f"SELECT ticker, MAX(name) AS name, COUNT(DISTINCT run_date) AS days, MIN(run_date) AS first_seen, "
+           f"MAX(run_date) AS last_seen, ROUND(AVG(score), 2) AS avg_score, GROUP_CONCAT(DISTINCT strategy) AS strategies "
+           f"FROM rows WHERE kind = ?{clause} GROUP BY ticker ORDER BY days DESC, last_seen DESC LIMIT ?")
+    return query(records_dir, sql, (kind,) + params + (int(limit),))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Local warehouse of daily FULL / DECISION / TOP20 outputs")
+    ap.add_argument("--records", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "daily_excel_records"))
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("backfill")
+    b.add_argument("--force", action="store_true")
+    a = sub.add_parser("appearances")
+    a.add_argument("code")
+    a.add_argument("--days", type=int, default=60)
+    a.add_argument("--kind", default="FULL", choices=KINDS)
+    t = sub.add_parser("top")
+    t.add_argument("--days", type=int, default=60)
+    t.add_argument("--kind", default="FULL", choices=KINDS)
+    t.add_argument("--limit", type=int, default=30)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "backfill":
+        backfill(args.records, force=args.force)
+        return 0
+    if args.cmd == "appearances":
+        df = appearances(args.records, args.code, days=args.days, kind=args.kind)
+    else:
+        df = top_appearances(args.records, days=args.days, kind=args.kind, limit=args.limit)
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(df.to_string(index=False) if len(df) else "(no rows)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
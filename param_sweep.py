@@ -0,0 +1,252 @@
+"""
+param_sweep.py  (v6.3.29-F4.8)
+
+策略門檻參數掃描（取代「改常數 → 重跑」）：
+- 歷史面板 + 指標只算一次（backtest_engine.build_panel / indicators_for；特徵庫完整時直接讀取）
+- 指標陣列放進 multiprocessing.shared_memory，worker 以 ndarray view 直接讀，不複製面板
+- 每組門檻：compute_signals + simulate + summarize → 候選數、最新交易日候選數、各策略回測統計
+- 輸出 param_sweep_<ts>.xlsx（Sweep：每組一列；ByStrategy：每組 × 策略）
+
+    python param_sweep.py --grid th_bias_mean_revert=-5,-6,-7 --grid th_bias_deep=-8:-11:-1 --workers 4
+    python param_sweep.py --grid-file sweep.json      # {"th_bias_mean_revert": [-5, -6], ...}
+
+可掃描的鍵：backtest_engine.DEFAULT_PARAMS（th_* / min_avg_volume / hold_days / cost_pct / slot_frac）。
+th_bias_deep 高於 th_bias_mean_revert 的組合會略過（深度乖離必須更深）。
+SQUEEZE_TW 專用門檻（th_squeeze_tw 等）不可掃描：掃描不載入券資比面板，該策略不會觸發。
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import backtest_engine as bt
+
+SHARED_FIELDS = ["open", "low", "close", "ma20", "bias20", "support_1m", "volatility_ratio", "volume_ratio",
+                 "vol20", "valid"]
+
+# 只作用於 SQUEEZE_TW（需 smr 面板；掃描沒有）→ 掃描結果不會變
+SMR_ONLY_PARAMS = ("th_squeeze_tw", "th_squeeze_vol_ratio", "th_squeeze_volratio_vol", "th_squeeze_min_bias")
+
+# worker-side state (set by _init_worker)
+_W = {}
+
+
+# ---------------------------------------------------------------------------
+# grid
+# ---------------------------------------------------------------------------
+def _parse_values(spec: str) -> list:
+    """'-5,-6,-7' 或 'start:stop:step'（含 stop）"""
+    spec = spec.strip()
+    if ":" in spec:
+        a, b, step = (float(x) for x in spec.split(":"))
+        if step == 0:
+            raise ValueError(f"zero step: {spec}")
+        n = int(round((b - a) / step)) + 1
+        return [round(a + i * step, 10) for i in range(max(n, 0))]
+    return [float(x) for x in spec.split(",") if x.strip()]
+
+
+def parse_grid(items: list[str] | None = None, grid_file: str | None = None) -> dict[str, list]:
+    grid = {}
+    if grid_file:
+        with open(grid_file, "r", encoding="utf-8") as f:
+            grid.update({k: list(v) for k, v in json.load(f).items()})
+    for it in items or []:
+        k, v = it.split("=", 1)
+        grid[k.strip()] = _parse_values(v)
+    unknown = [k for k in grid if k not in bt.DEFAULT_PARAMS]
+    if unknown:
+        raise ValueError(f"unknown parameter(s): {unknown}; choose from {sorted(bt.DEFAULT_PARAMS)}")
+    inert = [k for k in grid if k in SMR_ONLY_PARAMS]
+    if inert:
+        raise ValueError(f"parameter(s) {inert} only affect SQUEEZE_TW, which needs a short/margin-ratio panel "
+                         f"the sweep does not load")
+    return grid
+
+
+def expand_grid(grid: dict[str, list], base: dict | None = None) -> list[dict]:
+    base = bt.default_params(**(base or {}))
+    keys = list(grid)
+    out = []
+    for combo in itertools.product(*(grid[k] for k in keys)):
+        p = dict(base)
+        p.update(dict(zip(keys, combo)))
+        if "hold_days" in grid:
+            p["hold_days"] = int(p["hold_days"])
+        if p["th_bias_deep"] > p["th_bias_mean_revert"]:
+            continue
+        out.append(p)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# shared memory
+# ---------------------------------------------------------------------------
+def _share(arrays: dict) -> tuple[list, list]:
+    """arrays -> (specs, shm handles)；specs 可 pickle 給 worker。"""
+    specs, handles = [], []
+    for name, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+        specs.append((name, shm.name, a.shape, a.dtype.str))
+        handles.append(shm)
+    return specs, handles
+
+
+def _open_shm(name: str) -> shared_memory.SharedMemory:
+    """
+    worker 端只讀取；attach 時不登記到 resource tracker（由主程序負責 unlink）。
+    fork / spawn 的 worker 都共用主程序的 tracker，attach 後再 unregister 會把主程序的登記
+    一起移除（多個 worker → tracker KeyError），因此 3.13 以前改為 attach 期間略過 register。
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        pass
+    from multiprocessing import resource_tracker
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda *a, **k: None  # worker initializer 為單執行緒
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _attach(specs) -> tuple[dict, list]:
+    arrays, handles = {}, []
+    for name, shm_name, shape, dtype in specs:
+        shm = _open_shm(shm_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        handles.append(shm)
+    return arrays, handles
+
+
+def _state_from_arrays(arrays: dict, dates, tickers, market) -> tuple:
+    panel = bt.Panel(dates=dates, tickers=tickers, open_=arrays["open"], high=None, low=arrays["low"],
+                     close=arrays["close"], volume=None, market=market)
+    ind = {k: arrays[k] for k in ("close", "ma20", "bias20", "support_1m", "volatility_ratio", "volume_ratio",
+                                  "vol20", "valid")}
+    return panel, ind
+
+
+def _init_worker(specs, dates, tickers, market) -> None:
+    arrays, handles = _attach(specs)
+    _W["handles"] = handles  # keep mappings alive
+    _W["panel"], _W["ind"] = _state_from_arrays(arrays, pd.DatetimeIndex(dates), tickers, market)
+
+
+# ---------------------------------------------------------------------------
+# evaluation
+# ---------------------------------------------------------------------------
+def evaluate(params: dict, panel=None, ind=None) -> dict:
+    panel = panel if panel is not None else _W["panel"]
+    ind = ind if ind is not None else _W["ind"]
+    t0 = time.perf_counter()
+    codes = bt.compute_signals(panel, params, ind=ind)
+    trades = bt.simulate(panel, codes, params, ind=ind)
+    by_strat = bt.summarize(trades, panel, params)
+    ann, mdd = bt.equity_stats(trades["t_exit"], trades["ret_pct"], panel.shape[0], params["slot_frac"])
+    r = trades["ret_pct"]
+    per_code = np.bincount(codes.ravel(), minlength=len(bt.STRATEGY_CODES))
+    return {
+        "params": params,
+        "candidates": int((codes != 0).sum()),
+        "candidates_last_day": int((codes[-1] != 0).sum()),
+        "candidates_by_strategy": {bt.STRATEGY_CODES[i]: int(per_code[i]) for i in range(1, len(per_code))},
+        "trades": int(r.size),
+        "win_rate_pct": round(float((r > 0).mean() * 100.0), 2) if r.size else None,
+        "avg_return_pct": round(float(r.mean()), 4) if r.size else None,
+        "annualized_pct": round(ann, 4),
+        "mdd_pct": round(mdd, 4),
+        "by_strategy": by_strat.to_dict("records"),
+        "eval_s": round(time.perf_counter() - t0, 4),
+    }
+
+
+def run_sweep(histories: dict, param_sets: list[dict], workers: int | None = None, log=print) -> list[dict]:
+    t0 = time.perf_counter()
+    panel = bt.build_panel(histories)
+    ind = bt.indicators_for(panel)
+    log(f"[sweep] panel {panel.shape[0]} days x {panel.shape[1]} tickers ready in {time.perf_counter() - t0:.2f}s; "
+        f"{len(param_sets)} parameter sets")
+
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    if workers <= 1 or len(param_sets) <= 1:
+        return [evaluate(p, panel, ind) for p in param_sets]
+
+    arrays = {"open": panel.open, "low": panel.low}
+    arrays.update({k: ind[k] for k in SHARED_FIELDS if k in ind})
+    specs, handles = _share(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(specs, panel.dates.to_numpy(), panel.tickers, panel.market)) as ex:
+            results = list(ex.map(evaluate, param_sets, chunksize=max(1, len(param_sets) // (workers * 4))))
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+    log(f"[sweep] {len(results)} sets evaluated with {workers} workers in {time.perf_counter() - t0:.2f}s")
+    return results
+
+
+def results_frames(results: list[dict], grid_keys: list[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    rows, strat_rows = [], []
+    for i, r in enumerate(results):
+        base = {"set": i}
+        base.update({k: r["params"][k] for k in grid_keys})
+        row = dict(base)
+        row.update({k: r[k] for k in ("candidates", "candidates_last_day", "trades", "win_rate_pct",
+                                      "avg_return_pct", "annualized_pct", "mdd_pct")})
+        row["score"] = round(max(r["annualized_pct"], 0.0) / max(abs(r["mdd_pct"]), 1.0), 4)
+        row.update({f"cand_{k}": v for k, v in r["candidates_by_strategy"].items()})
+        rows.append(row)
+        for s in r["by_strategy"]:
+            sr = dict(base)
+            sr.update(s)
+            strat_rows.append(sr)
+    sweep = pd.DataFrame(rows).sort_values("score", ascending=False, kind="mergesort") if rows else pd.DataFrame()
+    return sweep, pd.DataFrame(strat_rows)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Parallel threshold sweep over the cached history panel")
+    ap.add_argument("--cache", default="cache_yf")
+    ap.add_argument("--grid", action="append", default=[], help="key=v1,v2,... or key=start:stop:step")
+    ap.add_argument("--grid-file", default=None, help="JSON {key: [values]}")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args(argv)
+
+    grid = parse_grid(args.grid, args.grid_file)
+    if not grid:
+        ap.error("no grid given (use --grid or --grid-file)")
+    param_sets = expand_grid(grid)
+    hist = bt.load_cached_histories(args.cache)
+    if not hist:
+        print(f"[sweep] no cached histories in {args.cache}")
+        return 1
+    results = run_sweep(hist, param_sets, workers=args.workers)
+    sweep, by_strat = results_frames(results, list(grid))
+    out = args.out or f"param_sweep_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    with pd.ExcelWriter(out) as xw:
+        sweep.to_excel(xw, sheet_name="Sweep", index=False)
+        by_strat.to_excel(xw, sheet_name="ByStrategy", index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", 30):
+        print(sweep.head(20).to_string(index=False))
+    print(f"[sweep] saved: {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
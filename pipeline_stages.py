@@ -0,0 +1,210 @@
+"""
+pipeline_stages.py  (v6.3.29-F4.8)
+
+daily_auto_run_final.main() 分段執行 + 交易日 checkpoint：
+- 每個 stage 完成後把輸出（dict）寫成 checkpoints/<交易日>/<序號>_<stage>.pkl
+- --resume：依序還原已完成的 stage，從第一個缺 checkpoint 的 stage 開始重跑
+- 非 resume 執行：先清除當日 checkpoint，避免混用舊結果
+- MemoryCheckpointStore：daemon 常駐模式的記憶體 checkpoint（見 daemon_runner.py）
+- prune_days：只保留最近 CHECKPOINT_KEEP_DAYS 個交易日的 checkpoints/<day>/（0 = 不刪）
+"""
+from __future__ import annotations
+
+import os
+import pickle
+import shutil
+import time
+from contextlib import nullcontext
+from datetime import date, timedelta
+
+STAGE_ORDER = [
+    "universe",
+    "margin",
+    "prefilter",
+    "histories",
+    "ledger",
+    "indicators",
+    "rules",
+    "weights",
+    "sizing",
+    "scoring",
+    "export",
+]
+
+CHECKPOINT_KEEP_DAYS = int(os.environ.get("CHECKPOINT_KEEP_DAYS", "5"))
+
+
+def prune_days(root: str, today: str, keep_days: int = CHECKPOINT_KEEP_DAYS, log=None) -> list[str]:
+    """
+    刪除 today 之前超過 keep_days 個交易日（平日）的 root/<YYYY-MM-DD>/；
+    today 當日與之後（隔夜預抓的下一交易日）一律保留。回傳刪除的日期。
+    """
+    if keep_days <= 0 or not os.path.isdir(root):
+        return []
+    try:
+        cutoff = date.fromisoformat(today)
+    except ValueError:
+        return []
+    n = keep_days
+    while n > 0:
+        cutoff -= timedelta(days=1)
+        if cutoff.weekday() < 5:
+            n -= 1
+    removed = []
+    for name in sorted(os.listdir(root)):
+        try:
+            day = date.fromisoformat(name)
+        except ValueError:
+            continue
+        path = os.path.join(root, name)
+        if day < cutoff and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(name)
+    if removed and log is not None:
+        log(f"checkpoints pruned: {len(removed)} day(s) before {cutoff} ({removed[0]} .. {removed[-1]})")
+    return removed
+
+
+class CheckpointStore:
+    """checkpoints/<day>/<nn>_<stage>.pkl"""
+
+    def __init__(self, root: str, day: str):
+        self.root = root
+        self.day = day
+        self.dir = os.path.join(root, day)
+
+    def path(self, stage: str) -> str:
+        idx = STAGE_ORDER.index(stage) if stage in STAGE_ORDER else 99
+        return os.path.join(self.dir, f"{idx:02d}_{stage}.pkl")
+
+    def has(self, stage: str) -> bool:
+        return os.path.exists(self.path(stage))
+
+    def load(self, stage: str):
+        with open(self.path(stage), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, stage: str, obj) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        p = self.path(stage)
+        tmp = p + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, p)
+
+    def drop_from(self, stage: str) -> None:
+        """刪除 stage（含）之後的 checkpoint。"""
+        start = STAGE_ORDER.index(stage) if stage in STAGE_ORDER else 0
+        for s in STAGE_ORDER[start:]:
+            try:
+                os.remove(self.path(s))
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def completed(self) -> list[str]:
+        return [s for s in STAGE_ORDER if self.has(s)]
+
+
+# daemon 常駐時保留在記憶體的 stage（網路 / 資料載入；之後的計算每次重跑）
+WARM_STAGES = ("universe", "margin", "prefilter", "histories")
+
+
+class MemoryCheckpointStore:
+    """
+    daemon_runner 用：warm stage 的輸出留在記憶體（同一物件，下游只讀不改），
+    其餘 stage 不保留 → StageRunner(resume=True) 從第一個非 warm stage 起重跑。
+    backing（磁碟 CheckpointStore）同步寫入，daemon 外的 --resume 照常可用。
+    """
+
+    def __init__(self, day: str, warm=WARM_STAGES, backing: CheckpointStore | None = None):
+        self.day = day
+        self.warm = set(warm)
+        self.backing = backing
+        self._mem: dict = {}
+        self.saved_at: dict[str, float] = {}
+
+    def path(self, stage: str) -> str:
+        return f"memory://{self.day}/{stage}"
+
+    def has(self, stage: str) -> bool:
+        return stage in self._mem
+
+    def load(self, stage: str):
+        return self._mem[stage]
+
+    def save(self, stage: str, obj) -> None:
+        if stage in self.warm:
+            self._mem[stage] = obj
+            self.saved_at[stage] = time.time()
+        if self.backing is not None:
+            self.backing.save(stage, obj)
+
+    def drop_from(self, stage: str) -> None:
+        start = STAGE_ORDER.index(stage) if stage in STAGE_ORDER else 0
+        for s in STAGE_ORDER[start:]:
+            self._mem.pop(s, None)
+            self.saved_at.pop(s, None)
+        if self.backing is not None:
+            self.backing.drop_from(stage)
+
+    def clear(self) -> None:
+        self._mem.clear()
+        self.saved_at.clear()
+        if self.backing is not None:
+            self.backing.clear()
+
+    def completed(self) -> list[str]:
+        return [s for s in STAGE_ORDER if s in self._mem]
+
+
+class StageRunner:
+    """
+    runner.run("histories", fn, *args) -> fn 的輸出 dict
+    resume=True 時，連續已完成的 stage 直接由 checkpoint 還原；一旦遇到缺的 stage，
+    之後所有 stage 都重新執行（上游已變動，下游 checkpoint 不可信）。
+    """
+
+    def __init__(self, store: CheckpointStore, resume: bool = False, log=print, metrics=None):
+        self.store = store
+        self.log = log
+        self.metrics = metrics
+        self._resuming = bool(resume)
+        if not resume:
+            store.clear()
+
+    def _stage_ctx(self, name: str, args, restored: bool):
+        if self.metrics is None:
+            return nullcontext()
+        from run_metrics import count_rows
+        return self.metrics.stage(name, rows_in=count_rows(args[0]) if args else None, restored=restored)
+
+    def _rows_out(self, out) -> None:
+        if self.metrics is not None:
+            from run_metrics import count_rows
+            self.metrics.set_rows(rows_out=count_rows(out))
+
+    def run(self, name: str, fn, *args, **kwargs) -> dict:
+        if self._resuming:
+            if self.store.has(name):
+                try:
+                    with self._stage_ctx(name, args, restored=True):
+                        out = self.store.load(name)
+                        self._rows_out(out)
+                    self.log(f"[stage] {name}: restored from checkpoint ({self.store.path(name)})")
+                    return out
+                except Exception as e:
+                    self.log(f"[stage] {name}: checkpoint unreadable, re-running: {e!r}")
+            self._resuming = False
+            self.store.drop_from(name)
+        self.log(f"[stage] {name}: start")
+        t0 = time.perf_counter()
+        with self._stage_ctx(name, args, restored=False):
+            out = fn(*args, **kwargs)
+            out = {} if out is None else out
+            self._rows_out(out)
+            self.store.save(name, out)
+        self.log(f"[stage] {name}: done in {time.perf_counter() - t0:.1f}s")
+        return out
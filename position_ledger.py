@@ -0,0 +1,259 @@
+"""
+position_ledger.py  (v6.3.29-F4.8)
+
+持倉帳本（SQLite：position_ledger.sqlite）：
+- ingest：每日 Decision 候選（建議部位 > 0）寫入為 OPEN；(entry_date, ticker, strategy) 唯一，重跑不重複
+- mark_to_market：所有 OPEN 部位一次向量化比對歷史價量（dates × positions 矩陣）
+    * 進場日（含）之後任一日最低價 <= stop_loss_price → 停損出場（跳空開低以開盤價）
+    * 持有滿 hold_days 個交易日 → 以當日收盤出場
+    * 其餘更新 last_price / unrealized_pct
+  出場規則與 backtest_engine 相同，兩者的統計可以互相比較
+- closed_trades / summary_by_strategy：CLOSED 交易 → performance_summary.xlsx（ByStrategy）
+
+盤前執行：進場價為前一交易日收盤，entry_date 當天起的 K 棒才計入持有期間。
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+LEDGER_PATH = os.environ.get("LEDGER_PATH", "position_ledger.sqlite")
+HOLD_DAYS = int(os.environ.get("LEDGER_HOLD_DAYS", "10"))
+SUMMARY_MIN_TRADES = int(os.environ.get("LEDGER_SUMMARY_MIN_TRADES", "30"))  # 至少這麼多筆 CLOSED 才覆寫回測摘要
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS positions (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    entry_date      TEXT NOT NULL,
+    ticker          TEXT NOT NULL,
+    symbol          TEXT,
+    market          TEXT,
+    strategy        TEXT NOT NULL,
+    entry_price     REAL NOT NULL,
+    stop_loss_price REAL,
+    position_size   REAL,
+    status          TEXT NOT NULL DEFAULT 'OPEN',
+    exit_date       TEXT,
+    exit_price      REAL,
+    pnl_pct         REAL,
+    hold_days       INTEGER,
+    exit_reason     TEXT,
+    last_date       TEXT,
+    last_price      REAL,
+    unrealized_pct  REAL,
+    updated         TEXT,
+    UNIQUE (entry_date, ticker, strategy)
+);
+CREATE INDEX IF NOT EXISTS ix_positions_status ON positions (status);
+CREATE INDEX IF NOT EXISTS ix_positions_ticker ON positions (ticker);
+"""
+
+MARKET_CODE = {"上市": "TW", "上櫃": "TWO", "TW": "TW", "TWO": "TWO", "TWSE": "TW"}
+
+
+def connect(path: str = LEDGER_PATH) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    return con
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def ingest(df: pd.DataFrame, path: str = LEDGER_PATH, size_col: str = "position_size") -> int:
+    """候選表（英文內部欄位：entry_date/ticker/symbol/market/strategy/entry_price/stop_loss_price/position_size）→ OPEN。"""
+    if df is None or df.empty:
+        return 0
+    size = pd.to_numeric(df.get(size_col), errors="coerce").fillna(0.0)
+    entry = pd.to_numeric(df.get("entry_price"), errors="coerce")
+    pick = df[(size > 0) & entry.notna() & (entry > 0)]
+    if pick.empty:
+        return 0
+    stop = pd.to_numeric(pick.get("stop_loss_price"), errors="coerce")
+    rows = list(zip(
+        pick["entry_date"].astype(str),
+        pick["ticker"].astype(str),
+        pick.get("symbol", pd.Series("", index=pick.index)).astype(str),
+        pick.get("market", pd.Series("", index=pick.index)).map(lambda m: MARKET_CODE.get(str(m), str(m))),
+        pick["strategy"].astype(str),
+        entry[pick.index].astype(float),
+        [None if pd.isna(v) else float(v) for v in stop.tolist()],
+        size[pick.index].astype(float),
+        [_now()] * len(pick),
+    ))
+    with connect(path) as con:
+        before = con.total_changes
+        con.executemany(
+            "INSERT OR IGNORE INTO positions (entry_date, ticker, symbol, market, strategy, entry_price, "
+            "stop_loss_price, position_size, updated) VALUES (?,?,?,?,?,?,?,?,?)", rows)
+        return con.total_changes - before
+
+
+def open_positions(path: str = LEDGER_PATH) -> pd.DataFrame:
+    with connect(path) as con:
+        return pd.read_sql_query("SELECT * FROM positions WHERE status = 'OPEN' ORDER BY id", con)
+
+
+def closed_trades(path: str = LEDGER_PATH) -> pd.DataFrame:
+    with connect(path) as con:
+        return pd.read_sql_query("SELECT * FROM positions WHERE status = 'CLOSED' ORDER BY exit_date, id", con)
+
+
+def _panel_for(histories: dict, tickers: list[str], cache_dir: str):
+    """持倉標的的面板；本次 histories 沒有的標的（已不在候選池）改讀 cache_yf。"""
+    import backtest_engine as bt
+
+    from history_ingest import read_cached
+
+    hist = {t: histories.get(t) for t in tickers}
+    gone = [t for t, h in hist.items() if h is None or not len(h)]
+    if gone:
+        hist.update(read_cached(cache_dir, gone))
+    hist = {t: h for t, h in hist.items() if h is not None and len(h) and "Close" in h.columns}
+    if not hist:
+        return None
+    panel = bt.build_panel(hist, index_ticker=None)
+    if getattr(panel.dates, "tz", None) is not None:
+        panel.dates = panel.dates.tz_localize(None)
+    return panel
+
+
+def mark_to_market(histories: dict, path: str = LEDGER_PATH, hold_days: int = HOLD_DAYS, cache_dir: str = "cache_yf",
+                   log=print) -> dict:
+    """全部 OPEN 部位一次評估（T×P 矩陣）；回傳 {"open", "closed", "stopped", "missing"} 筆數。"""
+    pos = open_positions(path)
+    res = {"open": len(pos), "closed": 0, "stopped": 0, "missing": 0}
+    if pos.empty:
+        return res
+    panel = _panel_for(histories or {}, sorted(set(pos["ticker"])), cache_dir)
+    if panel is None:
+        res["missing"] = len(pos)
+        return res
+    col_of = {t: j for j, t in enumerate(panel.tickers.tolist())}
+    known = pos["ticker"].isin(col_of).to_numpy()
+    pos = pos[known].reset_index(drop=True)
+    res["missing"] = int((~known).sum())
+    if pos.empty:
+        return res
+
+    c = pos["ticker"].map(col_of).to_numpy(dtype="int64")
+    entry = pos["entry_price"].to_numpy(dtype="float64")
+    stop = pd.to_numeric(pos["stop_loss_price"], errors="coerce").to_numpy(dtype="float64")
+    stop = np.where(np.isnan(stop), np.round(entry * 0.95, 2), stop)
+    start = panel.dates.searchsorted(pd.to_datetime(pos["entry_date"]).to_numpy(), side="left")  # 第一根持有 K 棒
+
+    T, P = panel.shape[0], len(pos)
+    lows, opens, closes = panel.low[:, c], panel.open[:, c], panel.close[:, c]   # (T, P)
+    bars = (np.arange(T)[:, None] >= start[None, :]) & ~np.isnan(closes)
+    nbar = np.cumsum(bars, axis=0)                                              # 第幾根持有 K 棒
+    with np.errstate(invalid="ignore"):
+        hit = bars & (nbar <= hold_days) & (lows <= stop[None, :])
+    any_hit = hit.any(axis=0)
+    expired = ~any_hit & (nbar[-1] >= hold_days)
+    t_exit = np.where(any_hit, hit.argmax(axis=0), (bars & (nbar == hold_days)).argmax(axis=0))
+    cols = np.arange(P)
+    o = opens[t_exit, cols]
+    exit_px = np.where(any_hit, np.where(np.isnan(o), stop, np.minimum(o, stop)), closes[t_exit, cols])
+    exit_px = np.round(exit_px, 2)
+    held = nbar[t_exit, cols]
+
+    has_bar = nbar[-1] > 0
+    t_last = T - 1 - bars[::-1].argmax(axis=0)
+    last_px = closes[t_last, cols]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pnl = (exit_px / entry - 1.0) * 100.0
+        unreal = (last_px / entry - 1.0) * 100.0
+
+    ids = pos["id"].astype(int).tolist()
+    now = _now()
+    closed = any_hit | expired
+    upd_closed = [
+        (str(panel.dates[t_exit[i]].date()), float(exit_px[i]), round(float(pnl[i]), 4), int(held[i]),
+         "STOP" if any_hit[i] else "HOLD", now, ids[i])
+        for i in np.nonzero(closed)[0].tolist()
+    ]
+    upd_open = [
+        (str(panel.dates[t_last[i]].date()), float(last_px[i]), round(float(unreal[i]), 4), int(nbar[-1, i]), now, ids[i])
+        for i in np.nonzero(~closed & has_bar)[0].tolist()
+    ]
+    with connect(path) as con:
+        con.executemany(
+            "UPDATE positions SET status='CLOSED', exit_date=?, exit_price=?, pnl_pct=?, hold_days=?, exit_reason=?, "
+            "updated=? WHERE id=?", upd_closed)
+        con.executemany(
+            "UPDATE positions SET last_date=?, last_price=?, unrealized_pct=?, hold_days=?, updated=? WHERE id=?",
+            upd_open)
+    res.update(open=res["open"] - len(upd_closed), closed=len(upd_closed), stopped=int(any_hit.sum()))
+    log(f"ledger mark-to-market: closed {res['closed']} (stop {res['stopped']}), open {res['open']}, "
+        f"no history {res['missing']}")
+    return res
+
+
+SUMMARY_COLS = ["strategy", "annualized_pct", "mdd_pct", "trades", "win_rate_pct", "avg_return_pct",
+                "avg_hold_days", "stop_rate_pct", "first_entry", "last_exit"]
+TRADE_COLS = ["strategy", "ticker", "entry_date", "exit_date", "entry_price", "stop_loss_price", "exit_price",
+              "pnl_pct", "hold_days", "exit_reason"]
+
+
+def trades_net(trades: pd.DataFrame, cost_pct: float | None = None) -> pd.DataFrame:
+    """帳本 pnl_pct 為毛報酬；扣除 cost_pct 後與 backtest_engine.trades_frame 同格式。"""
+    import backtest_engine as bt
+
+    cost = bt.default_params(cost_pct=cost_pct)["cost_pct"]
+    out = trades.reindex(columns=TRADE_COLS).copy()
+    out["pnl_pct"] = (pd.to_numeric(out["pnl_pct"], errors="coerce") - cost).round(4)
+    return out
+
+
+def summary_by_strategy(trades: pd.DataFrame, slot_frac: float | None = None) -> pd.DataFrame:
+    """trades_net 的結果 → ByStrategy（欄位同 backtest_engine.summarize；權益曲線以營業日計）。"""
+    import backtest_engine as bt
+
+    if trades is None or trades.empty:
+        return pd.DataFrame(columns=SUMMARY_COLS)
+    slot = bt.default_params(slot_frac=slot_frac)["slot_frac"]
+    ent = pd.to_datetime(trades["entry_date"])
+    ext = pd.to_datetime(trades["exit_date"])
+    days = pd.bdate_range(ent.min(), ext.max())
+    t_exit = np.minimum(days.searchsorted(ext.to_numpy()), len(days) - 1)
+    ret = trades["pnl_pct"].to_numpy(dtype="float64")
+    held = trades["hold_days"].to_numpy(dtype="float64")
+    stopped = (trades["exit_reason"] == "STOP").to_numpy()
+    strat = trades["strategy"].to_numpy()
+    rows = []
+    for s in sorted(set(strat.tolist())):
+        m = strat == s
+        r = ret[m]
+        ann, mdd = bt.equity_stats(t_exit[m], r, len(days), slot)
+        rows.append({
+            "strategy": s,
+            "annualized_pct": round(ann, 4),
+            "mdd_pct": round(mdd, 4),
+            "trades": int(m.sum()),
+            "win_rate_pct": round(float((r > 0).mean() * 100.0), 2),
+            "avg_return_pct": round(float(r.mean()), 4),
+            "avg_hold_days": round(float(held[m].mean()), 2),
+            "stop_rate_pct": round(float(stopped[m].mean() * 100.0), 2),
+            "first_entry": str(ent[m].min().date()),
+            "last_exit": str(ext[m].max().date()),
+        })
+    return pd.DataFrame(rows, columns=SUMMARY_COLS)
+
+
+def write_performance_summary(out_path: str, path: str = LEDGER_PATH, min_trades: int = SUMMARY_MIN_TRADES,
+                              log=print) -> bool:
+    """CLOSED 交易數達門檻才以實際帳本覆寫 performance_summary.xlsx（否則保留回測摘要）。"""
+    trades = closed_trades(path)
+    if len(trades) < min_trades:
+        return False
+    import backtest_engine as bt
+
+    net = trades_net(trades)
+    bt.write_summary(out_path, summary_by_strategy(net), net)
+    log(f"performance summary from ledger: {len(trades)} CLOSED trades -> {out_path}")
+    return True
@@ -0,0 +1,162 @@
+"""
+position_sizing.py  (v6.3.29-F4.8)
+
+向量化部位計算 + 投組層級資金配置：
+- size_positions：與 calc_position_size 相同公式，一次算完所有候選（取代 df.apply(axis=1)）
+- allocate：總資金 / 各策略 / 各市場預算
+    scale  ：超出預算的群組等比例縮小（策略 → 市場 → 總額）
+    greedy ：依綜合分數高→低逐檔填入，任一預算用完即停（後段候選部位=0）
+    off    ：不配置（各檔獨立對 TOTAL_CAPITAL 計算的舊行為）
+
+設定（環境變數，預算為 TOTAL_CAPITAL 的比例）：
+    POS_ALLOC_MODE=scale|greedy|off        （預設 scale）
+    POS_TOTAL_BUDGET=1.0
+    POS_STRATEGY_BUDGET="MEAN_REVERT:0.5,*:0.4"
+    POS_MARKET_BUDGET="TW:0.7,TWO:0.4"
+"""
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import pandas as pd
+
+ALLOC_MODE = os.environ.get("POS_ALLOC_MODE", "scale").strip().lower()
+TOTAL_BUDGET = float(os.environ.get("POS_TOTAL_BUDGET", "1.0"))
+STRATEGY_BUDGET = os.environ.get("POS_STRATEGY_BUDGET", "").strip()
+MARKET_BUDGET = os.environ.get("POS_MARKET_BUDGET", "").strip()
+
+NOTE_NO_BUDGET = "資金配額不足(部位=0)"
+HIGH_RISK_TAG = "HIGH RISK"
+
+
+def size_positions(atr20, close, weight, total_capital: float, max_account_risk: float,
+                   per_trade_risk_ratio: float, regime_multiplier: float = 1.0) -> np.ndarray:
+    """calc_position_size 的向量版：min(單筆風險 / (ATR20/收盤), 總資金×0.5)，四捨五入到元。"""
+    atr20 = np.asarray(atr20, dtype="float64")
+    close = np.asarray(close, dtype="float64")
+    weight = np.asarray(weight, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vol_pct = atr20 / close
+        max_trade_risk = total_capital * max_account_risk * weight * regime_multiplier * per_trade_risk_ratio
+        size = np.minimum(max_trade_risk / vol_pct, total_capital * 0.5)
+    size = np.where(vol_pct <= 0, 0.0, size)
+    return np.round(size, 0)
+
+
+def parse_budget(spec: str | dict | None) -> dict[str, float]:
+    """'TW:0.7,TWO:0.4' -> {'TW': 0.7, 'TWO': 0.4}（比例）；'*' 為其餘群組預設。"""
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        return {str(k): float(v) for k, v in spec.items()}
+    out = {}
+    for part in str(spec).split(","):
+        if ":" not in part:
+            continue
+        k, v = part.rsplit(":", 1)
+        try:
+            out[k.strip()] = float(v.strip())
+        except Exception:
+            continue
+    return out
+
+
+def _limits(keys: np.ndarray, budget: dict[str, float], capital: float) -> dict:
+    out = {}
+    for k in pd.unique(keys):
+        frac = budget.get(str(k), budget.get("*"))
+        if frac is not None:
+            out[k] = frac * capital
+    return out
+
+
+def _scale_groups(size: np.ndarray, keys: np.ndarray, limits: dict) -> np.ndarray:
+    if not limits:
+        return size
+    s = pd.Series(size)
+    tot = s.groupby(keys).transform("sum").to_numpy()
+    lim = np.array([limits.get(k, np.inf) for k in keys], dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = np.where(tot > lim, lim / tot, 1.0)
+    return size * f
+
+
+def allocate(size, score, strategy, market, total_capital: float, mode: str | None = None,
+             total_budget: float | None = None, strategy_budget=None, market_budget=None) -> np.ndarray:
+    """回傳配置後部位（元，整數）。size/score/strategy/market 為同長度陣列。"""
+    mode = (mode or ALLOC_MODE).lower()
+    size = np.nan_to_num(np.asarray(size, dtype="float64"), nan=0.0).clip(min=0.0)
+    if mode == "off" or size.size == 0:
+        return np.round(size, 0)
+    strategy = np.asarray(strategy, dtype=object)
+    market = np.asarray(market, dtype=object)
+    cap_total = (TOTAL_BUDGET if total_budget is None else total_budget) * total_capital
+    s_lim = _limits(strategy, parse_budget(STRATEGY_BUDGET if strategy_budget is None else strategy_budget), total_capital)
+    m_lim = _limits(market, parse_budget(MARKET_BUDGET if market_budget is None else market_budget), total_capital)
+
+    if mode == "greedy":
+        score = np.nan_to_num(np.asarray(score, dtype="float64"), nan=-np.inf)
+        order = np.lexsort((np.arange(size.size), -score))  # 分數高→低，同分維持原順序
+        left_total = cap_total
+        left_s = dict(s_lim)
+        left_m = dict(m_lim)
+        out = np.zeros_like(size)
+        for i in order.tolist():
+            sk, mk = strategy[i], market[i]
+            room = min(left_total, left_s.get(sk, np.inf), left_m.get(mk, np.inf))
+            a = min(size[i], max(room, 0.0))
+            out[i] = a
+            left_total -= a
+            if sk in left_s:
+                left_s[sk] -= a
+            if mk in left_m:
+                left_m[mk] -= a
+        return np.floor(out)
+
+    # scale
+    out = _scale_groups(size, strategy, s_lim)
+    out = _scale_groups(out, market, m_lim)
+    tot = out.sum()
+    if tot > cap_total > 0:
+        out = out * (cap_total / tot)
+    return np.floor(out)
+
+
+def set_high_risk(alerts: pd.Series, size, total_capital: float, high_risk_pos: float) -> pd.Series:
+    """部位 / 總資金 > high_risk_pos 的列標 HIGH RISK；其他附註保留（" | " 分隔）。"""
+    flag = np.nan_to_num(np.asarray(size, dtype="float64")) / total_capital > high_risk_pos
+    out = []
+    for t, hi in zip(alerts.fillna("").astype(str), flag):
+        parts = [x.strip() for x in t.split(" | ") if x.strip() and x.strip() != HIGH_RISK_TAG]
+        out.append(" | ".join(([HIGH_RISK_TAG] if hi else []) + parts))
+    return pd.Series(out, index=alerts.index, dtype=object)
+
+
+def allocate_frame(df: pd.DataFrame, total_capital: float, size_col: str = "position_size", score_col: str = "綜合分數",
+                   strategy_col: str = "strategy", market_col: str = "market", risk_col: str | None = "Risk Alert",
+                   mode: str | None = None, log=None, high_risk_pos: float | None = None) -> pd.DataFrame:
+    """
+    df 就地更新 size_col；greedy 模式下被排除的列在 risk_col 附註。
+    high_risk_pos：給定時依配置後的部位重算 risk_col 的 HIGH RISK 標記。
+    """
+    mode = (mode or ALLOC_MODE).lower()
+    if mode == "off" or df is None or df.empty or size_col not in df.columns:
+        return df
+    raw = pd.to_numeric(df[size_col], errors="coerce").to_numpy(dtype="float64")
+    score = pd.to_numeric(df[score_col], errors="coerce").to_numpy(dtype="float64") if score_col in df.columns else np.zeros(len(df))
+    strat = df[strategy_col].astype(str).to_numpy() if strategy_col in df.columns else np.array([""] * len(df), dtype=object)
+    mkt = df[market_col].astype(str).to_numpy() if market_col in df.columns else np.array([""] * len(df), dtype=object)
+    final = allocate(raw, score, strat, mkt, total_capital, mode=mode)
+    df[size_col] = final
+    if high_risk_pos is not None and risk_col and risk_col in df.columns:
+        df[risk_col] = set_high_risk(df[risk_col], final, total_capital, high_risk_pos)
+    if mode == "greedy" and risk_col and risk_col in df.columns:
+        dropped = (np.nan_to_num(raw) > 0) & (final <= 0)
+        if dropped.any():
+            cur = df.loc[dropped, risk_col].fillna("").astype(str)
+            df.loc[dropped, risk_col] = cur.map(lambda t: (t + " | " if t.strip() else "") + NOTE_NO_BUDGET)
+    if log is not None:
+        log(f"position allocation ({mode}): raw={np.nansum(raw):,.0f} -> allocated={final.sum():,.0f} "
+            f"/ capital={total_capital:,.0f}")
+    return df
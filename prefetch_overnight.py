@@ -0,0 +1,275 @@
+"""
+prefetch_overnight.py  (v6.3.29-F4.8)
+
+隔夜預抓（T+1 資料前一晚即公布）：收盤後把下一個執行日需要的資料先抓好存本機，
+盤前只驗證新鮮度、不再於時間壓力下連網。
+
+預抓項目（目標執行日 = 下一個營業日；資料日 = 今天/最近營業日）：
+- universe / margin / prefilter / histories：直接執行同名 stage，寫入 checkpoints/<執行日>/
+  （histories 強制重新下載並更新 cache_yf，不沿用白天的快取）
+- 股本 map：cache/shares_map.json（超過 PREFETCH_SHARES_MAX_AGE_H 小時即重建）
+- 成交量：cache/yahoo_volume_map_<執行日>.json（Stage2 全部標的）
+- 完成狀態寫入 checkpoints/<執行日>/prefetch.json
+
+就緒條件：margin 以 TPEx 資料日有資料為準；histories 需 ≥ PREFETCH_MIN_COVERAGE 的標的有資料日 K 棒。
+未就緒者每 --interval 分鐘重試到 --until（上游重抓時下游一併重抓）。
+
+    # crontab（平日 18:00 起，重試到 23:30）
+    0 18 * * 1-5  cd /path/to/repo && python prefetch_overnight.py --until 23:30 --interval 20
+
+盤前 main()：usable_stages 驗證 prefetch.json（執行日、資料日、存檔時間）後以 checkpoint 還原連續就緒的 stage。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+
+MANIFEST = "prefetch.json"
+LOCK_FILE = "prefetch.lock"
+MIN_COVERAGE = float(os.environ.get("PREFETCH_MIN_COVERAGE", "0.90"))
+MAX_AGE_HOURS = float(os.environ.get("PREFETCH_MAX_AGE_H", "16"))
+SHARES_MAX_AGE_HOURS = float(os.environ.get("PREFETCH_SHARES_MAX_AGE_H", "12"))
+STAGES = ("universe", "margin", "prefilter", "histories")
+DEPENDS = {"prefilter": ("universe",), "histories": ("prefilter",), "volumes": ("histories",)}
+
+
+def last_bday(d: date) -> date:
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d
+
+
+def next_bday(d: date) -> date:
+    d += timedelta(days=1)
+    while d.weekday() >= 5:
+        d += timedelta(days=1)
+    return d
+
+
+def manifest_path(checkpoint_dir: str, run_day: str) -> str:
+    return os.path.join(checkpoint_dir, run_day, MANIFEST)
+
+
+def load_manifest(checkpoint_dir: str, run_day: str) -> dict | None:
+    try:
+        with open(manifest_path(checkpoint_dir, run_day), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _save_manifest(checkpoint_dir: str, run_day: str, man: dict) -> None:
+    p = manifest_path(checkpoint_dir, run_day)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    man["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    tmp = p + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(man, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, p)
+
+
+def _bar_date(h):
+    try:
+        return h.index[-1].date()
+    except Exception:
+        return None
+
+
+class Prefetcher:
+    def __init__(self, run_day: date | None = None, log=None):
+        import daily_auto_run_final as d
+        from pipeline_stages import CheckpointStore
+
+        self.d = d
+        self.data_day = last_bday(datetime.now().date())
+        self.run_day = run_day or next_bday(self.data_day)
+        self.run_tag = self.run_day.strftime("%Y-%m-%d")
+        self.store = CheckpointStore(d.CHECKPOINT_DIR, self.run_tag)
+        self.log = log or d.log
+        self.man = load_manifest(d.CHECKPOINT_DIR, self.run_tag) or {}
+        if self.man.get("data_date") != str(self.data_day):
+            self.man = {}  # 不同資料日的舊狀態不可沿用
+        self.man.update(run_day=self.run_tag, data_date=str(self.data_day))
+        self.man.setdefault("items", {})
+        self._out = {}
+
+    # ----- state -----
+    def ready(self, name: str) -> bool:
+        return bool(self.man["items"].get(name, {}).get("ready"))
+
+    def _mark(self, name: str, ready: bool, **info) -> None:
+        ent = {"ready": bool(ready), "saved": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        ent.update(info)
+        self.man["items"][name] = ent
+        if not ready:
+            for k, deps in DEPENDS.items():  # 上游未就緒 / 重抓 → 下游重抓
+                if name in deps and k in self.man["items"]:
+                    self.man["items"][k]["ready"] = False
+        _save_manifest(self.d.CHECKPOINT_DIR, self.run_tag, self.man)
+
+    def _stage_out(self, name: str):
+        if name not in self._out and self.store.has(name):
+            self._out[name] = self.store.load(name)
+        return self._out.get(name)
+
+    def _run_stage(self, name: str, fn, *args) -> dict:
+        out = fn(*args)
+        self.store.save(name, out)
+        self._out[name] = out
+        return out
+
+    # ----- items -----
+    def universe(self) -> None:
+        out = self._run_stage("universe", self.d._stage_universe)
+        self._mark("universe", bool(out.get("tickers")), tickers=len(out.get("tickers") or []))
+        self._mark("prefilter", False)
+
+    def margin(self) -> None:
+        dd = self.data_day
+        published = not self.d._tpex_margin_df(f"{dd.year - 1911}/{dd.month:02d}/{dd.day:02d}").empty
+        if not published:
+            self._mark("margin", False, note=f"TPEx margin for {dd} not published yet")
+            return
+        out = self._run_stage("margin", self.d._stage_margin, self.run_day)
+        self._mark("margin", bool(out.get("ratio_map")), ratio_map=len(out.get("ratio_map") or {}))
+
+    def prefilter(self) -> None:
+        out = self._run_stage("prefilter", self.d._stage_prefilter, self._stage_out("universe")["tickers"])
+        self._mark("prefilter", bool(out.get("tickers2")), tickers2=len(out.get("tickers2") or []))
+        self._mark("histories", False)
+
+    def histories(self) -> None:
+        tickers2 = self._stage_out("prefilter")["tickers2"]
+        d = self.d
+        idx_hist = d.yf.Ticker(d.INDEX_TICKER).history(period="6mo")
+        hist = d.download_histories(tickers2, period=d.STAGE2_PERIOD, use_cache=False)
+        out = {"histories": hist, "market_regime": d.calc_market_regime(idx_hist),
+               "invalid_tickers": set(d.INVALID_TICKERS)}
+        self.store.save("histories", out)
+        self._out["histories"] = out
+        fresh = sum(1 for h in hist.values() if _bar_date(h) == self.data_day)
+        cov = fresh / max(len(tickers2), 1)
+        self._mark("histories", cov >= MIN_COVERAGE, coverage=round(cov, 4), tickers=len(hist))
+        self._mark("volumes", False)
+
+    def shares(self) -> None:
+        path = os.path.join("cache", "shares_map.json")
+        m = self.d.load_or_build_shares_map(path, max_age_hours=SHARES_MAX_AGE_HOURS)
+        self._mark("shares", bool(m), n=len(m or {}))
+
+    def volumes(self) -> None:
+        tickers2 = self._stage_out("prefilter")["tickers2"]
+        vol_map = self.d.fetch_yahoo_volume_map(tickers2, self.run_day, chunk_size=80, pause_sec=1.0)
+        path = os.path.join("cache", f"yahoo_volume_map_{self.run_tag}.json")
+        cov = len(vol_map) / max(len(tickers2), 1)
+        if vol_map:
+            os.makedirs("cache", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(vol_map, f, ensure_ascii=False)
+        self._mark("volumes", cov >= MIN_COVERAGE, coverage=round(cov, 4))
+
+    ITEMS = ("universe", "margin", "prefilter", "histories", "shares", "volumes")
+
+    def run_pass(self) -> list[str]:
+        """未就緒（且上游已就緒）的項目各試一次；回傳仍未就緒者。"""
+        for name in self.ITEMS:
+            if self.ready(name) or not all(self.ready(u) for u in DEPENDS.get(name, ())):
+                continue
+            t0 = time.perf_counter()
+            try:
+                getattr(self, name)()
+            except Exception as e:
+                self._mark(name, False, error=repr(e))
+            info = {k: v for k, v in self.man["items"].get(name, {}).items() if k not in ("ready", "saved")}
+            state = "ready" if self.ready(name) else "not ready"
+            self.log(f"[prefetch] {name}: {state} in {time.perf_counter() - t0:.1f}s {info}")
+        return [n for n in self.ITEMS if not self.ready(n)]
+
+
+def usable_stages(checkpoint_dir: str, run_day: str, log=print) -> list[str]:
+    """
+    盤前驗證：prefetch.json 屬於本執行日、資料日為前一營業日、存檔未超過 PREFETCH_MAX_AGE_H，
+    回傳 STAGE_ORDER 開頭連續就緒（且 checkpoint 存在）的 stage。
+    """
+    man = load_manifest(checkpoint_dir, run_day)
+    if not man or man.get("run_day") != run_day:
+        return []
+    rd = datetime.strptime(run_day, "%Y-%m-%d").date()
+    expect = last_bday(rd - timedelta(days=1))
+    if man.get("data_date") != str(expect):
+        log(f"[prefetch] data date {man.get('data_date')} != expected {expect}; ignoring prefetched stages")
+        return []
+    from pipeline_stages import CheckpointStore
+
+    store = CheckpointStore(checkpoint_dir, run_day)
+    kept = []
+    for s in STAGES:
+        ent = (man.get("items") or {}).get(s) or {}
+        if not ent.get("ready") or not store.has(s):
+            break
+        age_h = (datetime.now() - datetime.strptime(ent["saved"], "%Y-%m-%d %H:%M:%S")).total_seconds() / 3600.0
+        if age_h > MAX_AGE_HOURS:
+            log(f"[prefetch] {s}: saved {age_h:.1f}h ago (> {MAX_AGE_HOURS:g}h); re-fetching")
+            break
+        kept.append(s)
+    return kept
+
+
+def _acquire_lock(path: str, stale_hours: float = 6.0) -> bool:
+    try:
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) > stale_hours * 3600:
+            os.remove(path)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return True
+    except FileExistsError:
+        return False
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Overnight prefetch of next-run data (cron-friendly)")
+    ap.add_argument("--until", default="23:30", help="retry deadline HH:MM (today)")
+    ap.add_argument("--interval", type=float, default=20.0, help="minutes between passes")
+    ap.add_argument("--run-day", default=None, help="target run day YYYY-MM-DD (default: next business day)")
+    ap.add_argument("--once", action="store_true", help="single pass, no retries")
+    args = ap.parse_args(argv)
+
+    if not _acquire_lock(LOCK_FILE):
+        print(f"[prefetch] another prefetch is running ({LOCK_FILE}); exiting")
+        return 0
+    try:
+        run_day = datetime.strptime(args.run_day, "%Y-%m-%d").date() if args.run_day else None
+        pf = Prefetcher(run_day)
+        from pipeline_stages import prune_days
+        prune_days(pf.d.CHECKPOINT_DIR, str(pf.data_day), log=pf.log)
+        hh, mm = (int(x) for x in args.until.split(":"))
+        deadline = datetime.now().replace(hour=hh, minute=mm, second=0, microsecond=0)
+        pf.log(f"[prefetch] run day {pf.run_tag}, data date {pf.data_day}, retry until {deadline:%H:%M}")
+        while True:
+            pending = pf.run_pass()
+            if not pending:
+                pf.log("[prefetch] all items ready")
+                return 0
+            if args.once or datetime.now() + timedelta(minutes=args.interval) > deadline:
+                pf.log(f"[prefetch] deadline reached; not ready: {pending}", level="WARN")
+                return 1
+            pf.log(f"[prefetch] pending {pending}; next pass in {args.interval:g} min")
+            time.sleep(args.interval * 60)
+    finally:
+        try:
+            os.remove(LOCK_FILE)
+        except OSError:
+            pass
+        try:
+            import daily_auto_run_final as d
+            d.close_logger()
+        except Exception:
+            pass
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,155 @@
+"""
+run_logger.py  (v6.3.29-F4.8)
+
+非阻塞 run logger：
+- 單一檔案 handle 常駐開啟（不再每行 open/close）
+- 呼叫端只把紀錄放進 queue，由背景 thread 寫檔 + 印出，定期 flush
+- 等級 DEBUG / INFO / WARN / ERROR；結構化欄位以 " | k=v" 附在訊息後
+- flush() / close() 保證 queue 內容全部落地（__main__ 例外處理與 atexit 會呼叫）
+- reopen(path)：之後的紀錄改寫到新檔（daemon 每次 run 一個 run_<ts>.log）
+
+輸出格式與舊 log() 相同：[YYYY-mm-dd HH:MM:SS] msg
+"""
+from __future__ import annotations
+
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40, "FATAL": 50}
+
+
+def format_fields(fields: dict) -> str:
+    parts = []
+    for k, v in fields.items():
+        if v is None:
+            continue
+        if isinstance(v, float):
+            v = f"{v:.4g}"
+        parts.append(f"{k}={v}")
+    return (" | " + " ".join(parts)) if parts else ""
+
+
+class RunLogger:
+    def __init__(self, path: str, level: str = "INFO", flush_interval: float = 1.0, echo: bool = True):
+        self.path = path
+        self.min_level = LEVELS.get(str(level).upper(), 20)
+        self.flush_interval = flush_interval
+        self.echo = echo
+        self._q: queue.Queue = queue.Queue()
+        self._fh = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, name="run-logger", daemon=True)
+        self._thread.start()
+
+    # ---- producer side ----
+    def log(self, msg: str, level: str = "INFO", **fields) -> None:
+        lv = str(level).upper()
+        if LEVELS.get(lv, 20) < self.min_level:
+            return
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        tag = "" if lv == "INFO" else f"[{lv}] "
+        line = f"[{ts}] {tag}{msg}{format_fields(fields)}"
+        if self._closed:
+            self._write_sync(line)
+            return
+        self._q.put(line)
+
+    def flush(self, timeout: float | None = 5.0) -> None:
+        """等背景 thread 把目前 queue 內容寫完並 flush。"""
+        if self._closed:
+            return
+        ev = threading.Event()
+        self._q.put(ev)
+        ev.wait(timeout)
+
+    def reopen(self, path: str) -> None:
+        """切換輸出檔；queue 內先前的紀錄仍寫入舊檔。"""
+        if self._closed:
+            self.path = path
+            return
+        self._q.put(("reopen", path))
+
+    def close(self, timeout: float | None = 5.0) -> None:
+        if self._closed:
+            return
+        self._q.put(None)
+        self._thread.join(timeout)
+        self._closed = True
+        self._close_fh()
+
+    # ---- consumer side ----
+    def _open(self):
+        if self._fh is None:
+            try:
+                self._fh = open(self.path, "a", encoding="utf-8")
+            except Exception:
+                self._fh = None
+        return self._fh
+
+    def _close_fh(self) -> None:
+        try:
+            if self._fh is not None:
+                self._fh.flush()
+                self._fh.close()
+        except Exception:
+            pass
+        self._fh = None
+
+    def _emit(self, line: str) -> None:
+        if self.echo:
+            try:
+                print(line)
+            except Exception:
+                pass
+        fh = self._open()
+        if fh is not None:
+            try:
+                fh.write(line + "\n")
+            except Exception:
+                pass
+
+    def _flush_io(self) -> None:
+        try:
+            if self._fh is not None:
+                self._fh.flush()
+            sys.stdout.flush()
+        except Exception:
+            pass
+
+    def _write_sync(self, line: str) -> None:
+        """close() 之後仍有紀錄時（例如 atexit 之後）直接同步寫入。"""
+        self._emit(line)
+        self._flush_io()
+        self._close_fh()
+
+    def _worker(self) -> None:
+        dirty = False
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._q.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                self._flush_io()
+                return
+            if isinstance(item, tuple) and item[0] == "reopen":
+                self._flush_io()
+                self._close_fh()
+                self.path = item[1]
+                dirty, last_flush = False, time.monotonic()
+                continue
+            if isinstance(item, threading.Event):
+                self._flush_io()
+                dirty, last_flush = False, time.monotonic()
+                item.set()
+                continue
+            if item is not False:
+                self._emit(item)
+                dirty = True
+            if dirty and time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_io()
+                dirty, last_flush = False, time.monotonic()
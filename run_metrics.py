@@ -0,0 +1,164 @@
+"""
+run_metrics.py  (v6.3.29-F4.8)
+
+每次執行的分段效能指標 → run_metrics_<RUN_TS>.json（與 run_<RUN_TS>.log 同目錄）：
+- wall / CPU 秒數、peak RSS 增量
+- 計數器：http_requests / bytes_downloaded / yahoo_batches / cache_hits / cache_misses / cache_stale / cache_evicted ...
+  * http_requests / bytes_downloaded：requests SESSION（TWSE / TPEx / ISIN）流量；Content-Length 優先，
+    stream 回應且無 Content-Length 時不讀 body，改記 http_bytes_unknown
+  * Yahoo（yf.download，不經 SESSION）：yahoo_tickers_requested（每檔一次 chart 請求）、
+    yahoo_frame_bytes（回傳 DataFrame 的記憶體大小，近似下載量）、yahoo_info_requests（Ticker.info）
+- rows_in / rows_out
+
+計數器記在「目前的 stage」（可巢狀）以及全程 totals。
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def peak_rss_bytes() -> int | None:
+    """Process peak RSS（bytes）；取不到時回傳 None。"""
+    try:
+        import resource
+        v = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return int(v) if sys.platform == "darwin" else int(v) * 1024
+    except Exception:
+        pass
+    try:
+        import psutil
+        mi = psutil.Process().memory_info()
+        return int(getattr(mi, "peak_wset", 0) or mi.rss)
+    except Exception:
+        return None
+
+
+def count_rows(obj) -> int | None:
+    """DataFrame / list / dict → 筆數；dict 輸出取第一個可計數的值。"""
+    if obj is None:
+        return None
+    if hasattr(obj, "shape") and hasattr(obj, "columns"):
+        return int(obj.shape[0])
+    if isinstance(obj, (list, tuple, set)):
+        return len(obj)
+    if isinstance(obj, dict):
+        for v in obj.values():
+            if hasattr(v, "columns") or isinstance(v, (list, tuple, set, dict)):
+                return count_rows(v)
+        return len(obj)
+    return None
+
+
+class RunMetrics:
+    def __init__(self, run_ts: str, script: str = ""):
+        self.script = script
+        self.reset(run_ts)
+
+    def reset(self, run_ts: str) -> None:
+        """新的一次執行（daemon 重複使用同一物件；session hook 仍指向它）。"""
+        self.run_ts = run_ts
+        self.started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+        self.stages: list[dict] = []
+        self.totals: dict[str, float] = {}
+        self._stack: list[dict] = []
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None, **extra):
+        rec = {"stage": name, "rows_in": rows_in, "rows_out": None, "counters": {}}
+        rec.update(extra)
+        if self._stack:
+            rec["parent"] = self._stack[-1]["stage"]
+        self._stack.append(rec)
+        w0, c0, m0 = time.perf_counter(), time.process_time(), peak_rss_bytes()
+        try:
+            yield rec
+            rec["status"] = "ok"
+        except BaseException as e:
+            rec["status"] = "error"
+            rec["error"] = repr(e)
+            raise
+        finally:
+            m1 = peak_rss_bytes()
+            rec["wall_s"] = round(time.perf_counter() - w0, 4)
+            rec["cpu_s"] = round(time.process_time() - c0, 4)
+            rec["peak_rss_delta_bytes"] = (m1 - m0) if (m0 is not None and m1 is not None) else None
+            rec["peak_rss_bytes"] = m1
+            self._stack.pop()
+            self.stages.append(rec)
+
+    def incr(self, key: str, n: float = 1) -> None:
+        self.totals[key] = self.totals.get(key, 0) + n
+        if self._stack:
+            c = self._stack[-1]["counters"]
+            c[key] = c.get(key, 0) + n
+
+    def set_rows(self, rows_in: int | None = None, rows_out: int | None = None) -> None:
+        if not self._stack:
+            return
+        if rows_in is not None:
+            self._stack[-1]["rows_in"] = rows_in
+        if rows_out is not None:
+            self._stack[-1]["rows_out"] = rows_out
+
+    def to_dict(self) -> dict:
+        return {
+            "run_ts": self.run_ts,
+            "script": self.script,
+            "started": self.started,
+            "finished": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "wall_s": round(time.perf_counter() - self._t0, 4),
+            "cpu_s": round(time.process_time() - self._c0, 4),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "totals": self.totals,
+            "stages": self.stages,
+        }
+
+    def write(self, path: str) -> None:
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+
+def response_nbytes(r, stream: bool = False) -> int | None:
+    """Content-Length；沒有時非 stream 回應取 body 長度（requests 本來就會讀完），stream 回應回傳 None。"""
+    cl = (r.headers or {}).get("Content-Length")
+    if cl is not None and str(cl).strip().isdigit():
+        return int(cl)
+    if stream:
+        return None
+    return len(r.content or b"")
+
+
+def requests_counter_hook(metrics: RunMetrics):
+    """requests.Session response hook：計數 HTTP 次數與下載位元組（只含經過該 session 的流量）。"""
+    def _hook(r, *args, **kwargs):
+        try:
+            metrics.incr("http_requests")
+            n = response_nbytes(r, stream=bool(kwargs.get("stream")))
+            if n is None:
+                metrics.incr("http_bytes_unknown")
+            else:
+                metrics.incr("bytes_downloaded", n)
+        except Exception:
+            pass
+        return None
+    return _hook
+
+
+def frame_nbytes(df) -> int:
+    """DataFrame 的記憶體大小（yf.download 批次的下載量近似值）。"""
+    try:
+        return int(df.memory_usage(index=True, deep=False).sum()) if df is not None else 0
+    except Exception:
+        return 0
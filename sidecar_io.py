@@ -0,0 +1,175 @@
+"""
+sidecar_io.py  (v6.3.29-F4.8)
+
+每份 Excel 旁邊同步輸出「機器可讀」的 sidecar：
+- <xlsx 檔名>.arrow  : Arrow IPC (Feather v2, 未壓縮) → 可 memory-map 讀取
+- <日期>_manifest.json : 各表的檔名 / 列數 / 欄位型別
+
+下游（export_top20 等）優先讀 sidecar，舊日期沒有 sidecar 時才回退 pd.read_excel。
+需要 pyarrow；未安裝時寫出/讀取皆回傳 None，不影響 Excel 產出。
+"""
+from __future__ import annotations
+
+import glob
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+
+SIDECAR_EXT = ".arrow"
+MANIFEST_SUFFIX = "_manifest.json"
+MANIFEST_VERSION = 1
+
+# display placeholders that mean "no value" inside numeric columns
+NULL_TOKENS = ("", "N/A", "nan", "NaN", "None", "NA")
+
+# identifier / code columns: always string (2330 must not become 2330.0)
+ID_COLUMNS = ("股票代號", "Yahoo代碼", "策略代碼", "市場", "ticker", "symbol", "market", "strategy_code")
+
+
+def sidecar_path_for(xlsx_path: str) -> str:
+    base, _ = os.path.splitext(xlsx_path)
+    return base + SIDECAR_EXT
+
+
+def manifest_path(records_dir: str, date_tag: str) -> str:
+    return os.path.join(records_dir, f"{date_tag}{MANIFEST_SUFFIX}")
+
+
+def _null_mask(s: pd.Series) -> pd.Series:
+    return s.isna() | s.map(lambda v: isinstance(v, str) and v.strip() in NULL_TOKENS)
+
+
+def is_id_column(name: str) -> bool:
+    return name in ID_COLUMNS or name.endswith(("代號", "代碼"))
+
+
+def _id_str(v):
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return None
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+
+def typed_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    object 欄位定型：
+    - 代號 / 代碼欄（ID_COLUMNS、*代號、*代碼）→ string（2330 → "2330"，不轉成 2330.0）
+    - 非空值全為數字（空白/N/A 視為缺值）→ float64
+    - 其餘 → string（保留代號前導 0，例如 0050）
+    """
+    out = pd.DataFrame(index=df.index)
+    for c in df.columns:
+        s = df[c]
+        name = str(c)
+        if is_id_column(name):
+            out[name] = s.where(~_null_mask(s)).map(_id_str).astype("string")
+            continue
+        if s.dtype != object:
+            out[name] = s
+            continue
+        null = _null_mask(s)
+        nn = s[~null]
+        is_num = nn.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))
+        if len(nn) and bool(is_num.all()):
+            out[name] = pd.to_numeric(s.where(~null), errors="coerce").astype("float64")
+        else:
+            out[name] = s.where(~null).map(lambda v: None if v is None or (not isinstance(v, str) and pd.isna(v)) else str(v)).astype("string")
+    return out.reset_index(drop=True)
+
+
+def write_sidecar(df: pd.DataFrame, xlsx_path: str) -> dict | None:
+    """寫出單一表格的 Arrow IPC sidecar；回傳 manifest 條目（失敗回傳 None）。"""
+    try:
+        import pyarrow as pa
+    except Exception:
+        return None
+    path = sidecar_path_for(xlsx_path)
+    tdf = typed_frame(df if df is not None else pd.DataFrame())
+    table = pa.Table.from_pandas(tdf, preserve_index=False)
+    tmp = path + ".tmp"
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+    return {
+        "file": os.path.basename(path),
+        "xlsx": os.path.basename(xlsx_path),
+        "rows": int(table.num_rows),
+        "columns": [str(c) for c in tdf.columns],
+        "dtypes": {str(c): str(t) for c, t in tdf.dtypes.items()},
+    }
+
+
+def update_manifest(records_dir: str, date_tag: str, entries: dict) -> None:
+    path = manifest_path(records_dir, date_tag)
+    man = {}
+    try:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                man = json.load(f) or {}
+    except Exception:
+        man = {}
+    man["version"] = MANIFEST_VERSION
+    man["date"] = date_tag
+    man["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    tables = man.get("tables") or {}
+    tables.update(entries)
+    man["tables"] = tables
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(man, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def write_sidecars(records_dir: str, date_tag: str, tables: dict) -> dict:
+    """
+    tables: {"FULL": (df, xlsx_path), "DECISION": (df, xlsx_path), ...}
+    回傳成功寫出的 manifest 條目。
+    """
+    entries = {}
+    for name, (df, xlsx_path) in tables.items():
+        ent = write_sidecar(df, xlsx_path)
+        if ent is not None:
+            entries[name] = ent
+    if entries:
+        update_manifest(records_dir, date_tag, entries)
+    return entries
+
+
+def load_manifest(records_dir: str, date_tag: str) -> dict | None:
+    path = manifest_path(records_dir, date_tag)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def load_sidecar(records_dir: str, date_tag: str | None, table: str = "FULL") -> pd.DataFrame | None:
+    """memory-map 讀取 sidecar；沒有 manifest / 檔案 / pyarrow 時回傳 None。"""
+    if not date_tag:
+        return None
+    man = load_manifest(records_dir, date_tag)
+    ent = ((man or {}).get("tables") or {}).get(table)
+    if not ent:
+        return None
+    path = os.path.join(records_dir, ent["file"])
+    if not os.path.exists(path):
+        return None
+    try:
+        import pyarrow as pa
+        with pa.memory_map(path, "r") as src:
+            tbl = pa.ipc.open_file(src).read_all()
+        return tbl.to_pandas()
+    except Exception:
+        return None
+
+
+def latest_sidecar_date(records_dir: str) -> str | None:
+    files = sorted(glob.glob(os.path.join(records_dir, f"*{MANIFEST_SUFFIX}")))
+    if not files:
+        return None
+    return os.path.basename(files[-1])[: -len(MANIFEST_SUFFIX)]
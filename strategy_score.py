@@ -7,8 +7,49 @@ strategy_score.py  (v6.3.29-F4)
 """
 from __future__ import annotations
 import math
+import os
 import pandas as pd
 
+# 排名分組：market（預設，TWSE/TWO 分開排名）/ strategy / sector，可用逗號組合；空字串 = 全市場混排（舊行為）
+RANK_GROUP_BY = os.environ.get("RANK_GROUP_BY", "market").strip()
+
+STRATEGY_KEY_CANDIDATES = ["strategy", "策略代碼", "strategy_desc", "策略說明"]
+SECTOR_KEY_CANDIDATES = ["sector", "產業別", "industry"]
+MARKET_COL_CANDIDATES = ["市場", "market"]
+TICKER_COL_CANDIDATES = ["Yahoo代碼", "ticker"]
+
+
+def market_from_ticker(t) -> str:
+    s = str(t).strip().upper()
+    if s.endswith(".TWO"):
+        return "TWO"
+    if s.endswith(".TW"):
+        return "TWSE"
+    return ""
+
+
+def _normalize_market(v) -> str:
+    s = str(v).strip()
+    su = s.upper()
+    if su in ("TW", "TWSE", "LISTED") or s == "上市":
+        return "TWSE"
+    if su in ("TWO", "OTC", "TPEX") or s == "上櫃":
+        return "TWO"
+    return su
+
+
+def market_keys(df: pd.DataFrame) -> pd.Series:
+    """市場群組鍵（TWSE/TWO）：優先市場欄，否則由 Yahoo 代碼後綴推得。"""
+    mcol = next((c for c in MARKET_COL_CANDIDATES if c in df.columns), None)
+    if mcol is not None:
+        m = df[mcol].map(_normalize_market)
+        if (m != "").any():
+            return m
+    tcol = next((c for c in TICKER_COL_CANDIDATES if c in df.columns), None)
+    if tcol is None:
+        return pd.Series([""] * len(df), index=df.index)
+    return df[tcol].map(market_from_ticker)
+
 
 def light_label(x: float, t1: float, t2: float, reverse: bool=False) -> str:
     """Return emoji light based on thresholds.
@@ -57,6 +98,43 @@ def _rank01(series, higher_better=True):
         r = 1.0 - r
     return r.fillna(0.0)
 
+def rank_group_keys(df: pd.DataFrame, group_by: str | None = None) -> pd.Series | None:
+    """
+    組合排名分組鍵；回傳 None 表示不分組。
+    group_by 例："market"、"market,strategy"、"sector"。
+    """
+    spec = RANK_GROUP_BY if group_by is None else group_by
+    parts = [p.strip().lower() for p in str(spec or "").split(",") if p.strip()]
+    if not parts or df is None or len(df) == 0:
+        return None
+    keys = pd.Series([""] * len(df), index=df.index)
+    for p in parts:
+        if p == "market":
+            k = market_keys(df)
+        else:
+            cands = STRATEGY_KEY_CANDIDATES if p == "strategy" else (SECTOR_KEY_CANDIDATES if p == "sector" else [p])
+            col = next((c for c in cands if c in df.columns), None)
+            if col is None:
+                continue
+            k = df[col]
+        keys = keys + "|" + k.fillna("").astype(str)
+    return keys
+
+def grouped_rank01(components: pd.DataFrame, keys: pd.Series | None = None, lower_better=()) -> pd.DataFrame:
+    """
+    一次向量化 groupby().rank(pct=True) 計算所有分數元件的百分位排名（0~1）。
+    與 _rank01 相同規則：整組皆 NaN → 0；NaN → 0；lower_better 欄位取 1-r。
+    """
+    num = components.apply(_to_num)
+    if keys is None:
+        r = num.rank(pct=True)
+    else:
+        r = num.groupby(keys.values, sort=False, dropna=False).rank(pct=True)
+    for c in lower_better:
+        if c in r.columns:
+            r[c] = 1.0 - r[c]
+    return r.fillna(0.0)
+
 def _light_from_levels(x, hi, mid, reverse=False):
     """回傳：🟢/🟡/🔴/N/A。reverse=True 表示數值越大越危險。"""
     if x is None or (isinstance(x, float) and math.isnan(x)):
@@ -186,7 +264,8 @@ def add_lights(df: pd.DataFrame) -> pd.DataFrame:
         out["成交值燈號"] = "N/A"
     return out
 
-def compute_composite_score_live(df: pd.DataFrame) -> pd.DataFrame:
+def compute_composite_score_live(df: pd.DataFrame, group_by: str | None = None) -> pd.DataFrame:
+    """綜合分數；百分位排名依 group_by（預設 RANK_GROUP_BY=market）分組計算。"""
     if df is None:
         return pd.DataFrame()
     out = df.copy()
@@ -199,17 +278,18 @@ def compute_composite_score_live(df: pd.DataFrame) -> pd.DataFrame:
     col_vola = "年化波動" if "年化波動" in out.columns else ("vol_annual" if "vol_annual" in out.columns else None)
     col_price = "進場價" if "進場價" in out.columns else ("entry_price" if "entry_price" in out.columns else None)
 
-    w_score = _rank01(out[col_score] if col_score else pd.Series([0.0]*len(out), index=out.index), True)
-    w_pos = _rank01(out[col_pos] if col_pos else pd.Series([0.0]*len(out), index=out.index), True)
-
+    zeros = pd.Series([0.0]*len(out), index=out.index)
+    comps = pd.DataFrame({
+        "score": _to_num(out[col_score]) if col_score else zeros,
+        "pos": _to_num(out[col_pos]) if col_pos else zeros,
+        "turn": _to_num(out[col_turn]) if col_turn else zeros,
+        "tv": _to_num(out[col_tv]) if col_tv else zeros,
+    }, index=out.index)
     if col_bias:
-        b = _to_num(out[col_bias]).fillna(0.0).abs()
-        w_bias = _rank01(b, True)
-    else:
-        w_bias = pd.Series([0.0]*len(out), index=out.index)
-
-    w_turn = _rank01(out[col_turn] if col_turn else pd.Series([0.0]*len(out), index=out.index), True)
-    w_tv = _rank01(out[col_tv] if col_tv else pd.Series([0.0]*len(out), index=out.index), True)
+        comps["bias"] = _to_num(out[col_bias]).fillna(0.0).abs()
+    ranks = grouped_rank01(comps, rank_group_keys(out, group_by))
+    w_score, w_pos, w_turn, w_tv = ranks["score"], ranks["pos"], ranks["turn"], ranks["tv"]
+    w_bias = ranks["bias"] if col_bias else zeros
 
     out["成交值排名"] = w_tv.round(4)
 
@@ -0,0 +1,155 @@
+"""
+strategy_weights.py  (v6.3.29-F4.8)
+
+動態權重的輸入 / 狀態快取：
+- performance_summary.xlsx（ByStrategy）解析結果以 (路徑, mtime_ns, size, min_trades) 為鍵，
+  存成 cache/weight_inputs.pkl；檔案沒變就不再 pd.read_excel
+- strategy_weights_state.json 讀取同樣以 mtime/size 快取；權重沒變時不重寫
+- broadcast_trace：trace（每策略一列）一次對齊到候選表，取代逐欄 apply(lambda)
+
+daily_auto_run_final 的 load_weight_inputs_from_summary / _load_prev_weights / _save_prev_weights
+委派到這裡，解析規則與原本相同。
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+import pickle
+
+import pandas as pd
+
+SUMMARY_SHEET = "ByStrategy"
+INPUTS_CACHE = os.path.join("cache", "weight_inputs.pkl")
+CACHE_VERSION = 1
+
+_MEMO: dict = {}
+
+
+def file_key(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def parse_summary(path: str, min_trades: int) -> dict | None:
+    """ByStrategy → {strategy: {annualized_pct, mdd_pct, trades, score_raw}}（與 v6.3.29 相同規則）。"""
+    try:
+        df = pd.read_excel(path, sheet_name=SUMMARY_SHEET)
+    except Exception:
+        return None
+    if "strategy" not in [c.lower() for c in df.columns]:
+        return None
+    strategy_col = next(c for c in df.columns if c.lower() == "strategy")
+    ann_col = next((c for c in df.columns if c.lower().startswith("annualized")), None)
+    mdd_col = next((c for c in df.columns if c.lower().startswith("mdd")), None)
+    trades_col = next((c for c in df.columns if c.lower().startswith("trades")), None)
+    if ann_col is None or mdd_col is None:
+        return None
+    cols = [strategy_col, ann_col, mdd_col] + ([trades_col] if trades_col else [])
+    df = df[cols].copy()
+    df.columns = ["strategy", "annualized_pct", "mdd_pct"] + (["trades"] if trades_col else [])
+    df["annualized_pct"] = pd.to_numeric(df["annualized_pct"], errors="coerce")
+    df["mdd_pct"] = pd.to_numeric(df["mdd_pct"], errors="coerce")
+    df["trades"] = pd.to_numeric(df["trades"], errors="coerce") if "trades" in df.columns else pd.NA
+    df = df.dropna(subset=["strategy", "annualized_pct", "mdd_pct"])
+    if df.empty:
+        return None
+    df["score_raw"] = (df["annualized_pct"].clip(lower=0) / df["mdd_pct"].abs().clip(lower=1.0))
+    df["score_raw"] = df["score_raw"].replace([math.inf, -math.inf], pd.NA).fillna(0.0)
+    mask = df["trades"].notna() & (df["trades"] < min_trades)
+    df.loc[mask, "score_raw"] *= (df.loc[mask, "trades"] / min_trades).clip(lower=0, upper=1)
+    return {
+        str(s): {
+            "annualized_pct": float(a),
+            "mdd_pct": float(m),
+            "trades": None if pd.isna(t) else float(t),
+            "score_raw": float(sc),
+        }
+        for s, a, m, t, sc in zip(df["strategy"].tolist(), df["annualized_pct"].tolist(), df["mdd_pct"].tolist(),
+                                  df["trades"].tolist(), df["score_raw"].tolist())
+    }
+
+
+def _read_pickle_cache(path: str):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _write_pickle_cache(path: str, obj) -> None:
+    try:
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception:
+        pass
+
+
+def load_summary_inputs(path: str, min_trades: int, cache_path: str = INPUTS_CACHE) -> dict | None:
+    """mtime/size 沒變 → 記憶體 / pickle 快取；變了才重新解析 Excel。"""
+    fk = file_key(path)
+    if fk is None:
+        return None
+    key = (CACHE_VERSION, fk, int(min_trades))
+    hit = _MEMO.get(("inputs", path))
+    if hit is not None and hit[0] == key:
+        return hit[1]
+    cached = _read_pickle_cache(cache_path)
+    if isinstance(cached, dict) and cached.get("key") == key:
+        inputs = cached.get("inputs")
+    else:
+        inputs = parse_summary(path, min_trades)
+        _write_pickle_cache(cache_path, {"key": key, "inputs": inputs})
+    _MEMO[("inputs", path)] = (key, inputs)
+    return inputs
+
+
+def load_state(path: str) -> dict | None:
+    """strategy_weights_state.json 的 weights；以 mtime/size 快取。"""
+    fk = file_key(path)
+    if fk is None:
+        return None
+    hit = _MEMO.get(("state", path))
+    if hit is not None and hit[0] == fk:
+        return hit[1]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            w = (json.load(f) or {}).get("weights", None)
+    except Exception:
+        return None
+    _MEMO[("state", path)] = (fk, w)
+    return w
+
+
+def save_state(path: str, weights: dict, updated: str) -> bool:
+    """權重與現有狀態相同時不重寫；回傳是否寫檔。"""
+    if os.path.exists(path) and load_state(path) == weights:
+        return False
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"updated": updated, "weights": weights}, f, ensure_ascii=False, indent=2)
+    except Exception:
+        return False
+    fk = file_key(path)
+    if fk is not None:
+        _MEMO[("state", path)] = (fk, weights)
+    return True
+
+
+def broadcast_trace(df: pd.DataFrame, trace: dict, cols: list[str], key: str = "strategy") -> pd.DataFrame:
+    """trace {strategy: {col: value}} → 依 key 對齊寫入 df 的 cols（原欄位位置不變）。"""
+    tdf = pd.DataFrame.from_dict({s: (v or {}) for s, v in trace.items()}, orient="index")
+    tdf = tdf.reindex(columns=cols)
+    aligned = tdf.reindex(df[key].to_numpy())
+    for c in cols:
+        df[c] = aligned[c].to_numpy()
+    return df
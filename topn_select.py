@@ -0,0 +1,132 @@
+"""
+topn_select.py  (v6.3.29-F4.8)
+
+Top-N 選股（部分選取，不排序整張 FULL）：
+- 排序鍵：綜合分數 高→低，乖離率 低→高，NaN 置後（與原 sort_values + head 相同）
+- 無配額：heapq.nsmallest → O(n log k)
+- 有配額（市場 / 策略）：heapify 後依序 pop，超過配額者略過
+- 最低燈號門檻：例如 {"成交值燈號": "🟡"} → 只保留 🟡/🟢
+
+export_top20.build_top20 與 daily_auto_run_final（同程序 Top20）共用。
+"""
+from __future__ import annotations
+
+import heapq
+import math
+
+import pandas as pd
+
+from strategy_score import market_keys
+
+LIGHT_LEVEL = {"🟢": 3, "🟡": 2, "🔴": 1}
+
+STRATEGY_COL_CANDIDATES = ["策略代碼", "strategy", "策略說明", "strategy_desc"]
+
+
+def parse_quota(spec: str | dict | None) -> dict[str, int]:
+    """'TWSE:12,TWO:8' -> {'TWSE': 12, 'TWO': 8}；'*' 為其餘群組的預設配額。"""
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        return {str(k): int(v) for k, v in spec.items()}
+    out = {}
+    for part in str(spec).split(","):
+        if ":" not in part:
+            continue
+        k, v = part.rsplit(":", 1)
+        try:
+            out[k.strip()] = int(v.strip())
+        except Exception:
+            continue
+    return out
+
+
+def parse_min_lights(spec: str | dict | None) -> dict[str, str]:
+    """'成交值燈號:🟡,周轉率燈號:🟡' -> {'成交值燈號': '🟡', '周轉率燈號': '🟡'}"""
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        return {str(k): str(v) for k, v in spec.items()}
+    out = {}
+    for part in str(spec).split(","):
+        if ":" not in part:
+            continue
+        k, v = part.rsplit(":", 1)
+        out[k.strip()] = v.strip()
+    return out
+
+
+def _float_list(s: pd.Series) -> list[float]:
+    return [float("nan") if v is None else float(v) for v in pd.to_numeric(s, errors="coerce").astype("float64").tolist()]
+
+
+def _within(counts: dict, quota: dict, key) -> bool:
+    if not quota:
+        return True
+    lim = quota.get(key, quota.get("*"))
+    return lim is None or counts.get(key, 0) < lim
+
+
+def select_top_n(
+    df: pd.DataFrame,
+    n: int = 20,
+    score_col: str = "綜合分數",
+    tiebreak_col: str | None = "乖離率(%)",
+    tiebreak_ascending: bool = True,
+    market_quota: dict | str | None = None,
+    strategy_quota: dict | str | None = None,
+    min_lights: dict | str | None = None,
+    strategy_col: str | None = None,
+) -> pd.DataFrame:
+    """回傳依排名排序的前 n 列（保留原 index 與欄位）。"""
+    if df is None or len(df) == 0 or n <= 0:
+        return df.iloc[0:0] if df is not None else pd.DataFrame()
+
+    market_quota = parse_quota(market_quota)
+    strategy_quota = parse_quota(strategy_quota)
+    min_lights = parse_min_lights(min_lights)
+
+    keep = pd.Series(True, index=df.index)
+    for col, lvl in min_lights.items():
+        if col not in df.columns:
+            continue
+        need = LIGHT_LEVEL.get(lvl, 0)
+        keep &= df[col].map(LIGHT_LEVEL).fillna(0) >= need
+
+    nan = float("nan")
+    score = _float_list(df[score_col]) if score_col in df.columns else [nan] * len(df)
+    tb = _float_list(df[tiebreak_col]) if (tiebreak_col and tiebreak_col in df.columns) else [nan] * len(df)
+    sign = 1.0 if tiebreak_ascending else -1.0
+
+    keys = []
+    for pos, (ok, sc, b) in enumerate(zip(keep.tolist(), score, tb)):
+        if not ok:
+            continue
+        sc_nan, b_nan = math.isnan(sc), math.isnan(b)
+        keys.append((sc_nan, 0.0 if sc_nan else -sc, b_nan, 0.0 if b_nan else sign * b, pos))
+
+    if not market_quota and not strategy_quota:
+        picked = [k[-1] for k in heapq.nsmallest(n, keys)]
+        return df.iloc[picked]
+
+    mkeys = market_keys(df).tolist() if market_quota else None
+    if strategy_quota:
+        scol = strategy_col or next((c for c in STRATEGY_COL_CANDIDATES if c in df.columns), None)
+        skeys = df[scol].astype(str).tolist() if scol else [""] * len(df)
+    else:
+        skeys = None
+
+    heapq.heapify(keys)
+    picked, m_cnt, s_cnt = [], {}, {}
+    while keys and len(picked) < n:
+        pos = heapq.heappop(keys)[-1]
+        mk = mkeys[pos] if mkeys is not None else None
+        sk = skeys[pos] if skeys is not None else None
+        if not _within(m_cnt, market_quota, mk) or not _within(s_cnt, strategy_quota, sk):
+            continue
+        picked.append(pos)
+        if mk is not None:
+            m_cnt[mk] = m_cnt.get(mk, 0) + 1
+        if sk is not None:
+            s_cnt[sk] = s_cnt.get(sk, 0) + 1
+    return df.iloc[picked]